@@ -0,0 +1,176 @@
+"""
+Cache of complete LLM answers.
+
+Keyed on the normalized query tokens plus the retrieved context (the
+ordered docs with the passages sent to the LLM), the model and the
+temperature, so the same question over the same context is answered
+once. A document replaced through POST /documents changes the key, so
+an answer written from its old text is never replayed, in any worker
+or after a restart. Answers are stored as the
+list of streamed tokens and replayed as-is, which keeps the SSE output
+identical to a live answer.
+
+Two tiers: an in-memory LRU with a TTL, and an optional SQLite file
+shared across restarts (and across workers on the same host). Every
+SQLite call runs on one dedicated thread, never on the event loop: a
+lookup that misses memory awaits it, a write is queued to it. The
+connection is opened there on first use. main.py's lifespan calls
+purge() every ANSWER_CACHE_PURGE_INTERVAL seconds to drop expired
+answers from both tiers.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from tokenizer import tokenize
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))  # 0 disables
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))  # seconds
+ANSWER_CACHE_DB = os.getenv("ANSWER_CACHE_DB", "")  # SQLite path, empty = memory only
+ANSWER_CACHE_PURGE_INTERVAL = float(os.getenv("ANSWER_CACHE_PURGE_INTERVAL", "300"))  # seconds
+
+
+def cache_key(query: str, context_docs: list[dict], model: str, temperature: float) -> str:
+    payload = json.dumps(
+        [" ".join(tokenize(query)), context_docs, model, temperature],
+        separators=(",", ":"), sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class AnswerCache:
+    """LRU + TTL answer cache with an optional SQLite second tier."""
+
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 db_path: str = ANSWER_CACHE_DB):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._mem: OrderedDict[str, tuple[float, list[str]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.db_path = db_path if max_size > 0 else ""
+        self._db = None  # opened by the db thread's first call, see _conn()
+        # the only thread that touches SQLite; started by its first task
+        self._db_thread = (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="answer-cache")
+            if self.db_path else None
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    async def get(self, key: str) -> list[str] | None:
+        """Cached tokens for `key`, or None. Counts a hit or a miss."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._mem[key]
+
+        row = None
+        if self._db_thread is not None:
+            loop = asyncio.get_running_loop()
+            row = await loop.run_in_executor(self._db_thread, self._db_get, key)
+        with self._lock:
+            if row is not None and now - row[0] <= self.ttl:
+                self._put_mem(key, *row)
+                self.hits += 1
+                return row[1]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, tokens: list[str]):
+        """Store an answer; the SQLite write is queued, so this never blocks."""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._put_mem(key, now, tokens)
+        if self._db_thread is not None:
+            self._db_thread.submit(self._db_put, key, json.dumps(tokens), now)
+
+    def purge(self):
+        """Drop expired answers: from memory now, from SQLite on the db thread."""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for key in [k for k, (created, _) in self._mem.items() if created < cutoff]:
+                del self._mem[key]
+        if self._db_thread is not None:
+            self._db_thread.submit(self._db_purge, cutoff)
+
+    # ── SQLite tier, on self._db_thread only ───────────────
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS answers "
+                "(key TEXT PRIMARY KEY, tokens TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS answers_created ON answers (created)")
+        return self._db
+
+    def _db_get(self, key: str) -> tuple[float, list[str]] | None:
+        row = self._conn().execute(
+            "SELECT created, tokens FROM answers WHERE key = ?", (key,)
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def _db_put(self, key: str, tokens: str, created: float):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO answers (key, tokens, created) VALUES (?, ?, ?)",
+            (key, tokens, created),
+        )
+
+    def _db_purge(self, cutoff: float):
+        n = self._conn().execute("DELETE FROM answers WHERE created < ?", (cutoff,)).rowcount
+        if n:
+            print(f"[answer_cache] purged {n} expired answers")
+
+    def _db_close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _put_mem(self, key: str, created: float, tokens: list[str]):
+        self._mem[key] = (created, tokens)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_size:
+            self._mem.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._mem),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def close(self):
+        """Finish queued writes and close the connection."""
+        if self._db_thread is not None:
+            self._db_thread.submit(self._db_close)
+            self._db_thread.shutdown(wait=True)
+            self._db_thread = None
+
+
+# module-level singleton
+answer_cache = AnswerCache()
@@ -0,0 +1,338 @@
+"""
+Retrieval benchmarks on synthetic genomic corpora.
+
+Corpora are generated from the GENOMIC_KNOWLEDGE_BASE templates: each
+synthetic doc takes a template's type and sentences, another gene and
+protein change, and a few sentences borrowed from other templates. Each
+(corpus size, engine) case runs in its own process, so build memory and
+peak RSS don't leak between cases. A case measures:
+
+    build_s            index build (or streaming build + mmap load)
+    peak_rss_mb        ru_maxrss of the case process
+    index_mb           on-disk size (mmap) or RSS growth during the build
+    search / tfidf_query / bm25_score
+                       p50/p95/p99 latency (ms) and single-thread QPS of
+                       HybridRetriever.search and the two scorers alone
+
+    python bench.py run [--sizes 1000,100000,1000000] [--engines dict,csr,compact,mmap]
+    python bench.py compare old.json new.json
+
+Results are JSON (default data/bench/bench-<commit>.json); `compare`
+prints the ratio of every metric between two runs. Generated corpora
+are cached under data/bench/ and reused.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from genomic_db import GENOMIC_KNOWLEDGE_BASE
+
+BENCH_DIR = os.getenv("BENCH_DIR", "data/bench")
+ENGINES = ("dict", "csr", "compact", "mmap")  # mmap = streaming build + load_index
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+
+EXTRA_GENES = (
+    "EGFR", "BRAF", "PIK3CA", "PTEN", "ATM", "PALB2", "CDKN2A", "SMAD4", "ALK",
+    "MYC", "ERBB2", "IDH1", "NRAS", "APC", "RB1", "ARID1A", "KMT2D", "NOTCH1",
+)
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z])")
+
+
+# ── synthetic corpus ──────────────────────────────────────
+
+def _templates():
+    genes = sorted({d["gene"] for d in GENOMIC_KNOWLEDGE_BASE if d["gene"] != "multi"})
+    genes += [g for g in EXTRA_GENES if g not in genes]
+    sentences = [_SENTENCE_RE.split(d["content"]) for d in GENOMIC_KNOWLEDGE_BASE]
+    return genes, sentences
+
+
+def _variant(rng: random.Random) -> str:
+    return f"{rng.choice(AMINO_ACIDS)}{rng.randint(2, 1200)}{rng.choice(AMINO_ACIDS)}"
+
+
+def synth_documents(n: int, seed: int = 0):
+    """`n` synthetic documents shaped like the knowledge base."""
+    rng = random.Random(seed)
+    genes, sentences = _templates()
+    all_sentences = [s for doc in sentences for s in doc]
+    for i in range(n):
+        t = rng.randrange(len(GENOMIC_KNOWLEDGE_BASE))
+        template = GENOMIC_KNOWLEDGE_BASE[t]
+        gene = template["gene"] if rng.random() < 0.3 else rng.choice(genes)
+        variant = _variant(rng)
+        body = [s.replace(template["gene"], gene) for s in sentences[t]]
+        body += rng.sample(all_sentences, rng.randint(1, 4))
+        rng.shuffle(body)
+        yield {
+            "id": f"SYN-{i:07d}",
+            "title": f"{gene} {variant}: {template['title'].split(' — ')[0]}",
+            "type": template["type"],
+            "gene": gene,
+            "content": f"{gene} p.{variant} ({template['type'].replace('_', ' ')}). " + " ".join(body),
+            "references": rng.sample(template["references"], 1),
+        }
+
+
+def synth_queries(n: int, seed: int = 1) -> list[str]:
+    """A mix of gene + variant, gene + keywords and free-text queries."""
+    rng = random.Random(seed)
+    genes, sentences = _templates()
+    words = [w.strip(".,;:()") for doc in sentences for s in doc for w in s.split() if len(w) > 4]
+    queries = []
+    for _ in range(n):
+        kind = rng.random()
+        gene = rng.choice(genes)
+        if kind < 0.3:
+            queries.append(f"{gene} {_variant(rng)}")
+        elif kind < 0.7:
+            queries.append(f"{gene} " + " ".join(rng.sample(words, rng.randint(1, 3))))
+        else:
+            queries.append(" ".join(rng.sample(words, rng.randint(3, 6))))
+    return queries
+
+
+def corpus_path(n: int, seed: int = 0) -> str:
+    """Cached JSONL corpus of `n` synthetic docs, generated on first use."""
+    path = os.path.join(BENCH_DIR, f"corpus-{n}-{seed}.jsonl")
+    if not os.path.exists(path):
+        os.makedirs(BENCH_DIR, exist_ok=True)
+        tmp = f"{path}.tmp-{os.getpid()}"
+        with open(tmp, "w") as f:
+            for doc in synth_documents(n, seed):
+                f.write(json.dumps(doc) + "\n")
+        os.replace(tmp, path)
+    return path
+
+
+# ── one case (runs in a child process) ────────────────────
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def _dir_mb(path: str) -> float:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    ) / 2**20
+
+
+def _latency_stats(latencies: list[float], qps: bool = True) -> dict:
+    """p50/p95/p99 in ms, plus the rate of back-to-back (single-thread) calls."""
+    lat = sorted(latencies)
+
+    def pct(q):
+        return round(lat[min(len(lat) - 1, int(q * len(lat)))] * 1000, 3)
+
+    stats = {"p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99)}
+    if qps:
+        stats["qps"] = round(len(lat) / sum(lat), 1) if sum(lat) else None
+    return stats
+
+
+def _timed(fn, inputs) -> list[float]:
+    latencies = []
+    for x in inputs:
+        t0 = time.perf_counter()
+        fn(x)
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+def run_case(engine: str, corpus: str, n_queries: int, top_k: int) -> dict:
+    # config is read at import time, so set it before importing the retriever
+    os.environ["DOCUMENT_SOURCE"] = corpus
+    os.environ["RETRIEVAL_CACHE_SIZE"] = "0"  # measure scoring, not the cache
+    os.environ.pop("INDEX_DIR", None)
+    from retriever import HybridRetriever
+    from tokenizer import tokenize
+
+    rss0 = _rss_mb()
+    t0 = time.perf_counter()
+    if engine == "mmap":
+        from index_builder import build_index_streaming
+        index_dir = os.path.join(BENCH_DIR, f"index-{os.getpid()}")
+        build_index_streaming(corpus, index_dir)
+        retriever = HybridRetriever("csr")
+        retriever.load_index(index_dir)
+        index_mb = _dir_mb(index_dir)
+    else:
+        retriever = HybridRetriever(engine)
+        retriever.build_index()
+        index_dir = None
+        index_mb = _rss_mb() - rss0
+    build_s = time.perf_counter() - t0
+
+    queries = synth_queries(n_queries)
+    token_lists = [tokenize(q) for q in queries]
+    for q in queries[:20]:  # warm-up: lazy imports, page cache
+        retriever.search(q, top_k)
+
+    result = {
+        "engine": engine,
+        "n_docs": retriever.index_size,
+        "n_passages": len(retriever.passages),
+        "build_s": round(build_s, 3),
+        "index_mb": round(index_mb, 1),
+        "search": _latency_stats(_timed(lambda q: retriever.search(q, top_k), queries)),
+        "tfidf_query": _latency_stats(
+            _timed(lambda t: retriever.tfidf.query_tokens(t, top_k=top_k * 2), token_lists)
+        ),
+        "bm25_score": _latency_stats(
+            _timed(lambda t: retriever.bm25.score(t, top_k=top_k * 2), token_lists)
+        ),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if index_dir:
+        shutil.rmtree(index_dir, ignore_errors=True)
+    return result
+
+
+# ── commands ──────────────────────────────────────────────
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return out.stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def _cmd_case(args):
+    result = run_case(args.engine, args.corpus, args.queries, args.top_k)
+    print(json.dumps(result))
+
+
+def _cmd_run(args):
+    sizes = [int(s) for s in args.sizes.split(",")]
+    engines = args.engines.split(",")
+    for engine in engines:
+        if engine not in ENGINES:
+            raise SystemExit(f"unknown engine {engine!r}, expected one of {ENGINES}")
+
+    commit = _git_commit()
+    report = {
+        "commit": commit,
+        "created": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "queries": args.queries,
+        "top_k": args.top_k,
+        "cases": [],
+    }
+    for n in sizes:
+        t0 = time.time()
+        corpus = corpus_path(n)
+        print(f"[bench] corpus {n} docs ready ({time.time() - t0:.1f}s)")
+        for engine in engines:
+            cmd = [sys.executable, os.path.abspath(__file__), "case", "--engine", engine,
+                   "--corpus", corpus, "--queries", str(args.queries), "--top-k", str(args.top_k)]
+            try:
+                proc = subprocess.run(cmd, capture_output=True, text=True, timeout=args.timeout)
+            except subprocess.TimeoutExpired:
+                # subprocess.run has already killed the case; keep going
+                proc = None
+            if proc is None:
+                case = {"engine": engine, "n_docs": n, "error": f"timed out after {args.timeout:g}s",
+                        "timed_out": True}
+            elif proc.returncode != 0:
+                # e.g. the dict engine running out of memory at 1M docs
+                err = (proc.stderr.strip().splitlines() or [f"exit {proc.returncode}"])[-1]
+                case = {"engine": engine, "n_docs": n, "error": err}
+            else:
+                case = json.loads(proc.stdout.strip().splitlines()[-1])
+            case["size"] = n
+            report["cases"].append(case)
+            print(f"[bench] {n:>8} docs {engine:>8}: " + (
+                f"error: {case['error']}" if "error" in case else
+                f"build {case['build_s']}s, peak {case['peak_rss_mb']} MiB, "
+                f"search p50 {case['search']['p50_ms']} ms p99 {case['search']['p99_ms']} ms, "
+                f"{case['search']['qps']} qps"
+            ))
+
+    out = args.out or os.path.join(BENCH_DIR, f"bench-{commit}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[bench] wrote {out}")
+
+
+def _flatten(case: dict) -> dict:
+    out = {}
+    for key, value in case.items():
+        if isinstance(value, dict):
+            out.update({f"{key}.{k}": v for k, v in value.items()})
+        elif isinstance(value, (int, float)) and key not in ("size", "n_docs", "n_passages"):
+            out[key] = value
+    return out
+
+
+def _cmd_compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    old_cases = {(c["size"], c["engine"]): _flatten(c) for c in old["cases"]}
+    print(f"{old['commit']} -> {new['commit']} (ratio new/old; latency, time and memory: lower is better)")
+    for case in new["cases"]:
+        key = (case["size"], case["engine"])
+        before, after = old_cases.get(key), _flatten(case)
+        if not before or "error" in case:
+            continue
+        ratios = [
+            f"{metric} {after[metric] / before[metric]:.2f}x"
+            for metric in after if before.get(metric)
+        ]
+        print(f"{key[0]:>8} {key[1]:>8}: " + ", ".join(ratios))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Retrieval benchmarks on synthetic corpora.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="benchmark every (size, engine) case")
+    run.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)))
+    run.add_argument("--engines", default=",".join(ENGINES))
+    run.add_argument("--queries", type=int, default=500)
+    run.add_argument("--top-k", type=int, default=5)
+    run.add_argument("--timeout", type=float, default=3600, help="seconds per case")
+    run.add_argument("--out", default=None)
+    run.set_defaults(func=_cmd_run)
+
+    case = sub.add_parser("case", help="one case, JSON on stdout (used by run)")
+    case.add_argument("--engine", choices=ENGINES, required=True)
+    case.add_argument("--corpus", required=True)
+    case.add_argument("--queries", type=int, default=500)
+    case.add_argument("--top-k", type=int, default=5)
+    case.set_defaults(func=_cmd_case)
+
+    compare = sub.add_parser("compare", help="metric ratios between two result files")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.set_defaults(func=_cmd_compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
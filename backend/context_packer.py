@@ -0,0 +1,163 @@
+"""
+Token-budget context packing for the LLM prompt.
+
+Pasting every retrieved document whole makes the prompt, and with it
+upstream latency and cost, grow with top_k. pack_context() fills at most
+CONTEXT_TOKEN_BUDGET tokens instead:
+
+  1. each doc's header (id, title, type, gene) and best passage, in
+     retrieval order; lower-ranked docs that don't fit are dropped
+  2. the remaining passages, best first, while they fit
+
+Passages are the sentences of a doc's content, scored against the query
+with BM25 over the query terms they contain, weighted by the retriever's
+IDFs (HybridRetriever.term_weights). Kept passages are printed in their
+original order, "..." marking the gaps. References are numbered once and
+listed after the documents, so a paper cited by several docs is only
+sent once.
+
+Token counts are estimated at ~4 characters per token, which is close
+enough for a budget without pulling in the model's tokenizer.
+"""
+
+import os
+import re
+
+from tokenizer import tokenize
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))  # 0 = no limit
+CHARS_PER_TOKEN = 4
+
+# sentence ends: ., ! or ? followed by whitespace and an uppercase letter,
+# digit or bracket, so "p.G12C" or "c.68_69delAG" don't split
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\[])")
+
+# BM25 parameters for passages
+K1 = 1.2
+B = 0.75
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def split_passages(text: str) -> list[str]:
+    """Sentence-level passages of `text`."""
+    return [p for p in (s.strip() for s in _SENTENCE_RE.split(text)) if p]
+
+
+class _Passage:
+    __slots__ = ("doc", "pos", "text", "cost", "score")
+
+    def __init__(self, doc: int, pos: int, text: str):
+        self.doc = doc
+        self.pos = pos
+        self.text = text
+        self.cost = estimate_tokens(text) + 1  # + the joining space
+        self.score = 0.0
+
+
+def _score_passages(passages: list[_Passage], weights: dict[str, float]):
+    token_lists = [tokenize(p.text) for p in passages]
+    avg_len = sum(map(len, token_lists)) / max(len(token_lists), 1) or 1.0
+    for p, tokens in zip(passages, token_lists):
+        tf: dict[str, int] = {}
+        for t in tokens:
+            if t in weights:
+                tf[t] = tf.get(t, 0) + 1
+        norm = K1 * (1 - B + B * len(tokens) / avg_len)
+        p.score = sum(weights[t] * c * (K1 + 1) / (c + norm) for t, c in tf.items())
+
+
+def pack_context(
+    query: str,
+    documents: list[dict],
+    weights: dict[str, float] | None = None,
+    budget: int | None = None,
+) -> str:
+    """
+    Context block for the LLM within `budget` tokens (default
+    CONTEXT_TOKEN_BUDGET, 0 = everything). `weights` maps query tokens to
+    their importance; without it every query token counts the same.
+    """
+    if not documents:
+        return "No relevant documents were retrieved."
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    if weights is None:
+        weights = dict.fromkeys(tokenize(query), 1.0)
+
+    passages = [
+        _Passage(d, pos, text)
+        for d, doc in enumerate(documents)
+        for pos, text in enumerate(split_passages(doc.get("content", "")))
+    ]
+    _score_passages(passages, weights)
+    best: dict[int, _Passage] = {}
+    for p in passages:
+        if p.doc not in best or p.score > best[p.doc].score:
+            best[p.doc] = p
+
+    # ── each doc with its best passage, in retrieval order ─
+    remaining = budget or None
+    ref_ids: dict[str, int] = {}
+    headers, doc_refs = [], []
+    kept: set[tuple[int, int]] = set()
+    for d, doc in enumerate(documents):
+        refs = doc.get("references", [])
+        new_refs = [r for r in dict.fromkeys(refs) if r not in ref_ids]
+        header = (
+            f"--- [{doc['id']}] {doc['title']} ---\n"
+            f"Type: {doc['type']} | Gene: {doc.get('gene', 'N/A')}"
+        )
+        cost = (
+            estimate_tokens(header) + 4 * len(refs) + 4
+            + sum(estimate_tokens(r) + 3 for r in new_refs)
+            + (best[d].cost if d in best else 0)
+        )
+        if remaining is not None and headers and cost > remaining:
+            break  # lower-ranked docs don't fit at all
+        for ref in new_refs:
+            ref_ids[ref] = len(ref_ids) + 1
+        headers.append(header)
+        doc_refs.append([f"[R{ref_ids[r]}]" for r in refs])
+        if d in best:
+            kept.add((d, best[d].pos))
+        if remaining is not None:
+            remaining -= cost
+
+    # ── then the remaining passages, best first ────────────
+    rest = sorted(
+        (p for p in passages if p.doc < len(headers) and (p.doc, p.pos) not in kept),
+        key=lambda p: (-p.score, p.doc, p.pos),
+    )
+    for p in rest:
+        if remaining is None or p.cost <= remaining:
+            kept.add((p.doc, p.pos))
+            if remaining is not None:
+                remaining -= p.cost
+
+    # ── render ─────────────────────────────────────────────
+    by_doc: list[list[_Passage]] = [[] for _ in headers]
+    for p in passages:
+        if p.doc < len(headers):
+            by_doc[p.doc].append(p)
+
+    parts = []
+    for d, header in enumerate(headers):
+        body, gap = [], False
+        for p in by_doc[d]:
+            if (p.doc, p.pos) in kept:
+                if gap and body:
+                    body.append("...")
+                body.append(p.text)
+                gap = False
+            else:
+                gap = True
+        if gap and body:
+            body.append("...")
+        refs = ", ".join(doc_refs[d]) or "none"
+        parts.append(f"{header}\n{' '.join(body)}\nReferences: {refs}\n")
+
+    if ref_ids:
+        parts.append("References:\n" + "\n".join(f"[R{n}] {ref}" for ref, n in ref_ids.items()))
+    return "\n".join(parts)
@@ -0,0 +1,416 @@
+"""
+Optional dense (embedding) retrieval: a third ranking for the RRF fusion.
+
+Offline, the corpus is encoded with a sentence-transformers model and
+written to an index directory:
+
+    manifest.json     model, dim, dtype, ANN params, source + fingerprint
+    doc_ids.npy       fixed-width utf-8 doc ids, one per vector row
+    doc_digests.npy   uint64[N] index_store.doc_digest() of each row's doc
+    vectors.npy       float16[N, dim], or int8[N, dim] with
+    scales.npy        float32[N] per-row dequantization scales
+    centroids.npy     float32[nlist, dim]  IVF coarse quantizer
+    list_offsets.npy  int64[nlist + 1]     rows of each inverted list
+    hnsw.bin          only with --ann hnsw (needs hnswlib)
+
+Rows are grouped by IVF list, so probing a list reads one contiguous
+slice of the memory-mapped vectors. With the default IVF index a query
+scores the `nprobe` closest lists only; corpora under 10k docs use a
+single list, i.e. exact search.
+
+Query encoding runs on one dedicated thread (QueryEncoder). Requests
+from concurrent searches that arrive within DENSE_QUERY_WAIT_MS of each
+other go through the model as one batch.
+
+Build with (needs `pip install -r requirements-dense.txt`):
+
+    python dense.py build --out data/dense [--source corpus.jsonl] [--dtype int8]
+
+and start the backend with DENSE_INDEX_DIR=data/dense.
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+DENSE_MODEL = os.getenv("DENSE_MODEL", "all-MiniLM-L6-v2")
+DENSE_NPROBE = int(os.getenv("DENSE_NPROBE", "16"))
+DENSE_QUERY_BATCH = int(os.getenv("DENSE_QUERY_BATCH", "64"))
+DENSE_QUERY_WAIT_MS = float(os.getenv("DENSE_QUERY_WAIT_MS", "2"))
+
+FORMAT_VERSION = 1
+DTYPES = ("float16", "int8")
+ANN_KINDS = ("ivf", "hnsw")
+FLAT_BELOW = 10_000  # docs; smaller corpora get one IVF list (exact search)
+
+
+def load_model(name: str = DENSE_MODEL):
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError as e:
+        raise RuntimeError(
+            "dense retrieval requires sentence-transformers "
+            "(pip install -r requirements-dense.txt)"
+        ) from e
+    return SentenceTransformer(name)
+
+
+def _encode(model, texts: list[str], batch_size: int = 64) -> np.ndarray:
+    """Unit-length float32 embeddings, so a dot product is the cosine."""
+    vecs = model.encode(
+        texts, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True,
+        show_progress_bar=False,
+    )
+    return np.asarray(vecs, dtype=np.float32)
+
+
+def _quantize_int8(vecs: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization: vecs ~= q * scale[:, None]."""
+    scales = np.abs(vecs).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    q = np.rint(vecs / scales[:, None]).astype(np.int8)
+    return q, scales.astype(np.float32)
+
+
+# ── query encoder worker ──────────────────────────────────
+
+class QueryEncoder:
+    """
+    Owns the model and encodes on a dedicated thread. encode() blocks its
+    caller (a retrieval worker) until the batch holding its texts is done.
+    """
+
+    def __init__(self, model, max_batch: int = DENSE_QUERY_BATCH,
+                 max_wait: float = DENSE_QUERY_WAIT_MS / 1000):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.texts = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="dense-encoder", daemon=True)
+        self._thread.start()
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        fut: Future = Future()
+        self._queue.put((texts, fut))
+        return fut.result()
+
+    def close(self):
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch, n = [item], len(item[0])
+            deadline = time.monotonic() + self.max_wait
+            # gather whatever else arrives in the wait window
+            while n < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # finish this batch, then stop
+                    break
+                batch.append(item)
+                n += len(item[0])
+
+            texts = [t for item_texts, _ in batch for t in item_texts]
+            try:
+                vecs = _encode(self.model, texts, batch_size=max(len(texts), 1))
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            self.batches += 1
+            self.texts += len(texts)
+            start = 0
+            for item_texts, fut in batch:
+                fut.set_result(vecs[start:start + len(item_texts)])
+                start += len(item_texts)
+
+
+# ── ANN index ─────────────────────────────────────────────
+
+class DenseIndex:
+    """Memory-mapped vectors + IVF lists (or an hnswlib graph)."""
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"dense index format {self.manifest.get('format_version')} in {path}")
+
+        def arr(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.doc_ids = arr("doc_ids")
+        # None for indexes built before digests: rows bind by id alone
+        self.doc_digests = arr("doc_digests") if os.path.exists(os.path.join(path, "doc_digests.npy")) else None
+        self.vectors = arr("vectors")
+        self.scales = arr("scales") if self.manifest["dtype"] == "int8" else None
+        self.centroids = np.asarray(arr("centroids"), dtype=np.float32)
+        self.list_offsets = np.asarray(arr("list_offsets"))
+        self.nprobe = min(DENSE_NPROBE, len(self.centroids))
+        self._rows: dict[str, int] | None = None  # doc id -> vector row
+
+        self.hnsw = None
+        if self.manifest["ann"] == "hnsw":
+            import hnswlib
+            self.hnsw = hnswlib.Index(space="ip", dim=self.manifest["dim"])
+            self.hnsw.load_index(os.path.join(path, "hnsw.bin"))
+            self.hnsw.set_ef(max(64, DENSE_NPROBE * 8))
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def row_of(self, doc_id: str) -> int | None:
+        if self._rows is None:
+            self._rows = {d.decode(): row for row, d in enumerate(self.doc_ids)}
+        return self._rows.get(doc_id)
+
+    def encodes(self, row: int, digest: int) -> bool:
+        """Whether vector `row` was encoded from the doc with this index_store.doc_digest()."""
+        return self.doc_digests is None or int(self.doc_digests[row]) == digest
+
+    def bind(self, id_to_slot: dict[str, int], digest_of=None) -> np.ndarray:
+        """
+        Vector row -> the retriever's doc slot (-1 = not indexed). The
+        retriever keeps the array in its index snapshot and passes it to
+        search(). With `digest_of` (slot -> doc digest), a doc rewritten
+        since the build keeps no vector: its row encodes the old content.
+        """
+        row_slots = np.full(len(self.doc_ids), -1, dtype=np.int64)
+        for doc_id, slot in id_to_slot.items():
+            row = self.row_of(doc_id)
+            if row is not None and (digest_of is None or self.encodes(row, digest_of(slot))):
+                row_slots[row] = slot
+        return row_slots
+
+    def _score_rows(self, rows: np.ndarray, q: np.ndarray) -> np.ndarray:
+        scores = np.asarray(self.vectors[rows], dtype=np.float32) @ q
+        if self.scales is not None:
+            scores *= self.scales[rows]
+        return scores
+
+    def _score_range(self, start: int, stop: int, q: np.ndarray) -> np.ndarray:
+        # a contiguous slice of the mmap: no gather copy
+        scores = np.asarray(self.vectors[start:stop], dtype=np.float32) @ q
+        if self.scales is not None:
+            scores *= self.scales[start:stop]
+        return scores
+
+    def _candidates(self, q: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """(rows, scores) of the vectors the ANN index considers."""
+        if self.hnsw is not None:
+            labels, _ = self.hnsw.knn_query(q, k=min(len(self), top_k))
+            rows = labels[0].astype(np.int64)
+            return rows, self._score_rows(rows, q)
+        if len(self.centroids) == 1:
+            return np.arange(len(self)), self._score_range(0, len(self), q)
+        centroid_scores = self.centroids @ q
+        probe = np.argpartition(-centroid_scores, self.nprobe - 1)[:self.nprobe]
+        bounds = [(self.list_offsets[p], self.list_offsets[p + 1]) for p in probe]
+        rows = np.concatenate([np.arange(a, b) for a, b in bounds])
+        scores = np.concatenate([self._score_range(a, b, q) for a, b in bounds])
+        return rows, scores
+
+    def search(self, q: np.ndarray, top_k: int, row_slots: np.ndarray, allowed=None) -> list[tuple[int, float]]:
+        """
+        (slot, cosine) pairs for one unit-length query vector, with slots
+        from bind(), restricted to `allowed` (a filters.DocFilter) when given.
+        """
+        from sparse_index import top_k_from_arrays
+
+        # hnsw can't filter inside the graph walk, so over-fetch when filtered
+        rows, scores = self._candidates(q, top_k * (8 if allowed is not None else 1))
+        slots = row_slots[rows]
+        keep = slots >= 0
+        if allowed is not None:
+            keep[keep] = allowed.contains(slots[keep])
+        return top_k_from_arrays(slots[keep], scores[keep], top_k)
+
+
+class DenseRetriever:
+    """A DenseIndex plus the QueryEncoder that feeds it."""
+
+    def __init__(self, index: DenseIndex, encoder: QueryEncoder):
+        self.index = index
+        self.encoder = encoder
+
+    @classmethod
+    def open(cls, path: str) -> "DenseRetriever":
+        index = DenseIndex(path)
+        return cls(index, QueryEncoder(load_model(index.manifest["model"])))
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        return self.encoder.encode(texts)
+
+    def row_of(self, doc_id: str) -> int | None:
+        return self.index.row_of(doc_id)
+
+    def encodes(self, row: int, digest: int) -> bool:
+        return self.index.encodes(row, digest)
+
+    def bind(self, id_to_slot: dict[str, int], digest_of=None) -> np.ndarray:
+        return self.index.bind(id_to_slot, digest_of)
+
+    def search(self, q: np.ndarray, top_k: int, row_slots: np.ndarray, allowed=None) -> list[tuple[int, float]]:
+        return self.index.search(q, top_k, row_slots, allowed)
+
+    def stats(self) -> dict:
+        return {
+            "docs": len(self.index),
+            "model": self.index.manifest["model"],
+            "dtype": self.index.manifest["dtype"],
+            "encoder_batches": self.encoder.batches,
+            "encoded_queries": self.encoder.texts,
+        }
+
+    def close(self):
+        self.encoder.close()
+
+
+# ── offline build ─────────────────────────────────────────
+
+def _kmeans(x: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on a sample of unit vectors; returns unit centroids."""
+    rng = np.random.default_rng(seed)
+    sample = x[rng.choice(len(x), size=min(len(x), k * 256), replace=False)]
+    sample = np.asarray(sample, dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        norms = np.linalg.norm(sums, axis=1)
+        empty = norms == 0
+        sums[empty] = centroids[empty]  # keep empty clusters where they were
+        norms[empty] = 1.0
+        centroids = sums / norms[:, None]
+    return centroids
+
+
+def build_dense_index(source: str, out_path: str, dtype: str = "int8", ann: str = "ivf",
+                      nlist: int | None = None, batch_size: int = 256) -> dict:
+    from doc_sources import iter_documents
+    from index_store import doc_digest, publish, source_fingerprint, staging_dir
+    from retriever import HybridRetriever
+
+    model = load_model(DENSE_MODEL)
+    tmp = staging_dir(out_path)
+
+    # ── encode, in corpus order ───────────────────────────
+    doc_ids, digests, chunks = [], [], []
+    batch = []
+    for doc in iter_documents(source):
+        doc_ids.append(doc["id"])
+        digests.append(doc_digest(doc))
+        batch.append(HybridRetriever._doc_text(doc))
+        if len(batch) >= batch_size:
+            chunks.append(_encode(model, batch, batch_size).astype(np.float16))
+            batch = []
+            print(f"[dense] encoded {len(doc_ids)} docs")
+    if batch:
+        chunks.append(_encode(model, batch, batch_size).astype(np.float16))
+    vecs = np.concatenate(chunks) if chunks else np.zeros((0, 1), dtype=np.float16)
+    del chunks
+    n_docs, dim = vecs.shape
+
+    # ── IVF lists ─────────────────────────────────────────
+    if nlist is None:
+        nlist = 1 if n_docs < FLAT_BELOW else int(4 * np.sqrt(n_docs))
+    nlist = max(1, min(nlist, n_docs))
+    if nlist == 1:
+        centroids = np.zeros((1, dim), dtype=np.float32)
+        assign = np.zeros(n_docs, dtype=np.int64)
+    else:
+        centroids = _kmeans(vecs, nlist)
+        assign = np.concatenate([
+            np.argmax(np.asarray(vecs[i:i + 65536], dtype=np.float32) @ centroids.T, axis=1)
+            for i in range(0, n_docs, 65536)
+        ])
+    order = np.argsort(assign, kind="stable")
+    list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assign, minlength=nlist), out=list_offsets[1:])
+    vecs = vecs[order]
+
+    def put(name, a):
+        np.save(os.path.join(tmp, f"{name}.npy"), a)
+
+    put("doc_ids", np.array([doc_ids[i].encode() for i in order], dtype=bytes) if n_docs
+        else np.zeros(0, dtype="S1"))
+    put("doc_digests", np.array(digests, dtype=np.uint64)[order])
+    put("centroids", centroids)
+    put("list_offsets", list_offsets)
+    if dtype == "int8":
+        q, scales = _quantize_int8(vecs.astype(np.float32))
+        put("vectors", q)
+        put("scales", scales)
+    else:
+        put("vectors", vecs)
+
+    if ann == "hnsw":
+        import hnswlib
+        graph = hnswlib.Index(space="ip", dim=dim)
+        graph.init_index(max_elements=max(n_docs, 1), ef_construction=200, M=16)
+        graph.add_items(vecs.astype(np.float32), np.arange(n_docs))
+        graph.save_index(os.path.join(tmp, "hnsw.bin"))
+
+    return publish(tmp, out_path, {
+        "format_version": FORMAT_VERSION,
+        "source": source,
+        "source_fingerprint": source_fingerprint(source),
+        "model": DENSE_MODEL,
+        "dim": int(dim),
+        "dtype": dtype,
+        "ann": ann,
+        "nlist": int(nlist),
+        "n_docs": int(n_docs),
+    })
+
+
+def _cmd_build(args):
+    t0 = time.time()
+    manifest = build_dense_index(args.source, args.out, dtype=args.dtype, ann=args.ann,
+                                 nlist=args.nlist, batch_size=args.batch_size)
+    print(f"[dense] wrote {args.out}: {manifest['n_docs']} vectors, dim {manifest['dim']}, "
+          f"{manifest['dtype']}, {manifest['nlist']} lists ({time.time() - t0:.1f}s)")
+
+
+def main(argv=None):
+    from doc_sources import DOCUMENT_SOURCE
+
+    parser = argparse.ArgumentParser(description="Build the dense (embedding) index.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="encode a document source into a dense index")
+    build.add_argument("--out", default=os.getenv("DENSE_INDEX_DIR") or "data/dense")
+    build.add_argument("--source", default=DOCUMENT_SOURCE)
+    build.add_argument("--dtype", choices=DTYPES, default="int8")
+    build.add_argument("--ann", choices=ANN_KINDS, default="ivf")
+    build.add_argument("--nlist", type=int, default=None,
+                       help="IVF lists (default: 1 under 10k docs, else 4*sqrt(N))")
+    build.add_argument("--batch-size", type=int, default=256)
+    build.set_defaults(func=_cmd_build)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -0,0 +1,76 @@
+"""
+Pluggable document sources, read as generators.
+
+A source spec is either "builtin" (the genomic_db knowledge base) or a
+path to a JSONL, gzipped JSONL or Parquet file with one document per
+line/row. Every source yields plain dicts with the genomic_db fields
+(id, title, type, gene, content, references), so nothing downstream
+needs to hold the whole corpus in memory.
+"""
+
+import gzip
+import json
+import os
+from typing import Iterator
+
+DOCUMENT_SOURCE = os.getenv("DOCUMENT_SOURCE", "builtin")
+
+REQUIRED_FIELDS = ("id", "title", "type", "content")
+
+
+def _normalize(raw: dict, where: str) -> dict:
+    missing = [f for f in REQUIRED_FIELDS if not raw.get(f)]
+    if missing:
+        raise ValueError(f"{where}: missing field(s) {', '.join(missing)}")
+    refs = raw.get("references") or []
+    if isinstance(refs, str):
+        refs = [refs]
+    return {
+        "id": str(raw["id"]),
+        "title": raw["title"],
+        "type": raw["type"],
+        "gene": raw.get("gene") or "",
+        "content": raw["content"],
+        "references": list(refs),
+    }
+
+
+def iter_builtin() -> Iterator[dict]:
+    from genomic_db import get_all_documents
+    yield from get_all_documents()
+
+
+def iter_jsonl(path: str) -> Iterator[dict]:
+    """One JSON document per line; .gz files are decompressed on the fly."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if line:
+                yield _normalize(json.loads(line), f"{path}:{lineno}")
+
+
+def iter_parquet(path: str, batch_size: int = 10_000) -> Iterator[dict]:
+    """Row batches from a Parquet file. Needs the optional pyarrow package."""
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("reading Parquet sources requires pyarrow (pip install pyarrow)") from e
+
+    row = 0
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        for raw in batch.to_pylist():
+            row += 1
+            yield _normalize(raw, f"{path}:row {row}")
+
+
+def iter_documents(source: str | None = None) -> Iterator[dict]:
+    """Stream documents from a source spec (default DOCUMENT_SOURCE)."""
+    source = source or DOCUMENT_SOURCE
+    if source == "builtin":
+        return iter_builtin()
+    if source.endswith((".jsonl", ".jsonl.gz", ".ndjson", ".ndjson.gz")):
+        return iter_jsonl(source)
+    if source.endswith(".parquet"):
+        return iter_parquet(source)
+    raise ValueError(f"unsupported document source {source!r} (builtin, .jsonl[.gz] or .parquet)")
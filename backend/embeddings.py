@@ -1,10 +1,9 @@
+import heapq
 import math
-import re
 from collections import defaultdict
 
-
-def _tokenize(text: str) -> list[str]:
-    return re.findall(r"[a-z0-9]+", text.lower())
+from profiler import count_work
+from tokenizer import count_terms, tokenize
 
 
 class TfidfVectorizer:
@@ -13,50 +12,82 @@ class TfidfVectorizer:
     def __init__(self):
         self.vocab: dict[str, int] = {}  # token -> index
         self.idf: dict[str, float] = {}
-        self.doc_vectors: list[dict[str, float]] = []  # sparse vectors
+        # inverted index: token -> {doc_idx: weight}, the only copy of the
+        # doc vectors (a filtered query probes it per doc, like BM25's)
+        self.postings: dict[str, dict[int, float]] = {}
+        self.doc_freq: dict[str, int] = {}
+        self.n_docs = 0
+        # see fit_counts(reference=...)
+        self.reference = None
 
     def fit(self, texts: list[str]):
-
-        n_docs = len(texts)
-        doc_freq: dict[str, int] = defaultdict(int)
-        all_tokens_per_doc = []
-
-        for text in texts:
-            tokens = _tokenize(text)
-            all_tokens_per_doc.append(tokens)
-            unique_tokens = set(tokens)
-            for t in unique_tokens:
-                doc_freq[t] += 1
+        self.fit_counts([count_terms(tokenize(text)) for text in texts])
+
+    def fit_counts(
+        self,
+        doc_tfs: list[dict[str, int]],
+        doc_freq: dict[str, int] | None = None,
+        reference=None,
+    ):
+        """
+        Fit from per-document term counts (see parallel_build.py).
+        `doc_freq` may be passed in when it was already merged from shards.
+        With a `reference` TF-IDF scorer (a delta segment's base, see
+        segments.py), terms it knows keep its IDF, so doc and query
+        vectors are on the same scale as the reference's.
+        """
+        n_docs = len(doc_tfs)
+        self.reference = reference
+        if doc_freq is None:
+            doc_freq = defaultdict(int)
+            for tf in doc_tfs:
+                for t in tf:
+                    doc_freq[t] += 1
 
 
         all_tokens = sorted(doc_freq.keys())
         self.vocab = {t: i for i, t in enumerate(all_tokens)}
 
         # IDF: log(N / df) + 1  (smoothed)
+        n_total = n_docs + (reference.n_docs if reference is not None else 0)
         self.idf = {}
         for token, df in doc_freq.items():
-            self.idf[token] = math.log(n_docs / (df + 1)) + 1.0
-
-
-        self.doc_vectors = []
-        for tokens in all_tokens_per_doc:
-            tf: dict[str, float] = defaultdict(float)
-            for t in tokens:
-                tf[t] += 1.0
-            # normalize TF by doc length
-            length = len(tokens) or 1
-            vec = {}
-            for t, count in tf.items():
-                if t in self.idf:
-                    vec[t] = (count / length) * self.idf[t]
-            # L2 normalize
-            norm = math.sqrt(sum(v * v for v in vec.values())) or 1.0
-            vec = {t: v / norm for t, v in vec.items()}
-            self.doc_vectors.append(vec)
+            idf = reference.term_idf(token) if reference is not None else 0.0
+            self.idf[token] = idf or math.log(n_total / (df + 1)) + 1.0
+
+        self.doc_freq = dict(doc_freq)
+        self.n_docs = n_docs
+
+        postings: dict[str, dict[int, float]] = defaultdict(dict)
+        for doc_idx, tf in enumerate(doc_tfs):
+            for t, w in self._doc_vector(tf).items():
+                postings[t][doc_idx] = w
+        self.postings = dict(postings)
+
+    def _doc_vector(self, tf: dict[str, int]) -> dict[str, float]:
+        """L2-normalized TF-IDF vector for one document, using current IDF."""
+        # normalize TF by doc length
+        length = sum(tf.values()) or 1
+        vec = {}
+        for t, count in tf.items():
+            if t in self.idf:
+                vec[t] = (count / length) * self.idf[t]
+        # L2 normalize
+        norm = math.sqrt(sum(v * v for v in vec.values())) or 1.0
+        return {t: v / norm for t, v in vec.items()}
+
+    def term_idf(self, token: str) -> float:
+        """IDF of `token`, 0.0 if it's not in the corpus."""
+        return self.idf.get(token, 0.0)
 
     def query(self, text: str, top_k: int = 10) -> list[tuple[int, float]]:
+        return self.query_tokens(tokenize(text), top_k=top_k)
 
-        tokens = _tokenize(text)
+    def query_tokens(self, tokens: list[str], top_k: int = 10, allowed=None) -> list[tuple[int, float]]:
+        """
+        Same as query(), for callers that already tokenized the text.
+        `allowed` (a filters.DocFilter) restricts scoring to those docs.
+        """
         tf: dict[str, float] = defaultdict(float)
         for t in tokens:
             tf[t] += 1.0
@@ -65,18 +96,45 @@ class TfidfVectorizer:
 
         q_vec = {}
         for t, count in tf.items():
-            if t in self.idf:
-                q_vec[t] = (count / length) * self.idf[t]
+            idf = self.idf.get(t)
+            if idf is None and self.reference is not None:
+                # no postings here, but the reference's query vector has it:
+                # keep it in the norm so cosines match the reference's
+                idf = self.reference.term_idf(t) or None
+            if idf is not None:
+                q_vec[t] = (count / length) * idf
         # L2 normalize
         norm = math.sqrt(sum(v * v for v in q_vec.values())) or 1.0
         q_vec = {t: v / norm for t, v in q_vec.items()}
 
 
-        scores = []
-        for idx, doc_vec in enumerate(self.doc_vectors):
-            sim = sum(q_vec.get(t, 0) * doc_vec.get(t, 0) for t in q_vec)
-            if sim > 0:
-                scores.append((idx, sim))
-
-        scores.sort(key=lambda x: x[1], reverse=True)
-        return scores[:top_k]
+        # only docs sharing at least one term with the query get a score
+        scores: dict[int, float] = defaultdict(float)
+        walked = sum(len(self.postings.get(t, ())) for t in q_vec)
+        if allowed is None:
+            for t, q_w in q_vec.items():
+                for doc_idx, d_w in self.postings.get(t, {}).items():
+                    scores[doc_idx] += q_w * d_w
+        elif len(allowed) < walked:
+            # small filter: probe each allowed doc in the query terms' postings
+            terms = [(self.postings[t], q_w) for t, q_w in q_vec.items() if t in self.postings]
+            walked = len(allowed) * len(terms)  # probes
+            for doc_idx in allowed.id_list():
+                for postings, q_w in terms:
+                    d_w = postings.get(doc_idx)
+                    if d_w:
+                        scores[doc_idx] += q_w * d_w
+        else:
+            keep = allowed.id_set()
+            for t, q_w in q_vec.items():
+                for doc_idx, d_w in self.postings.get(t, {}).items():
+                    if doc_idx in keep:
+                        scores[doc_idx] += q_w * d_w
+        count_work(walked, len(scores))
+
+        # ties break towards the lower doc index, same as a stable full sort
+        return heapq.nlargest(
+            top_k,
+            ((idx, sim) for idx, sim in scores.items() if sim > 0),
+            key=lambda x: (x[1], -x[0]),
+        )
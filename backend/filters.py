@@ -0,0 +1,172 @@
+"""
+Metadata filters (gene, type) for hybrid search.
+
+FilterIndex keeps one sorted doc-id container per (field, value), like
+a postings list for metadata. A filter such as
+
+    {"gene": ["BRCA1", "BRCA2"], "type": "clinical"}
+
+is OR-ed within a field and AND-ed across fields into a DocFilter, which
+the scorers apply *before* scoring: postings of docs outside it are
+skipped, and a filter smaller than the query's postings is probed doc by
+doc instead of walking the postings at all. Matching is
+case-insensitive. Resolved filters are cached, so the common case of
+the same few genes over and over costs one dict lookup.
+
+Containers are append-only `array("i")` buffers (doc indexes only grow,
+so they stay sorted at 4 bytes per doc). An index opened from disk has
+them precomputed by index_builder.py instead (index_store.MmapFilterIndex). Deleted docs stay in them; the
+retriever drops tombstones after scoring as it does for unfiltered
+searches.
+
+numpy is imported inside the methods that use it: main.py imports
+normalize_filters() at startup, and the dict engine runs without numpy.
+"""
+
+import threading
+from array import array
+from collections import OrderedDict
+
+FILTER_FIELDS = ("gene", "type")
+FILTER_CACHE_SIZE = 256
+
+
+def filter_value(doc: dict, field: str) -> str:
+    """The value `doc` is matched on for `field` ("" = none)."""
+    return str(doc.get(field) or "").strip().lower()
+
+
+def normalize_filters(filters: dict | None) -> tuple | None:
+    """
+    Canonical, hashable form of a filter spec: ((field, (values...)), ...),
+    or None for "no filter". Raises ValueError on unknown fields.
+    """
+    if not filters:
+        return None
+    out = []
+    for field in sorted(filters):
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"unknown filter field {field!r}, expected one of {FILTER_FIELDS}")
+        values = filters[field]
+        if values is None:
+            continue
+        if isinstance(values, str):
+            values = [values]
+        values = tuple(sorted({str(v).strip().lower() for v in values if str(v).strip()}))
+        if values:
+            out.append((field, values))
+    return tuple(out) or None
+
+
+class DocFilter:
+    """Sorted doc indexes a filtered search may return."""
+
+    # above this fraction of the corpus, membership tests use a dense
+    # bool bitmap instead of binary search over the ids
+    DENSE_RATIO = 1 / 32
+
+    def __init__(self, ids, n_docs: int):
+        self.ids = ids  # sorted int32 numpy array
+        self.n_docs = n_docs
+        self._mask = None
+        self._list: list[int] | None = None
+        self._set: set[int] | None = None
+        # the same filter over passage rows, see passages.PassageMap.expand
+        self.expanded: "DocFilter | None" = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def id_list(self) -> list[int]:
+        if self._list is None:
+            self._list = self.ids.tolist()
+        return self._list
+
+    def id_set(self) -> set[int]:
+        if self._set is None:
+            self._set = set(self.id_list())
+        return self._set
+
+    def positions(self, doc_ids):
+        """Indexes into a sorted postings array of the docs in this filter."""
+        import numpy as np
+
+        if len(self.ids) < len(doc_ids):
+            # few allowed docs: binary-search each one in the postings
+            pos = np.searchsorted(doc_ids, self.ids)
+            ok = pos < len(doc_ids)
+            pos = pos[ok]
+            return pos[doc_ids[pos] == self.ids[ok]]
+        return np.flatnonzero(self.contains(doc_ids))
+
+    def contains(self, doc_ids):
+        """Bool mask: which of `doc_ids` (any order) pass the filter."""
+        import numpy as np
+
+        if len(self.ids) > self.n_docs * self.DENSE_RATIO:
+            if self._mask is None:
+                mask = np.zeros(self.n_docs, dtype=bool)
+                mask[self.ids] = True
+                self._mask = mask
+            return self._mask[doc_ids]
+        if not len(self.ids):
+            return np.zeros(len(doc_ids), dtype=bool)
+        pos = np.searchsorted(self.ids, doc_ids)
+        pos[pos == len(self.ids)] = 0
+        return self.ids[pos] == doc_ids
+
+
+class FilterIndex:
+    """(field, value) -> sorted doc indexes, for FILTER_FIELDS."""
+
+    def __init__(self, documents):
+        self.n_docs = 0
+        self.values: dict[str, dict[str, array]] = {f: {} for f in FILTER_FIELDS}
+        self._cache: OrderedDict[tuple, DocFilter] = OrderedDict()
+        self._lock = threading.Lock()  # searches share the cache without the retriever's lock
+        self.add(0, documents)
+
+    def add(self, start: int, documents):
+        """Index documents appended at doc index `start` onwards (None = deleted)."""
+        self._cache.clear()
+        for idx, doc in enumerate(documents, start):
+            if doc is None:
+                continue
+            for field in FILTER_FIELDS:
+                value = filter_value(doc, field)
+                if value:
+                    self.values[field].setdefault(value, array("i")).append(idx)
+        self.n_docs = max(self.n_docs, start + len(documents))
+
+    def _ids(self, field: str, value: str):
+        import numpy as np
+
+        ids = self.values[field].get(value)
+        # a copy: a numpy view would pin the buffer and block later appends
+        return np.array(ids if ids is not None else (), dtype=np.int32)
+
+    def select(self, key: tuple) -> DocFilter:
+        """DocFilter for a normalize_filters() key."""
+        import numpy as np
+
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit is not None:
+                self._cache.move_to_end(key)
+                return hit
+
+        per_field = []
+        for field, values in key:
+            parts = [self._ids(field, v) for v in values]
+            per_field.append(parts[0] if len(parts) == 1 else np.unique(np.concatenate(parts)))
+        # smallest field first keeps the intersections cheap
+        ids = None
+        for field_ids in sorted(per_field, key=len):
+            ids = field_ids if ids is None else np.intersect1d(ids, field_ids, assume_unique=True)
+
+        doc_filter = DocFilter(ids, self.n_docs)
+        with self._lock:
+            self._cache[key] = doc_filter
+            while len(self._cache) > FILTER_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return doc_filter
@@ -402,9 +402,11 @@ def get_all_documents():
     return GENOMIC_KNOWLEDGE_BASE
 
 
+# id -> position in GENOMIC_KNOWLEDGE_BASE
+_ID_INDEX = {doc["id"]: i for i, doc in enumerate(GENOMIC_KNOWLEDGE_BASE)}
+
+
 def get_document_by_id(doc_id: str):
     """Fetch a single document by its ID."""
-    for doc in GENOMIC_KNOWLEDGE_BASE:
-        if doc["id"] == doc_id:
-            return doc
-    return None
+    i = _ID_INDEX.get(doc_id)
+    return GENOMIC_KNOWLEDGE_BASE[i] if i is not None else None
@@ -1,18 +1,41 @@
 
 
+import asyncio
 import json
 import os
-from typing import Generator
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import AsyncGenerator, Generator
 
 import httpx
 
+import metrics
+from context_packer import pack_context
+from limiter import upstream_limiter
+
 # ── config ─────────────────────────────────────────────────
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
 GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
 GROQ_TEMPERATURE = float(os.getenv("GROQ_TEMPERATURE", "0.3"))
 GROQ_MAX_TOKENS = int(os.getenv("GROQ_MAX_TOKENS", "2048"))
-GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+
+# upstream connection pool (shared client, see open_client())
+GROQ_MAX_CONNECTIONS = int(os.getenv("GROQ_MAX_CONNECTIONS", "100"))
+GROQ_MAX_KEEPALIVE = int(os.getenv("GROQ_MAX_KEEPALIVE", "20"))
+GROQ_KEEPALIVE_EXPIRY = float(os.getenv("GROQ_KEEPALIVE_EXPIRY", "30"))
+GROQ_HTTP2 = os.getenv("GROQ_HTTP2", "false").lower() in ("1", "true", "yes")
+GROQ_CONNECT_TIMEOUT = float(os.getenv("GROQ_CONNECT_TIMEOUT", "5"))
+GROQ_READ_TIMEOUT = float(os.getenv("GROQ_READ_TIMEOUT", "60"))
+
+# retries before the first token, after a 429/5xx or a connection error
+GROQ_MAX_RETRIES = int(os.getenv("GROQ_MAX_RETRIES", "3"))
+GROQ_BACKOFF_BASE = float(os.getenv("GROQ_BACKOFF_BASE", "0.5"))  # seconds
+GROQ_BACKOFF_MAX = float(os.getenv("GROQ_BACKOFF_MAX", "8"))      # longest wait before a retry
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)  # upstream asking us to slow down
 
 # ── system prompt ──────────────────────────────────────────
 
@@ -39,26 +62,24 @@ When answering questions:
 """
 
 
-def _format_context(documents: list[dict]) -> str:
-    """Format retrieved documents into a context block for the LLM."""
-    if not documents:
-        return "No relevant documents were retrieved."
-
-    parts = []
-    for doc in documents:
-        refs = "; ".join(doc.get("references", []))
-        parts.append(
-            f"--- [{doc['id']}] {doc['title']} ---\n"
-            f"Type: {doc['type']} | Gene: {doc.get('gene', 'N/A')}\n"
-            f"{doc['content']}\n"
-            f"References: {refs}\n"
-        )
-    return "\n".join(parts)
+def _format_context(
+    documents: list[dict], query: str = "", term_weights: dict[str, float] | None = None
+) -> str:
+    """
+    Format retrieved documents into a context block for the LLM, packed
+    to CONTEXT_TOKEN_BUDGET around the passages that best match `query`.
+    """
+    t0 = time.perf_counter()
+    context = pack_context(query, documents, term_weights)
+    metrics.CONTEXT_SECONDS.observe(time.perf_counter() - t0)
+    return context
 
 
-def _build_messages(query: str, context_docs: list[dict]) -> list[dict]:
+def _build_messages(
+    query: str, context_docs: list[dict], term_weights: dict[str, float] | None = None
+) -> list[dict]:
     """Assemble the chat messages array for the Groq API."""
-    context_block = _format_context(context_docs)
+    context_block = _format_context(context_docs, query, term_weights)
 
     return [
         {"role": "system", "content": GENOMICS_SYSTEM_PROMPT},
@@ -74,15 +95,104 @@ def _build_messages(query: str, context_docs: list[dict]) -> list[dict]:
     ]
 
 
+# ── shared upstream client ─────────────────────────────────
+
+_client: httpx.AsyncClient | None = None
+
+
+def _timeout() -> httpx.Timeout:
+    # read timeout is per chunk, so long streams are fine as long as
+    # tokens keep arriving
+    return httpx.Timeout(GROQ_READ_TIMEOUT, connect=GROQ_CONNECT_TIMEOUT)
+
+
+def open_client() -> httpx.AsyncClient:
+    """
+    Create the process-wide pooled client. Called from the FastAPI
+    lifespan so every query reuses warm keep-alive connections instead
+    of paying for a TCP + TLS handshake.
+    """
+    global _client
+    if _client is not None:
+        return _client
+
+    limits = httpx.Limits(
+        max_connections=GROQ_MAX_CONNECTIONS,
+        max_keepalive_connections=GROQ_MAX_KEEPALIVE,
+        keepalive_expiry=GROQ_KEEPALIVE_EXPIRY,
+    )
+    try:
+        _client = httpx.AsyncClient(timeout=_timeout(), limits=limits, http2=GROQ_HTTP2)
+    except ImportError:
+        # http2=True needs the optional `h2` package (pip install httpx[http2])
+        print("[groq_client] GROQ_HTTP2 set but h2 is not installed, using HTTP/1.1")
+        _client = httpx.AsyncClient(timeout=_timeout(), limits=limits)
+    return _client
+
+
+async def close_client():
+    """Close the shared client, called on app shutdown."""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
+
+
 # ── streaming completion (raw httpx, no SDK) ───────────────
 
+_DONE = object()  # sentinel for the upstream "[DONE]" line
+
+
+def _request_payload(
+    query: str, context_docs: list[dict], term_weights: dict[str, float] | None = None
+) -> dict:
+    return {
+        "model": GROQ_MODEL,
+        "messages": _build_messages(query, context_docs, term_weights),
+        "temperature": GROQ_TEMPERATURE,
+        "max_tokens": GROQ_MAX_TOKENS,
+        "stream": True,
+    }
+
+
+def _request_headers() -> dict:
+    return {
+        "Authorization": f"Bearer {GROQ_API_KEY}",
+        "Content-Type": "application/json",
+    }
+
+
+def _parse_sse_line(line: str):
+    """
+    Parse one line of the Groq SSE stream.
+    Returns the content delta, _DONE at end of stream, or None to skip.
+    """
+    if not line or not line.startswith("data: "):
+        return None
+
+    data_str = line[6:]  # strip "data: "
+
+    if data_str.strip() == "[DONE]":
+        return _DONE
+
+    try:
+        chunk = json.loads(data_str)
+        delta = chunk["choices"][0].get("delta", {})
+        return delta.get("content", "") or None
+    except (json.JSONDecodeError, KeyError, IndexError):
+        # malformed chunk, skip
+        return None
+
+
 def stream_genomic_answer(
     query: str,
     context_docs: list[dict],
+    term_weights: dict[str, float] | None = None,
 ) -> Generator[str, None, None]:
     """
     Send query + context to Groq's OpenAI-compatible endpoint
-    and yield response tokens as they arrive.
+    and yield response tokens as they arrive. `term_weights` (query
+    token -> IDF, see HybridRetriever.term_weights) guides context packing.
 
     Uses httpx directly to avoid the groq SDK's proxies= bug
     with httpx>=0.28.
@@ -91,28 +201,13 @@ def stream_genomic_answer(
         yield "[ERROR] GROQ_API_KEY not configured. Set it in .env.\n"
         return
 
-    messages = _build_messages(query, context_docs)
-
-    payload = {
-        "model": GROQ_MODEL,
-        "messages": messages,
-        "temperature": GROQ_TEMPERATURE,
-        "max_tokens": GROQ_MAX_TOKENS,
-        "stream": True,
-    }
-
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
     # use httpx streaming — works with any httpx version
-    with httpx.Client(timeout=60.0) as client:
+    with httpx.Client(timeout=_timeout()) as client:
         with client.stream(
             "POST",
             GROQ_API_URL,
-            json=payload,
-            headers=headers,
+            json=_request_payload(query, context_docs, term_weights),
+            headers=_request_headers(),
         ) as response:
             if response.status_code != 200:
                 # read full error body
@@ -123,26 +218,142 @@ def stream_genomic_answer(
 
             # parse SSE lines from the Groq response stream
             for line in response.iter_lines():
-                if not line or not line.startswith("data: "):
-                    continue
+                token = _parse_sse_line(line)
+                if token is _DONE:
+                    break
+                if token:
+                    yield token
 
-                data_str = line[6:]  # strip "data: "
 
-                if data_str.strip() == "[DONE]":
-                    break
+async def astream_genomic_answer(
+    query: str,
+    context_docs: list[dict],
+    term_weights: dict[str, float] | None = None,
+) -> AsyncGenerator[str, None]:
+    """
+    Async twin of stream_genomic_answer(). Runs on the event loop via
+    httpx.AsyncClient, so an open stream doesn't hold a threadpool slot.
+    Uses the shared pooled client when open_client() has been called,
+    otherwise a one-off client.
+    """
+    if not GROQ_API_KEY:
+        yield "[ERROR] GROQ_API_KEY not configured. Set it in .env.\n"
+        return
+
+    if _client is not None:
+        async for token in _astream(_client, query, context_docs, term_weights):
+            yield token
+    else:
+        async with httpx.AsyncClient(timeout=_timeout()) as client:
+            async for token in _astream(client, query, context_docs, term_weights):
+                yield token
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    """Seconds from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_delay(attempt: int, retry_after: str | None = None) -> float | None:
+    """
+    Seconds to wait before retry number `attempt` + 1, or None to give up.
+    Honors upstream's Retry-After (plus a little jitter so waiting clients
+    don't return in lockstep). Without one, full-jitter exponential backoff.
+    """
+    if attempt >= GROQ_MAX_RETRIES:
+        return None
+    delay = _parse_retry_after(retry_after)
+    if delay is not None:
+        if delay > GROQ_BACKOFF_MAX:
+            return None  # not worth holding the client that long
+        return delay + random.uniform(0, GROQ_BACKOFF_BASE)
+    return random.uniform(0, min(GROQ_BACKOFF_MAX, GROQ_BACKOFF_BASE * 2 ** attempt))
+
+
+async def _astream(
+    client: httpx.AsyncClient,
+    query: str,
+    context_docs: list[dict],
+    term_weights: dict[str, float] | None = None,
+) -> AsyncGenerator[str, None]:
+    """
+    Stream one completion over `client`, yielding content deltas. Each
+    attempt holds an upstream_limiter slot for its whole stream (raises
+    limiter.UpstreamBusy if none frees up in time). Throttled, 5xx and
+    failed-to-connect requests are retried with backoff until the first
+    token arrives.
+    """
+    payload = _request_payload(query, context_docs, term_weights)
+    for attempt in range(GROQ_MAX_RETRIES + 1):
+        # a slot per attempt, so backing off doesn't keep one from others
+        async with upstream_limiter.slot() as outcome:
+            t_start = time.perf_counter()
+            t_first = None
+            n_tokens = 0
+            try:
+                async with client.stream(
+                    "POST", GROQ_API_URL, json=payload, headers=_request_headers()
+                ) as response:
+                    if response.status_code != 200:
+                        await response.aread()
+                        if response.status_code in THROTTLE_STATUSES:
+                            upstream_limiter.on_throttled()
+                        delay = None
+                        if response.status_code in RETRY_STATUSES:
+                            delay = _retry_delay(attempt, response.headers.get("retry-after"))
+                        if delay is None:
+                            metrics.UPSTREAM_ERRORS["status"].inc()
+                            yield f"[ERROR] Groq API returned {response.status_code}: {response.text}\n"
+                            return
+                    else:
+                        done = False
+                        async for line in response.aiter_lines():
+                            # keep reading to EOF after [DONE]: a fully consumed response
+                            # goes back to the pool, an abandoned one closes the connection
+                            if done:
+                                continue
+                            token = _parse_sse_line(line)
+                            if token is _DONE:
+                                done = True
+                            elif token:
+                                if t_first is None:
+                                    t_first = time.perf_counter()
+                                    metrics.UPSTREAM_TTFT_SECONDS.observe(t_first - t_start)
+                                n_tokens += 1
+                                yield token
+
+                        outcome["ok"] = True
+                        t_end = time.perf_counter()
+                        metrics.UPSTREAM_STREAM_SECONDS.observe(t_end - t_start)
+                        if n_tokens > 1 and t_end > t_first:
+                            # generation rate, excluding the wait for the first token
+                            metrics.UPSTREAM_TOKENS_PER_SECOND.observe((n_tokens - 1) / (t_end - t_first))
+                        return
+            except httpx.HTTPError as e:
+                # only retry if nothing reached the caller yet
+                delay = None
+                if isinstance(e, httpx.TransportError) and not n_tokens:
+                    delay = _retry_delay(attempt)
+                if delay is None:
+                    metrics.UPSTREAM_ERRORS["transport"].inc()
+                    raise
 
-                try:
-                    chunk = json.loads(data_str)
-                    delta = chunk["choices"][0].get("delta", {})
-                    content = delta.get("content", "")
-                    if content:
-                        yield content
-                except (json.JSONDecodeError, KeyError, IndexError):
-                    # malformed chunk, skip
-                    continue
+        metrics.UPSTREAM_RETRIES.inc()
+        await asyncio.sleep(delay)
 
 
-def get_genomic_answer(query: str, context_docs: list[dict]) -> str:
+def get_genomic_answer(
+    query: str, context_docs: list[dict], term_weights: dict[str, float] | None = None
+) -> str:
     """Non-streaming version. Useful for testing."""
-    parts = list(stream_genomic_answer(query, context_docs))
+    parts = list(stream_genomic_answer(query, context_docs, term_weights))
     return "".join(parts)
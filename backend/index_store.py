@@ -0,0 +1,333 @@
+"""
+On-disk retrieval index, opened with mmap at startup.
+
+Layout of an index directory:
+
+    manifest.json        format version, source + fingerprint, corpus
+                         hash, tokenizer, passage window, sizes, BM25 params
+    vocab.npy            sorted fixed-width utf-8 tokens (term id = row)
+    tfidf_idf.npy        float64[V]
+    bm25_idf.npy         float64[V]
+    indptr.npy           int32[V + 1]   postings offsets per term
+    postings.npy         int32[nnz]     passage rows, sorted within each term
+                                        (both int64 past 2**31 postings)
+    tfidf_weights.npy    float32[nnz]
+    bm25_weights.npy     float32[nnz]
+    doc_lens.npy         int32[P]       tokens per passage
+    docs.jsonl           one JSON document per line
+    doc_offsets.npy      int64[N + 1]   byte offsets into docs.jsonl
+    doc_ids.npy          sorted fixed-width utf-8 doc ids
+    doc_id_slots.npy     int32[N]       doc slot of each sorted id
+    doc_digests.npy      uint64[N]      doc_digest() of each doc (dense.py)
+    filter_<field>_values.npy  sorted fixed-width utf-8 values of a
+                                        filters.FILTER_FIELDS field
+    filter_<field>_indptr.npy  int64[values + 1]  offsets into _docs
+    filter_<field>_docs.npy    int32      sorted doc slots per value
+    row_doc.npy          int32[P]       passage (postings row) -> doc
+    row_start.npy        int32[P]       passage span in the doc's content
+    row_end.npy          int32[P]
+    doc_rows.npy         int64[N + 1]   doc -> first passage row
+
+Postings are per passage (see passages.py); a doc shorter than one
+passage window is a single row.
+
+TF-IDF and BM25 share the same sparsity pattern (both are built from
+the same tokens), so the postings are stored once with two weight
+arrays. Everything is loaded with np.load(mmap_mode="r"), so workers
+on the same host share the page cache instead of each holding a copy.
+
+Build with (streaming, postings written straight to disk, see index_builder.py):
+
+    python index_store.py build --out data/index [--source corpus.jsonl.gz]
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+
+from filters import FILTER_FIELDS, FilterIndex
+
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+
+
+def new_corpus_hasher():
+    return hashlib.sha256(f"gciqs-index-v{FORMAT_VERSION}\n".encode())
+
+
+def hash_document(h, doc: dict):
+    h.update(json.dumps(doc, sort_keys=True, ensure_ascii=False).encode())
+    h.update(b"\n")
+
+
+def doc_digest(doc: dict) -> int:
+    """64-bit content hash of one document, see dense.DenseIndex.bind()."""
+    h = hashlib.sha256()
+    hash_document(h, doc)
+    return int.from_bytes(h.digest()[:8], "little")
+
+
+def corpus_hash(documents) -> str:
+    """Content hash of the source corpus, used to detect a stale index."""
+    h = new_corpus_hasher()
+    for doc in documents:
+        hash_document(h, doc)
+    return h.hexdigest()
+
+
+# ── read side ─────────────────────────────────────────────
+
+class MmapVocab:
+    """
+    token -> term id lookup over a sorted, memory-mapped token array.
+    Behaves like the read-only subset of dict the scorers use.
+    """
+
+    def __init__(self, tokens: np.ndarray):
+        self.tokens = tokens
+
+    def get(self, token: str, default=None):
+        key = token.encode()
+        if len(key) > self.tokens.dtype.itemsize:
+            return default
+        i = int(np.searchsorted(self.tokens, key))
+        if i < len(self.tokens) and self.tokens[i] == key:
+            return i
+        return default
+
+    def __contains__(self, token: str) -> bool:
+        return self.get(token) is not None
+
+    def __getitem__(self, token: str) -> int:
+        i = self.get(token)
+        if i is None:
+            raise KeyError(token)
+        return i
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+
+class MmapIdIndex(MmapVocab):
+    """
+    doc id -> doc slot over sorted, memory-mapped ids, so worker processes
+    share it instead of each building a dict. Read-only; the retriever
+    copies it into a dict on its first write.
+    """
+
+    def __init__(self, ids: np.ndarray, slots: np.ndarray):
+        super().__init__(ids)
+        self.slots = slots
+
+    def get(self, doc_id: str, default=None):
+        i = super().get(doc_id)
+        return int(self.slots[i]) if i is not None else default
+
+    def items(self):
+        for doc_id, slot in zip(self.tokens, self.slots):
+            yield doc_id.decode(), int(slot)
+
+
+class MmapFilterIndex(FilterIndex):
+    """
+    FilterIndex over the doc slot lists index_builder precomputes per
+    (field, value), so opening an index parses no documents and a
+    filter's ids are slices of the shared, memory-mapped arrays.
+    """
+
+    def __init__(self, n_docs: int, fields: dict[str, tuple]):
+        super().__init__(())
+        self.n_docs = n_docs
+        self.fields = fields  # field -> (MmapVocab of values, indptr, doc slots)
+
+    def _ids(self, field: str, value: str):
+        values, indptr, docs = self.fields[field]
+        i = values.get(value)
+        if i is None:
+            return np.zeros(0, dtype=np.int32)
+        return docs[indptr[i]:indptr[i + 1]]
+
+
+class DocStore:
+    """Read-only list of documents backed by a memory-mapped JSONL file."""
+
+    def __init__(self, path: str, offsets: np.ndarray):
+        self.offsets = offsets
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> dict:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        return json.loads(self._mmap[start:end])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def read_manifest(path: str) -> dict | None:
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def load_index(path: str) -> dict:
+    """
+    Open an index directory. Returns the manifest plus memory-mapped
+    arrays and the CSR matrices built on top of them (no copies).
+    """
+    manifest = read_manifest(path)
+    if manifest is None:
+        raise FileNotFoundError(f"no index manifest in {path}")
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(
+            f"index format {manifest.get('format_version')} in {path}, expected {FORMAT_VERSION}"
+        )
+
+    def arr(name):
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+    # postings are per passage; indexes from before passages.py have one per doc
+    n_terms, n_rows = manifest["n_terms"], manifest.get("n_passages", manifest["n_docs"])
+    indptr, postings = arr("indptr"), arr("postings")
+    shape = (n_terms, n_rows)
+
+    return {
+        "manifest": manifest,
+        "vocab": MmapVocab(arr("vocab")),
+        "tfidf_idf": arr("tfidf_idf"),
+        "bm25_idf": arr("bm25_idf"),
+        "tfidf_matrix": sparse.csr_matrix((arr("tfidf_weights"), postings, indptr), shape=shape, copy=False),
+        "bm25_matrix": sparse.csr_matrix((arr("bm25_weights"), postings, indptr), shape=shape, copy=False),
+        "doc_lens": arr("doc_lens"),
+        "documents": DocStore(os.path.join(path, "docs.jsonl"), arr("doc_offsets")),
+        "id_index": (MmapIdIndex(arr("doc_ids"), arr("doc_id_slots"))
+                     if os.path.exists(os.path.join(path, "doc_ids.npy")) else None),
+        "passages": _passage_map(path, manifest, arr),
+        "filters": _filter_index(path, manifest, arr),
+        "digests": arr("doc_digests") if os.path.exists(os.path.join(path, "doc_digests.npy")) else None,
+    }
+
+
+def _filter_index(path: str, manifest: dict, arr) -> MmapFilterIndex | None:
+    if not all(os.path.exists(os.path.join(path, f"filter_{f}_docs.npy")) for f in FILTER_FIELDS):
+        return None  # built before the filter lists: Segment indexes the docs on first use
+    return MmapFilterIndex(manifest["n_docs"], {
+        f: (MmapVocab(arr(f"filter_{f}_values")), arr(f"filter_{f}_indptr"), arr(f"filter_{f}_docs"))
+        for f in FILTER_FIELDS
+    })
+
+
+def _passage_map(path: str, manifest: dict, arr):
+    from passages import PassageMap
+
+    if "n_passages" not in manifest:
+        # built before passages: one row per doc
+        rows = np.arange(manifest["n_docs"], dtype=np.int32)
+        return PassageMap(rows, rows * 0, rows * 0, np.arange(manifest["n_docs"] + 1))
+    return PassageMap(arr("row_doc"), arr("row_start"), arr("row_end"), arr("doc_rows"))
+
+
+# ── write side (see index_builder.py) ─────────────────────
+
+def index_dtype(nnz: int):
+    # scipy wants indptr and indices in one dtype; a mismatch would make
+    # it copy the memory-mapped arrays on load
+    return np.int32 if nnz < 2**31 else np.int64
+
+
+def vocab_array(tokens: list[str]) -> np.ndarray:
+    """Sorted tokens as a fixed-width bytes array, searchable by MmapVocab."""
+    if not tokens:
+        return np.zeros(0, dtype="S1")
+    return np.array([t.encode() for t in tokens], dtype=bytes)
+
+
+def staging_dir(path: str) -> str:
+    """Fresh scratch directory next to `path`; see publish()."""
+    tmp = f"{path.rstrip(os.sep)}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    return tmp
+
+
+def publish(tmp: str, path: str, manifest: dict):
+    """
+    Write the manifest last and rename the staged directory into place,
+    so readers never see a half-written index.
+    """
+    manifest = {"format_version": FORMAT_VERSION, **manifest, "created": time.time()}
+    with open(os.path.join(tmp, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    old = f"{path.rstrip(os.sep)}.old-{os.getpid()}"
+    if os.path.exists(path):
+        os.replace(path, old)
+    os.replace(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    return manifest
+
+
+def source_fingerprint(source: str) -> str:
+    """
+    Cheap identity of a document source for the staleness check: the
+    content hash for the builtin corpus, size + mtime for files (hashing
+    a multi-GB dump on every startup would defeat the point).
+    """
+    if source == "builtin":
+        from genomic_db import get_all_documents
+        return corpus_hash(get_all_documents())
+    st = os.stat(source)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+# ── build command ─────────────────────────────────────────
+
+def _cmd_build(args):
+    from index_builder import build_index_streaming
+
+    t0 = time.time()
+    manifest = build_index_streaming(args.source, args.out, chunk_size=args.chunk_size)
+    print(
+        f"[index_store] wrote {args.out}: {manifest['n_docs']} docs, "
+        f"{manifest['n_terms']} terms, {manifest['nnz']} postings ({time.time() - t0:.2f}s)"
+    )
+
+
+def main(argv=None):
+    from doc_sources import DOCUMENT_SOURCE
+
+    parser = argparse.ArgumentParser(description="Build the on-disk retrieval index.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="build the index from a document source")
+    build.add_argument("--out", default=os.getenv("INDEX_DIR") or "data/index")
+    build.add_argument("--source", default=DOCUMENT_SOURCE,
+                       help="builtin, or a .jsonl / .jsonl.gz / .parquet file")
+    build.add_argument("--chunk-size", type=int, default=50_000,
+                       help="documents per chunk in the postings pass")
+    build.set_defaults(func=_cmd_build)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
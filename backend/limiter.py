@@ -0,0 +1,166 @@
+"""
+Adaptive (AIMD) concurrency limit for upstream LLM streams.
+
+At most `limit` streams are open at once. Each stream that completes
+successfully raises the limit by 1 / limit, which is about +1 per round
+of `limit` streams; errors (5xx, dropped connections) and abandoned
+streams leave it as is. A 429 or 503 from upstream halves it, at most
+once per second, since one burst of rejections is a single signal. Like
+TCP congestion control, the limit settles just under the provider's
+rate limit instead of slamming into it.
+
+Callers over the limit wait in a FIFO queue of at most QUEUE_SIZE, for
+at most QUEUE_TIMEOUT seconds. A caller that finds the queue full, or
+that times out, gets UpstreamBusy with a Retry-After estimate. /query
+turns a full queue into 503 + Retry-After once it knows the answer needs
+an upstream call (not cached, not joining a running flight), so a spike
+is shed before the stream opens instead of every stream failing with 429.
+
+    UPSTREAM_LIMIT_INITIAL=16  UPSTREAM_LIMIT_MIN=1  UPSTREAM_LIMIT_MAX=GROQ_MAX_CONNECTIONS
+    UPSTREAM_QUEUE_SIZE=64     UPSTREAM_QUEUE_TIMEOUT=10
+
+Everything runs on the event loop thread, so no locks are needed.
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+UPSTREAM_LIMIT_INITIAL = float(os.getenv("UPSTREAM_LIMIT_INITIAL", "16"))
+UPSTREAM_LIMIT_MIN = float(os.getenv("UPSTREAM_LIMIT_MIN", "1"))
+UPSTREAM_LIMIT_MAX = float(os.getenv("UPSTREAM_LIMIT_MAX", os.getenv("GROQ_MAX_CONNECTIONS", "100")))
+UPSTREAM_QUEUE_SIZE = int(os.getenv("UPSTREAM_QUEUE_SIZE", "64"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "10"))
+
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN = 1.0   # seconds between multiplicative decreases
+HOLD_EWMA_ALPHA = 0.2     # smoothing of the stream duration estimate
+MAX_RETRY_AFTER = 60      # seconds
+
+
+class UpstreamBusy(Exception):
+    """No upstream slot: the wait queue is full or the wait timed out."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(f"{message}, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AIMDLimiter:
+    def __init__(
+        self,
+        initial: float = UPSTREAM_LIMIT_INITIAL,
+        minimum: float = UPSTREAM_LIMIT_MIN,
+        maximum: float = UPSTREAM_LIMIT_MAX,
+        queue_size: int = UPSTREAM_QUEUE_SIZE,
+        queue_timeout: float = UPSTREAM_QUEUE_TIMEOUT,
+    ):
+        self.minimum = max(minimum, 1.0)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._last_decrease = 0.0
+        self._hold = 1.0  # EWMA of seconds a slot is held
+        # counters for /health and /metrics
+        self.rejected = 0
+        self.timed_out = 0
+        self.throttled = 0
+
+    def queue_full(self) -> bool:
+        return len(self._waiters) >= self.queue_size and self.in_flight >= int(self.limit)
+
+    def retry_after(self) -> int:
+        """Seconds until the queue ahead has likely drained."""
+        rounds = (len(self._waiters) + 1) / max(int(self.limit), 1)
+        return min(max(math.ceil(rounds * self._hold), 1), MAX_RETRY_AFTER)
+
+    def shed(self) -> int:
+        """Count a request turned away before queueing; returns its Retry-After."""
+        self.rejected += 1
+        return self.retry_after()
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            raise UpstreamBusy("upstream queue is full", self.shed())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._waiters.remove(waiter)
+                self.timed_out += 1
+                raise UpstreamBusy("timed out waiting for an upstream slot", self.retry_after())
+            # granted as the timeout fired: keep the slot
+        except asyncio.CancelledError:
+            if waiter.done():
+                self._release()  # granted, but the caller is gone
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self, held: float, ok: bool = False):
+        """
+        Give back a slot held for `held` seconds. Only a stream that
+        completed (`ok`) raises the limit; throttled ones already lowered
+        it in on_throttled().
+        """
+        self._hold += HOLD_EWMA_ALPHA * (held - self._hold)
+        if ok:
+            self.limit = min(self.limit + 1.0 / self.limit, self.maximum)
+        self._release()
+
+    def on_throttled(self):
+        """Upstream answered 429/503: back off now, not when the slot is released."""
+        self.throttled += 1
+        now = time.monotonic()
+        if now - self._last_decrease >= DECREASE_COOLDOWN:
+            self._last_decrease = now
+            self.limit = max(self.limit * DECREASE_FACTOR, self.minimum)
+
+    def _release(self):
+        self.in_flight -= 1
+        # hand freed slots to waiters in arrival order
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Hold one upstream slot for the body of the `async with`. The body
+        sets `outcome["ok"] = True` once the stream completed; anything
+        else (throttled, 5xx, transport error, cancelled) counts as not ok.
+        """
+        await self.acquire()
+        outcome = {"ok": False}
+        t0 = time.monotonic()
+        try:
+            yield outcome
+        finally:
+            self.release(time.monotonic() - t0, outcome["ok"])
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "throttled": self.throttled,
+        }
+
+
+upstream_limiter = AIMDLimiter()
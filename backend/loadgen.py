@@ -0,0 +1,252 @@
+"""
+End-to-end load generator for the /query SSE endpoint.
+
+Keeps `--concurrency` streaming /query requests open for `--duration`
+seconds and reports requests/s, answer tokens/s, time to first answer
+token and full-stream latency (p50/p95/p99), plus errors by kind.
+Queries are drawn from `--distinct` synthetic queries (bench.synth_queries),
+so the answer cache and request coalescing see a realistic repeat rate;
+--no-cache turns both off in a spawned backend.
+
+Without --url, a stub LLM (an OpenAI-compatible streaming endpoint that
+emits `--stub-tokens` tokens, `--stub-delay-ms` apart) and a backend
+pointed at it are started on free local ports and stopped afterwards,
+so the numbers measure this service rather than the LLM provider.
+
+    python loadgen.py --concurrency 32 --duration 30 [--source corpus.jsonl] [--out result.json]
+    python loadgen.py --url http://127.0.0.1:8000    # an already running backend
+    python loadgen.py stub --port 9911               # just the stub LLM
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench import _latency_stats, synth_queries
+
+
+# ── stub LLM ──────────────────────────────────────────────
+
+def stub_app(tokens: int = 50, delay_ms: float = 10):
+    """FastAPI app streaming `tokens` chat-completion chunks per request."""
+    from fastapi import FastAPI
+    from fastapi.responses import StreamingResponse
+
+    app = FastAPI()
+    app.state.calls = 0
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions():
+        app.state.calls += 1
+
+        async def chunks():
+            for i in range(tokens):
+                await asyncio.sleep(delay_ms / 1000)
+                yield "data: " + json.dumps({"choices": [{"delta": {"content": f" tok{i}"}}]}) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    @app.get("/calls")
+    async def calls():
+        return {"calls": app.state.calls}
+
+    return app
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(url: str, proc: subprocess.Popen, timeout: float = 600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {proc.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
+
+
+def _spawn(args) -> tuple[str, list[subprocess.Popen]]:
+    """Start the stub LLM and a backend using it; returns (backend url, procs)."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    stub_port, api_port = _free_port(), _free_port()
+    stub = subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), "stub", "--port", str(stub_port),
+        "--tokens", str(args.stub_tokens), "--delay-ms", str(args.stub_delay_ms),
+    ])
+    procs = [stub]
+    _wait_ready(f"http://127.0.0.1:{stub_port}/calls", stub)
+
+    env = {
+        **os.environ,
+        "GROQ_API_URL": f"http://127.0.0.1:{stub_port}/v1/chat/completions",
+        "GROQ_API_KEY": "loadgen",
+    }
+    if args.source:
+        env["DOCUMENT_SOURCE"] = os.path.abspath(args.source)
+    if args.no_cache:
+        env.update(ANSWER_CACHE_SIZE="0", RETRIEVAL_CACHE_SIZE="0", SINGLE_FLIGHT="false")
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(api_port), "--log-level", "warning"],
+        cwd=here, env=env,
+    )
+    procs.append(backend)
+    url = f"http://127.0.0.1:{api_port}"
+    _wait_ready(f"{url}/health", backend)
+    return url, procs
+
+
+# ── load ──────────────────────────────────────────────────
+
+class _Stats:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.ttfts: list[float] = []
+        self.tokens = 0
+        self.errors: dict[str, int] = {}
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def _one_query(client: httpx.AsyncClient, url: str, query: str, stats: _Stats):
+    t0 = time.perf_counter()
+    ttft = None
+    tokens = 0
+    try:
+        async with client.stream("POST", f"{url}/query", json={"query": query}) as resp:
+            if resp.status_code != 200:
+                await resp.aread()
+                stats.error(f"http_{resp.status_code}")
+                return
+            async for line in resp.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[6:])
+                if event["type"] == "token":
+                    if event["data"].startswith("[ERROR]"):
+                        # upstream failures arrive as answer text
+                        stats.error("upstream_error")
+                        return
+                    if ttft is None:
+                        ttft = time.perf_counter() - t0
+                    tokens += 1
+                elif event["type"] == "error":
+                    stats.error("sse_error")
+                    return
+    except httpx.HTTPError as e:
+        stats.error(type(e).__name__)
+        return
+    stats.latencies.append(time.perf_counter() - t0)
+    if ttft is not None:
+        stats.ttfts.append(ttft)
+    stats.tokens += tokens
+
+
+async def run_load(url: str, queries: list[str], concurrency: int, duration: float, seed: int = 0) -> dict:
+    stats = _Stats()
+    rng = random.Random(seed)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    timeout = httpx.Timeout(60, connect=5)
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                await _one_query(client, url, rng.choice(queries), stats)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    done = len(stats.latencies)
+    return {
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 2),
+        "distinct_queries": len(set(queries)),
+        "requests": done,
+        "errors": stats.errors,
+        "requests_per_s": round(done / elapsed, 1),
+        "tokens_per_s": round(stats.tokens / elapsed, 1),
+        # requests overlap, so throughput is requests_per_s, not 1 / latency
+        "latency": _latency_stats(stats.latencies, qps=False) if stats.latencies else None,
+        "ttft": _latency_stats(stats.ttfts, qps=False) if stats.ttfts else None,
+    }
+
+
+# ── commands ──────────────────────────────────────────────
+
+def _cmd_stub(args):
+    import uvicorn
+    uvicorn.run(stub_app(args.tokens, args.delay_ms), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def _cmd_load(args):
+    procs = []
+    try:
+        url = args.url
+        if url is None:
+            url, procs = _spawn(args)
+            print(f"[loadgen] backend {url} with stub LLM "
+                  f"({args.stub_tokens} tokens, {args.stub_delay_ms} ms apart)")
+        queries = synth_queries(args.distinct, seed=args.seed)
+        print(f"[loadgen] {args.concurrency} concurrent streams for {args.duration:.0f}s ...")
+        result = asyncio.run(run_load(url, queries, args.concurrency, args.duration, args.seed))
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            proc.wait()
+
+    result["stub_llm"] = None if args.url else {"tokens": args.stub_tokens, "delay_ms": args.stub_delay_ms}
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["stub"]:
+        parser = argparse.ArgumentParser(description="Stub OpenAI-compatible streaming LLM.")
+        parser.add_argument("--port", type=int, default=9911)
+        parser.add_argument("--tokens", type=int, default=50)
+        parser.add_argument("--delay-ms", type=float, default=10)
+        _cmd_stub(parser.parse_args(argv[1:]))
+        return
+
+    parser = argparse.ArgumentParser(description="Drive /query and measure SSE throughput.")
+    parser.add_argument("--url", default=None, help="running backend (default: spawn one with a stub LLM)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--distinct", type=int, default=200, help="distinct queries to draw from")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--source", default=None, help="DOCUMENT_SOURCE for a spawned backend")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="spawned backend without answer/retrieval caches or coalescing")
+    parser.add_argument("--stub-tokens", type=int, default=50)
+    parser.add_argument("--stub-delay-ms", type=float, default=10)
+    parser.add_argument("--out", default=None)
+    _cmd_load(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
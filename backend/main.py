@@ -1,35 +1,94 @@
 
 
+import asyncio
+import functools
+import hashlib
+import hmac
 import json
 import os
+import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 
 # so that `from retriever import ...` works regardless of cwd
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+# load .env before the imports below read their config from os.environ
+load_dotenv()
+
+import metrics
+from filters import FILTER_FIELDS, normalize_filters
+from limiter import upstream_limiter
+from passages import with_passages
+from profiler import PROFILE_HEADER, query_profiler
 from retriever import retriever
-from groq_client import stream_genomic_answer
+from answer_cache import ANSWER_CACHE_PURGE_INTERVAL, answer_cache, cache_key
+from groq_client import (
+    GROQ_MODEL,
+    GROQ_TEMPERATURE,
+    astream_genomic_answer,
+    close_client,
+    open_client,
+)
+from singleflight import SingleFlight
+from tokenizer import tokenize
 
-load_dotenv()
+# retrieval is CPU-bound; run it on a small dedicated pool so it neither
+# blocks the event loop nor competes with Starlette's default threadpool
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "4"))
+
+# coalesce identical concurrent /query requests (see singleflight.py)
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "true").lower() in ("1", "true", "yes")
+query_flights = SingleFlight("query")
+
+# guards /admin/*, on-demand profiling (see profiler.py) and document
+# writes; unset, all three are off
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# POST/DELETE /documents; serve.py turns them off when several workers
+# share one read-only index, since a write would reach only one of them
+INDEX_WRITES = os.getenv("INDEX_WRITES", "true").lower() in ("1", "true", "yes")
 
 
 # ── app lifecycle ──────────────────────────────────────────
 
+async def _purge_answer_cache():
+    """Drop expired answers every ANSWER_CACHE_PURGE_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(ANSWER_CACHE_PURGE_INTERVAL)
+        answer_cache.purge()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # startup: build retrieval indexes
-    print("[main] building indexes on startup ...")
-    retriever.build_index()
+    # startup: open the prebuilt index if there is one, else build
+    print("[main] loading indexes on startup ...")
+    retriever.load_or_build()
+    app.state.retrieval_pool = ThreadPoolExecutor(
+        max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval"
+    )
+    # one pooled keep-alive client for every upstream LLM call
+    open_client()
+    purge = None
+    if answer_cache.enabled and ANSWER_CACHE_PURGE_INTERVAL > 0:
+        purge = asyncio.create_task(_purge_answer_cache())
     print("[main] ready.")
     yield
+    await close_client()
+    if purge is not None:
+        purge.cancel()
+    await asyncio.to_thread(answer_cache.close)  # waits for queued SQLite writes
+    if retriever.dense is not None:
+        retriever.dense.close()
+    app.state.retrieval_pool.shutdown(wait=False, cancel_futures=True)
 
 
 app = FastAPI(
@@ -55,12 +114,143 @@ async def health():
     return {
         "status": "ok",
         "index_size": retriever.index_size,
+        "retrieval_cache": retriever.cache.stats(),
+        "dense": retriever.dense.stats() if retriever.dense is not None else None,
+        "answer_cache": answer_cache.stats(),
+        "single_flight": query_flights.stats(),
+        "profiler": query_profiler.stats(),
+        "upstream_limiter": upstream_limiter.stats(),
         "timestamp": time.time(),
     }
 
 
+# ── metrics ────────────────────────────────────────────────
+
+def _collect():
+    """Scrape-time samples for counts the caches and flights already keep."""
+    for name, cache in (("retrieval", retriever.cache), ("answer", answer_cache)):
+        for result, count in (("hit", cache.hits), ("miss", cache.misses)):
+            yield ("gciqs_cache_lookups", "counter", "Cache lookups by cache and result.",
+                   {"cache": name, "result": result}, count)
+    flights = query_flights.stats()
+    yield ("gciqs_query_flights_in_flight", "gauge", "Coalesced /query flights running.",
+           {}, flights["in_flight"])
+    yield ("gciqs_query_flights_joined", "counter", "/query requests that joined a running flight.",
+           {}, flights["joined"])
+    yield ("gciqs_index_documents", "gauge", "Documents in the index.", {}, retriever.index_size)
+    limiter = upstream_limiter.stats()
+    yield ("gciqs_upstream_limit", "gauge", "Adaptive upstream concurrency limit.", {}, limiter["limit"])
+    yield ("gciqs_upstream_in_flight", "gauge", "Open upstream LLM streams.", {}, limiter["in_flight"])
+    yield ("gciqs_upstream_queued", "gauge", "Requests waiting for an upstream slot.", {}, limiter["queued"])
+    yield ("gciqs_upstream_shed", "counter", "Requests refused an upstream slot.",
+           {"reason": "queue_full"}, limiter["rejected"])
+    yield ("gciqs_upstream_shed", "counter", "Requests refused an upstream slot.",
+           {"reason": "timeout"}, limiter["timed_out"])
+    yield ("gciqs_upstream_throttled", "counter", "Upstream 429/503 responses.", {}, limiter["throttled"])
+
+
+metrics.register_collector(_collect)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition; 404 when METRICS_ENABLED is false."""
+    if not metrics.METRICS_ENABLED:
+        return JSONResponse(status_code=404, content={"error": "metrics are disabled"})
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # ── query endpoint (SSE) ──────────────────────────────────
 
+def _parse_filters(body: dict) -> dict | None:
+    """
+    Optional metadata filters from a request body: "gene" and/or "type",
+    each a string or a list of strings. Raises ValueError if malformed.
+    """
+    filters = {}
+    for field in FILTER_FIELDS:
+        value = body.get(field)
+        if value in (None, "", []):
+            continue
+        if isinstance(value, str):
+            value = [value]
+        if not isinstance(value, list) or not all(isinstance(v, str) and v.strip() for v in value):
+            raise ValueError(f"{field} must be a string or a list of strings")
+        filters[field] = value
+    return filters or None
+
+
+def _llm_context(query: str, hits: list) -> tuple[list[dict], dict[str, float]]:
+    """
+    The matched passages of each hit's document (the whole doc when it's a
+    single passage), plus query term weights for the context packer.
+    """
+    docs = {d["id"]: d for d in retriever.get_documents([hit.id for hit in hits])}
+    context = [with_passages(docs[hit.id], hit.passages) for hit in hits if hit.id in docs]
+    return context, retriever.term_weights(query)
+
+
+async def _answer_events(
+    pool, user_query: str, top_k: int, filters: dict | None, profile: str | None = None
+):
+    """
+    (type, data) SSE events for one query: references, then answer tokens.
+    With `profile` (a profiler reason), retrieval runs under the profiler.
+    A lone ("busy", None) event means the answer needs an upstream call
+    and the upstream queue is full; query_endpoint turns it into a 503.
+    """
+    # step 1: hybrid retrieval, off the event loop
+    loop = asyncio.get_running_loop()
+    if profile:
+        search = functools.partial(
+            query_profiler.search, retriever, user_query, top_k, filters, profile
+        )
+    else:
+        search = functools.partial(retriever.search, user_query, top_k, filters=filters)
+    try:
+        hits = await loop.run_in_executor(pool, search)
+    except Exception as e:
+        yield "error", str(e)
+        return
+
+    # step 2: the answer, replayed from cache or streamed from the LLM.
+    # The key covers the context itself, so it's fetched even for cache
+    # hits: a replaced document must not replay an answer about its old text
+    try:
+        context_docs, term_weights = await loop.run_in_executor(
+            pool, _llm_context, user_query, hits
+        )
+    except Exception as e:
+        yield "error", str(e)
+        return
+    key = cache_key(user_query, context_docs, GROQ_MODEL, GROQ_TEMPERATURE)
+    cached = await answer_cache.get(key)
+    if cached is None and upstream_limiter.queue_full():
+        # shed here, not at the door: cached and coalesced answers never
+        # take an upstream slot, so they're served even under overload
+        yield "busy", None
+        return
+
+    # first, emit the retrieved references so the frontend can show them
+    yield "references", [hit.as_dict() for hit in hits]
+
+    if cached is not None:
+        for token in cached:
+            yield "token", token
+        return
+
+    tokens = []
+    try:
+        async for token in astream_genomic_answer(user_query, context_docs, term_weights):
+            tokens.append(token)
+            yield "token", token
+        # only complete, error-free answers are worth replaying
+        if tokens and not any(t.startswith("[ERROR]") for t in tokens):
+            answer_cache.put(key, tokens)
+    except Exception as e:
+        yield "error", str(e)
+
+
 @app.post("/query")
 async def query_endpoint(request: Request):
     body = await request.json()
@@ -73,32 +263,43 @@ async def query_endpoint(request: Request):
         )
 
     top_k = min(int(body.get("top_k", 5)), 10)
+    try:
+        filters = _parse_filters(body)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    pool = request.app.state.retrieval_pool
+    requested = request.headers.get(PROFILE_HEADER, "").lower() in ("1", "true", "yes")
+    profile = query_profiler.reason(requested and _is_admin(request))
+    if profile:
+        # a profiled request runs its own retrieval, never a shared one
+        events = _answer_events(pool, user_query, top_k, filters, profile)
+    elif SINGLE_FLIGHT:
+        # identical concurrent queries share one retrieval + LLM stream
+        flight_key = (" ".join(tokenize(user_query)), top_k, normalize_filters(filters))
+        events = query_flights.stream(
+            flight_key, lambda: _answer_events(pool, user_query, top_k, filters)
+        )
+    else:
+        events = _answer_events(pool, user_query, top_k, filters)
 
-    # step 1: hybrid retrieval
-    retrieved_docs = retriever.search(user_query, top_k=top_k)
-
-    # step 2: stream LLM response as SSE
-    def event_stream():
-        # first, emit the retrieved references so the frontend can show them
-        refs_payload = []
-        for doc in retrieved_docs:
-            refs_payload.append({
-                "id": doc["id"],
-                "title": doc["title"],
-                "type": doc["type"],
-                "gene": doc.get("gene", ""),
-                "score": doc.get("score", 0),
-                "references": doc.get("references", []),
-            })
-        yield f"data: {json.dumps({'type': 'references', 'data': refs_payload})}\n\n"
-
-        # then stream the LLM answer token by token
-        try:
-            for token in stream_genomic_answer(user_query, retrieved_docs):
-                yield f"data: {json.dumps({'type': 'token', 'data': token})}\n\n"
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'data': str(e)})}\n\n"
+    # the first event decides the status: 503 if the answer can't get an
+    # upstream slot, else a 200 stream starting with that event
+    first = await anext(events, None)
+    if first is not None and first[0] == "busy":
+        await events.aclose()
+        return JSONResponse(
+            status_code=503,
+            content={"error": "server busy, retry later"},
+            headers={"Retry-After": str(upstream_limiter.shed())},
+        )
 
+    async def event_stream():
+        if first is not None:
+            kind, data = first
+            yield f"data: {json.dumps({'type': kind, 'data': data})}\n\n"
+        async for kind, data in events:
+            yield f"data: {json.dumps({'type': kind, 'data': data})}\n\n"
         # signal completion
         yield f"data: {json.dumps({'type': 'done'})}\n\n"
 
@@ -113,6 +314,202 @@ async def query_endpoint(request: Request):
     )
 
 
+# ── admin ──────────────────────────────────────────────────
+
+def _is_admin(request: Request) -> bool:
+    # closed by default: with no token configured nobody is admin
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN)
+
+
+@app.get("/admin/profiles")
+async def list_profiles(request: Request):
+    """The slowest profiled queries, slowest first (see profiler.py)."""
+    if not _is_admin(request):
+        return JSONResponse(status_code=403, content={"error": "admin token required"})
+    return {**query_profiler.stats(), "traces": query_profiler.slowest()}
+
+
+@app.delete("/admin/profiles")
+async def clear_profiles(request: Request):
+    if not _is_admin(request):
+        return JSONResponse(status_code=403, content={"error": "admin token required"})
+    query_profiler.clear()
+    return {"cleared": True}
+
+
+# ── batch retrieval (JSON, no LLM) ─────────────────────────
+
+MAX_BATCH_QUERIES = int(os.getenv("MAX_BATCH_QUERIES", "1000"))
+
+
+@app.post("/search/batch")
+async def search_batch_endpoint(request: Request):
+    """
+    Retrieval-only search for many queries at once, for evaluation and
+    cache pre-warm jobs. Returns the same reference objects /query emits.
+    """
+    body = await request.json()
+    queries = body.get("queries")
+    if (
+        not isinstance(queries, list)
+        or not queries
+        or not all(isinstance(q, str) and q.strip() for q in queries)
+    ):
+        return JSONResponse(
+            status_code=400,
+            content={"error": "queries must be a non-empty list of strings"},
+        )
+    if len(queries) > MAX_BATCH_QUERIES:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"at most {MAX_BATCH_QUERIES} queries per batch"},
+        )
+
+    top_k = min(int(body.get("top_k", 5)), 10)
+    try:
+        filters = _parse_filters(body)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    loop = asyncio.get_running_loop()
+    batches = await loop.run_in_executor(
+        request.app.state.retrieval_pool,
+        functools.partial(retriever.search_many, [q.strip() for q in queries], top_k, filters=filters),
+    )
+    return {
+        "results": [
+            {"query": q, "documents": [hit.as_dict() for hit in hits]}
+            for q, hits in zip(queries, batches)
+        ]
+    }
+
+
+# ── document ingestion ─────────────────────────────────────
+
+REQUIRED_DOC_FIELDS = ("id", "title", "type", "content")
+# ids end up in URLs, HTML and the write log: letters, digits and . _ : -
+DOC_ID_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9._:-]{0,127}")
+
+
+def _refuse_write(request: Request) -> JSONResponse | None:
+    """The error response for a write this process mustn't take, or None."""
+    if not _is_admin(request):
+        return JSONResponse(status_code=403, content={"error": "admin token required"})
+    if not INDEX_WRITES:
+        return JSONResponse(status_code=409, content={
+            "error": "document writes are disabled: several workers share a read-only index, "
+                     "or the write log would be on tmpfs; rebuild the index (serve.py --rebuild), "
+                     "or run a single worker with INDEX_WRITE_LOG on disk",
+        })
+    return None
+
+
+def _validate_documents(docs) -> str | None:
+    """Return an error message, or None if every document is well-formed."""
+    if not isinstance(docs, list) or not docs:
+        return "documents must be a non-empty list"
+    seen = set()
+    for doc in docs:
+        if not isinstance(doc, dict):
+            return "each document must be an object"
+        for field in REQUIRED_DOC_FIELDS:
+            if not isinstance(doc.get(field), str) or not doc[field].strip():
+                return f"document field {field!r} is required"
+        if not DOC_ID_PATTERN.fullmatch(doc["id"]):
+            return f"invalid document id {doc['id']!r}"
+        if not isinstance(doc.get("gene", ""), str):
+            return "document field 'gene' must be a string"
+        refs = doc.get("references", [])
+        if not isinstance(refs, list) or not all(isinstance(ref, str) for ref in refs):
+            return "document field 'references' must be a list of strings"
+        if doc["id"] in seen:
+            return f"duplicate document id {doc['id']!r}"
+        seen.add(doc["id"])
+    return None
+
+
+@app.post("/documents")
+async def add_documents_endpoint(request: Request):
+    """Add or replace documents in the live index (no restart needed). Admin only."""
+    refused = _refuse_write(request)
+    if refused is not None:
+        return refused
+    body = await request.json()
+    docs = body.get("documents")
+    error = _validate_documents(docs)
+    if error:
+        return JSONResponse(status_code=400, content={"error": error})
+
+    docs = [
+        {
+            "id": d["id"],
+            "title": d["title"],
+            "type": d["type"],
+            "gene": d.get("gene", ""),
+            "content": d["content"],
+            "references": d.get("references", []),
+        }
+        for d in docs
+    ]
+    loop = asyncio.get_running_loop()
+    added = await loop.run_in_executor(
+        request.app.state.retrieval_pool, retriever.add_documents, docs
+    )
+    return {"added": added, "index_size": retriever.index_size}
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+@app.get("/documents/{doc_id}")
+async def get_document_endpoint(doc_id: str, request: Request):
+    """
+    Full stored document, fetched by the frontend when a citation is
+    expanded. Served with an ETag so repeat views revalidate with a 304.
+    """
+    loop = asyncio.get_running_loop()
+    doc = await loop.run_in_executor(
+        request.app.state.retrieval_pool, retriever.get_document, doc_id
+    )
+    if doc is None:
+        return JSONResponse(status_code=404, content={"error": f"no document {doc_id!r}"})
+
+    body = json.dumps(doc, ensure_ascii=False, sort_keys=True).encode()
+    etag = _etag(body)
+    # docs can be replaced via POST /documents, so always revalidate
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.delete("/documents/{doc_id}")
+async def delete_document_endpoint(doc_id: str, request: Request):
+    """Delete a document from the live index. Admin only."""
+    refused = _refuse_write(request)
+    if refused is not None:
+        return refused
+    if not DOC_ID_PATTERN.fullmatch(doc_id):
+        return JSONResponse(status_code=400, content={"error": f"invalid document id {doc_id!r}"})
+    loop = asyncio.get_running_loop()
+    deleted = await loop.run_in_executor(
+        request.app.state.retrieval_pool, retriever.delete_documents, [doc_id]
+    )
+    if not deleted:
+        return JSONResponse(status_code=404, content={"error": f"no document {doc_id!r}"})
+    return {"deleted": deleted, "index_size": retriever.index_size}
+
+
 # ── run directly for local development ─────────────────────
 
 if __name__ == "__main__":
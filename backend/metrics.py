@@ -0,0 +1,189 @@
+"""
+Hot-path latency histograms and counters, rendered in the Prometheus
+text format by GET /metrics.
+
+    METRICS_ENABLED=true   (false: every observe()/inc() is a no-op)
+
+Instrumented code times a stage with two perf_counter() calls and one
+observe():
+
+    t0 = time.perf_counter()
+    ...
+    metrics.TFIDF_SECONDS.observe(time.perf_counter() - t0)
+
+Counts that already live elsewhere (cache hits and misses, in-flight
+requests) aren't duplicated on the hot path; register_collector() reads
+them when /metrics is scraped.
+
+Values are per process. Under serve.py each worker keeps its own, and a
+scrape reaches whichever worker accepts it.
+"""
+
+import os
+import threading
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# seconds; retrieval stages are sub-millisecond on small corpora, LLM
+# streams take seconds
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+RATE_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000)  # tokens per second
+
+
+def _labels(labels: dict[str, str], extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels.items()]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt(value: float) -> str:
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+class Histogram:
+    """Cumulative-bucket histogram; observe() is thread-safe."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS, labels: dict | None = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = 'le="%s"' % _fmt(bound)
+            yield f"{self.name}_bucket{_labels(self.labels, le)} {cumulative}"
+        yield f"{self.name}_sum{_labels(self.labels)} {_fmt(total)}"
+        yield f"{self.name}_count{_labels(self.labels)} {cumulative}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: dict | None = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n: float = 1):
+        with self._lock:
+            self._value += n
+
+    def samples(self) -> Iterable[str]:
+        yield f"{self.name}_total{_labels(self.labels)} {_fmt(self._value)}"
+
+
+class _Noop:
+    """Stands in for every metric when METRICS_ENABLED is false."""
+
+    def observe(self, value: float):
+        pass
+
+    def inc(self, n: float = 1):
+        pass
+
+
+_metrics: list = []
+_collectors: list[Callable[[], Iterable[tuple[str, str, str, dict, float]]]] = []
+
+
+def histogram(name: str, help: str, buckets=LATENCY_BUCKETS, **labels) -> Histogram:
+    if not METRICS_ENABLED:
+        return _Noop()
+    metric = Histogram(name, help, buckets, labels)
+    _metrics.append(metric)
+    return metric
+
+
+def counter(name: str, help: str, **labels) -> Counter:
+    if not METRICS_ENABLED:
+        return _Noop()
+    metric = Counter(name, help, labels)
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(fn: Callable[[], Iterable[tuple[str, str, str, dict, float]]]):
+    """
+    `fn()` yields (name, type, help, labels, value) samples at scrape
+    time, for values another module already keeps.
+    """
+    if METRICS_ENABLED:
+        _collectors.append(fn)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format (0.0.4)."""
+    lines: list[str] = []
+    seen: set[str] = set()
+
+    def header(name: str, kind: str, help: str):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for metric in _metrics:
+        header(metric.name, metric.kind, metric.help)
+        lines.extend(metric.samples())
+    for fn in _collectors:
+        for name, kind, help, labels, value in fn():
+            header(name, kind, help)
+            sample = f"{name}_total" if kind == "counter" else name
+            lines.append(f"{sample}{_labels(labels)} {_fmt(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# ── hot-path metrics ──────────────────────────────────────
+
+_STAGE = "gciqs_stage_seconds"
+_STAGE_HELP = "Time spent in one stage of a query."
+
+TOKENIZE_SECONDS = histogram(_STAGE, _STAGE_HELP, stage="tokenize")
+TFIDF_SECONDS = histogram(_STAGE, _STAGE_HELP, stage="tfidf")
+BM25_SECONDS = histogram(_STAGE, _STAGE_HELP, stage="bm25")
+DENSE_SECONDS = histogram(_STAGE, _STAGE_HELP, stage="dense")
+FUSION_SECONDS = histogram(_STAGE, _STAGE_HELP, stage="rrf_fusion")
+CONTEXT_SECONDS = histogram(_STAGE, _STAGE_HELP, stage="context_format")
+SEARCH_SECONDS = histogram(_STAGE, _STAGE_HELP, stage="search")
+
+UPSTREAM_TTFT_SECONDS = histogram(
+    "gciqs_upstream_ttft_seconds", "Time from sending the LLM request to its first token."
+)
+UPSTREAM_STREAM_SECONDS = histogram(
+    "gciqs_upstream_stream_seconds", "Total duration of an upstream LLM stream."
+)
+UPSTREAM_TOKENS_PER_SECOND = histogram(
+    "gciqs_upstream_tokens_per_second", "Token rate of a completed upstream LLM stream.",
+    buckets=RATE_BUCKETS,
+)
+UPSTREAM_RETRIES = counter(
+    "gciqs_upstream_retries", "Upstream LLM requests retried after a 429/5xx or connection error."
+)
+UPSTREAM_ERRORS = {
+    kind: counter("gciqs_upstream_errors", "Failed upstream LLM requests.", kind=kind)
+    for kind in ("status", "transport")
+}
@@ -0,0 +1,120 @@
+"""
+Corpus counting for index builds, optionally sharded across processes.
+
+Tokenizing and counting terms is the bulk of a build and is independent
+per document, so the corpus is split into contiguous shards, a few per
+worker. Shards keep document order, so whatever is built from the
+merged result is identical to a serial build.
+
+    count_postings()  for the array engines (csr): each worker returns
+                      its shard's postings as arrays (term, doc, count
+                      triples over a shard-local vocabulary). The parent
+                      only remaps term ids and concatenates, so little
+                      serial work is left after the workers finish.
+    count_corpus()    for the dict and compact engines, which are built
+                      from per-document term-count dicts: each worker
+                      returns its dicts plus a partial DF table.
+
+Workers are started with the "spawn" method, not fork: builds also run
+on the background merge thread (segments.py), and a child forked from a
+threaded process can deadlock on a lock another thread held.
+"""
+
+import multiprocessing
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from tokenizer import count_terms, tokenize
+
+BUILD_WORKERS = int(os.getenv("BUILD_WORKERS", "0")) or os.cpu_count() or 1
+# below this, process startup and pickling cost more than they save
+PARALLEL_MIN_DOCS = int(os.getenv("PARALLEL_MIN_DOCS", "5000"))
+
+
+def _map_shards(fn, texts: list[str], workers: int | None) -> list:
+    """fn() of each contiguous shard of `texts`, in order."""
+    workers = workers or BUILD_WORKERS
+    if workers <= 1 or len(texts) < PARALLEL_MIN_DOCS:
+        return [fn(texts)]
+
+    # a few shards per worker evens out skew between long and short docs
+    n_shards = workers * 4
+    size = -(-len(texts) // n_shards)
+    shards = [texts[i:i + size] for i in range(0, len(texts), size)]
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        return list(pool.map(fn, shards))
+
+
+# ── per-doc counts (dict and compact engines) ─────────────
+
+def _count_shard(texts: list[str]) -> tuple[list[dict[str, int]], dict[str, int]]:
+    doc_tfs = [count_terms(tokenize(text)) for text in texts]
+    df: dict[str, int] = {}
+    for tf in doc_tfs:
+        for t in tf:
+            df[t] = df.get(t, 0) + 1
+    return doc_tfs, df
+
+
+def count_corpus(
+    texts: list[str], workers: int | None = None
+) -> tuple[list[dict[str, int]], dict[str, int]]:
+    """
+    Per-document term counts and the corpus DF table.
+    Uses `workers` processes (default BUILD_WORKERS) for large corpora.
+    """
+    doc_tfs: list[dict[str, int]] = []
+    df: dict[str, int] = {}
+    for shard_tfs, shard_df in _map_shards(_count_shard, texts, workers):
+        doc_tfs.extend(shard_tfs)
+        for t, n in shard_df.items():
+            df[t] = df.get(t, 0) + n
+    return doc_tfs, df
+
+
+# ── postings arrays (csr engine) ──────────────────────────
+
+def _shard_postings(texts: list[str]):
+    """(sorted shard vocab, term ids, doc ids, counts, doc lengths), shard-local."""
+    doc_tfs = [count_terms(tokenize(text)) for text in texts]
+    tokens = sorted({t for tf in doc_tfs for t in tf})
+    local = {t: i for i, t in enumerate(tokens)}
+    terms, docs, counts = array("i"), array("i"), array("i")
+    for doc_idx, tf in enumerate(doc_tfs):
+        for t, c in tf.items():  # first-appearance order, as the serial build
+            terms.append(local[t])
+            docs.append(doc_idx)
+            counts.append(c)
+    doc_lens = array("i", (sum(tf.values()) for tf in doc_tfs))
+    return tokens, terms, docs, counts, doc_lens
+
+
+def count_postings(texts: list[str], workers: int | None = None):
+    """
+    (vocab, term ids, doc ids, counts, doc lengths) of the corpus: one
+    (term, doc, count) triple per distinct term of each doc, in doc
+    order, with vocab the sorted token -> term id map. What
+    sparse_index's fit_postings() / from_postings() take.
+    """
+    import numpy as np
+
+    shards = _map_shards(_shard_postings, texts, workers)
+    vocab = {t: i for i, t in enumerate(sorted(set().union(*(shard[0] for shard in shards))))}
+    terms, docs, counts, doc_lens = [], [], [], []
+    base = 0
+    for tokens, shard_terms, shard_docs, shard_counts, shard_lens in shards:
+        remap = np.fromiter((vocab[t] for t in tokens), dtype=np.int32, count=len(tokens))
+        terms.append(remap[np.frombuffer(shard_terms, dtype=np.int32)])
+        docs.append(np.frombuffer(shard_docs, dtype=np.int32) + base)
+        counts.append(np.frombuffer(shard_counts, dtype=np.int32))
+        doc_lens.append(np.frombuffer(shard_lens, dtype=np.int32))
+        base += len(shard_lens)
+    return (
+        vocab,
+        np.concatenate(terms),
+        np.concatenate(docs).astype(np.int32),
+        np.concatenate(counts).astype(np.float64),
+        np.concatenate(doc_lens),
+    )
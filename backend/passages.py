@@ -0,0 +1,188 @@
+"""
+Passage-level indexing: documents are split into overlapping word
+windows and the scorers index those instead of whole documents.
+
+    PASSAGE_WORDS=200 PASSAGE_OVERLAP=50   (0 words = whole documents)
+
+Each passage is indexed as "title gene <window of content>", so the
+title still matches every passage of its doc. A doc no longer than one
+window is a single passage with exactly the text of
+HybridRetriever._doc_text, so short annotations rank as before.
+
+PassageMap maps scorer rows to (doc slot, content span). A doc's rows
+are contiguous, so a doc -> rows range is one lookup. Passage rankings
+are pooled back to documents, scoring a doc by either its best passage
+(max) or the sum of its retrieved passages (sum, PASSAGE_POOLING). The
+spans of the passages that matched are kept with each hit. That lets the
+LLM get those passages instead of the whole document.
+
+Pooling only sees the passages the scorers returned. When docs span
+several rows, the scorers are asked for POOL_DEPTH times more rows than
+usual, so a doc's sum rarely misses many of its passages.
+"""
+
+import os
+import re
+from array import array
+
+PASSAGE_WORDS = int(os.getenv("PASSAGE_WORDS", "200"))
+PASSAGE_OVERLAP = int(os.getenv("PASSAGE_OVERLAP", "50"))
+PASSAGE_POOLING = os.getenv("PASSAGE_POOLING", "max")  # max | sum
+POOLING_MODES = ("max", "sum")
+
+POOL_DEPTH = 4           # row-ranking depth multiplier when docs have several passages
+PASSAGES_PER_HIT = 3     # matched passages kept per search hit
+
+_WORD_RE = re.compile(r"\S+")
+
+
+def passage_config() -> list[int]:
+    """[words, overlap] as recorded in index manifests ([0, 0] = whole docs)."""
+    return [PASSAGE_WORDS, PASSAGE_OVERLAP] if PASSAGE_WORDS > 0 else [0, 0]
+
+
+def chunk_spans(
+    content: str, words: int = PASSAGE_WORDS, overlap: int = PASSAGE_OVERLAP
+) -> list[tuple[int, int]]:
+    """(start, end) character spans of the passage windows of `content`."""
+    if words <= 0:
+        return [(0, len(content))]
+    bounds = [m.span() for m in _WORD_RE.finditer(content)]
+    if len(bounds) <= words:
+        return [(0, len(content))]
+    stride = max(words - overlap, 1)
+    spans = []
+    for i in range(0, len(bounds), stride):
+        j = min(i + words, len(bounds))
+        spans.append((bounds[i][0], bounds[j - 1][1]))
+        if j == len(bounds):
+            break
+    return spans
+
+
+def passage_text(doc: dict, start: int, end: int) -> str:
+    """Indexed text of one passage; same fields as HybridRetriever._doc_text."""
+    return f"{doc['title']} {doc.get('gene', '')} {doc['content'][start:end]}"
+
+
+def merge_spans(spans) -> list[tuple[int, int]]:
+    """Sorted spans with overlapping windows joined."""
+    out: list[tuple[int, int]] = []
+    for start, end in sorted(spans):
+        if out and start <= out[-1][1]:
+            out[-1] = (out[-1][0], max(out[-1][1], end))
+        else:
+            out.append((start, end))
+    return out
+
+
+def with_passages(doc: dict, spans) -> dict:
+    """`doc` with its content cut down to `spans` (all of it if there are none)."""
+    content = doc["content"]
+    spans = merge_spans(spans)
+    if not spans or spans == [(0, len(content))]:
+        return doc
+    parts = [content[s:e] for s, e in spans]
+    if spans[0][0] > 0:
+        parts.insert(0, "")
+    if spans[-1][1] < len(content):
+        parts.append("")
+    return {**doc, "content": " ... ".join(parts).strip()}
+
+
+class PassageMap:
+    """
+    Scorer row <-> (doc slot, content span). Rows of doc d are
+    doc_rows[d]:doc_rows[d + 1].
+    """
+
+    def __init__(self, row_doc=None, row_start=None, row_end=None, doc_rows=None):
+        # may be memory-mapped numpy arrays (index_store.load_index);
+        # they're copied into arrays on the first add()
+        self.row_doc = row_doc if row_doc is not None else array("i")
+        self.row_start = row_start if row_start is not None else array("i")
+        self.row_end = row_end if row_end is not None else array("i")
+        self.doc_rows = doc_rows if doc_rows is not None else array("q", [0])
+        # one row per doc: rows are doc slots and pooling is a no-op
+        self.identity = True
+        if doc_rows is not None:
+            import numpy as np
+            self.identity = bool(np.all(np.diff(np.asarray(doc_rows)) == 1))
+
+    def __len__(self) -> int:
+        return len(self.row_doc)
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_rows) - 1
+
+    def add(self, documents) -> list[str]:
+        """
+        Append docs at the next doc slots and return the texts of their
+        new rows, in row order.
+        """
+        if not isinstance(self.row_doc, array):
+            self.row_doc, self.row_start, self.row_end = (
+                array("i", a) for a in (self.row_doc, self.row_start, self.row_end)
+            )
+            self.doc_rows = array("q", self.doc_rows)
+
+        texts = []
+        for doc in documents:
+            slot = len(self.doc_rows) - 1
+            spans = chunk_spans(doc["content"])
+            for start, end in spans:
+                self.row_doc.append(slot)
+                self.row_start.append(start)
+                self.row_end.append(end)
+                texts.append(passage_text(doc, start, end))
+            self.doc_rows.append(len(self.row_doc))
+            if len(spans) != 1:
+                self.identity = False
+        return texts
+
+    def rows(self, doc_idx: int) -> range:
+        return range(int(self.doc_rows[doc_idx]), int(self.doc_rows[doc_idx + 1]))
+
+    def span(self, row: int) -> tuple[int, int]:
+        return int(self.row_start[row]), int(self.row_end[row])
+
+    def pool(
+        self, ranking: list[tuple[int, float]], mode: str = PASSAGE_POOLING
+    ) -> tuple[list[tuple[int, float]], dict[int, list[int]]]:
+        """
+        Doc ranking from a (row, score) ranking, plus each doc's matched
+        rows, best first.
+        """
+        if self.identity:
+            return ranking, {row: [row] for row, _ in ranking}
+        scores: dict[int, float] = {}
+        rows: dict[int, list[int]] = {}
+        for row, score in ranking:  # best first
+            doc_idx = int(self.row_doc[row])
+            if doc_idx in scores:
+                if mode == "sum":
+                    scores[doc_idx] += score
+                rows[doc_idx].append(row)
+            else:
+                scores[doc_idx] = score
+                rows[doc_idx] = [row]
+        return sorted(scores.items(), key=lambda x: (-x[1], x[0])), rows
+
+    def expand(self, doc_filter):
+        """Row-level filters.DocFilter for a doc-level one."""
+        if self.identity:
+            return doc_filter
+        import numpy as np
+        from filters import DocFilter
+
+        cached = doc_filter.expanded
+        if cached is None or cached.n_docs != len(self.row_doc):
+            doc_rows = np.array(self.doc_rows, dtype=np.int64)  # a copy, see FilterIndex._ids
+            starts = doc_rows[doc_filter.ids]
+            counts = doc_rows[doc_filter.ids + 1] - starts
+            # each doc's rows are starts[i] .. starts[i] + counts[i]
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            rows = (np.repeat(starts, counts) + offsets).astype(np.int32)
+            cached = doc_filter.expanded = DocFilter(rows, len(self.row_doc))
+        return cached
@@ -0,0 +1,405 @@
+"""
+Block-compressed postings for the "compact" retriever engine.
+
+The dict engine keeps every posting as a Python int -> int (or float)
+dict entry, which costs well over 100 bytes per posting. Here each
+term's postings are cut into blocks of BLOCK_SIZE docs:
+
+    data          varint bytes: per block, the first doc id in full and
+                  then the gaps to the previous doc id
+    freqs         uint16 term frequency per posting, parallel to the doc
+                  ids (clipped at 65535)
+    block_offset  byte offset of each block in `data`
+    block_start   posting offset of each block in `freqs`
+    block_last    last doc id of each block, for skipping
+    block_max_tf  largest tf in the block  } BM25 block upper bound
+    block_min_len shortest doc in the block }
+
+which comes to 3-4 bytes per posting. A block is only decoded when
+scoring touches it, and the per-block bounds let MaxScore drop a
+candidate without decoding the block at all (block-max pruning).
+
+One PostingsStore is shared by CompactTfidfVectorizer and CompactBM25:
+both scorers derive their weights from the same (doc, tf) pairs.
+"""
+
+import heapq
+import math
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from itertools import accumulate
+
+from profiler import count_work
+from tokenizer import count_terms, tokenize
+
+BLOCK_SIZE = 128
+MAX_TF = 0xFFFF
+
+
+def _encode_varint(n: int, out: bytearray):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _decode_varints(buf, start: int, end: int) -> list[int]:
+    values = []
+    n = shift = 0
+    for byte in buf[start:end]:
+        n |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(n)
+            n = shift = 0
+    return values
+
+
+class PostingsStore:
+    """Immutable term -> [(doc_idx, tf)] index in compressed blocks."""
+
+    def __init__(self, doc_tfs: list[dict[str, int]], doc_freq: dict[str, int] | None = None):
+        if doc_freq is None:
+            doc_freq = defaultdict(int)
+            for tf in doc_tfs:
+                for t in tf:
+                    doc_freq[t] += 1
+
+        self.n_docs = len(doc_tfs)
+        self.vocab = {t: i for i, t in enumerate(sorted(doc_freq))}
+        self.df = array("i", [0]) * len(self.vocab)
+        self.doc_lens = array("i", (sum(tf.values()) for tf in doc_tfs))
+
+        # gather each term's postings in doc order, then compress term by term
+        term_docs = [array("i") for _ in range(len(self.vocab))]
+        term_tfs = [array("H") for _ in range(len(self.vocab))]
+        for doc_idx, tf in enumerate(doc_tfs):
+            for t, f in tf.items():
+                tid = self.vocab[t]
+                term_docs[tid].append(doc_idx)
+                term_tfs[tid].append(min(f, MAX_TF))
+
+        self.data = bytearray()
+        self.freqs = array("H")
+        self.term_block = array("q", [0])  # first block of each term, [V + 1]
+        self.block_offset = array("q", [0])  # [n_blocks + 1]
+        self.block_start = array("q", [0])  # [n_blocks + 1]
+        self.block_last = array("i")
+        self.block_max_tf = array("H")
+        self.block_min_len = array("i")
+
+        for tid in range(len(self.vocab)):
+            docs, tfs = term_docs[tid], term_tfs[tid]
+            self.df[tid] = len(docs)
+            for lo in range(0, len(docs), BLOCK_SIZE):
+                block = docs[lo:lo + BLOCK_SIZE]
+                prev = 0
+                for d in block:
+                    _encode_varint(d - prev, self.data)
+                    prev = d
+                self.freqs.extend(tfs[lo:lo + BLOCK_SIZE])
+                self.block_offset.append(len(self.data))
+                self.block_start.append(len(self.freqs))
+                self.block_last.append(block[-1])
+                self.block_max_tf.append(max(tfs[lo:lo + BLOCK_SIZE]))
+                self.block_min_len.append(min(self.doc_lens[d] for d in block))
+            self.term_block.append(len(self.block_last))
+            term_docs[tid] = term_tfs[tid] = None  # free as we go
+
+    def __len__(self) -> int:
+        return len(self.freqs)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.freqs, self.term_block, self.block_offset, self.block_start,
+                  self.block_last, self.block_max_tf, self.block_min_len, self.df, self.doc_lens)
+        return len(self.data) + sum(a.itemsize * len(a) for a in arrays)
+
+    def blocks(self, tid: int) -> range:
+        return range(self.term_block[tid], self.term_block[tid + 1])
+
+    def decode(self, block: int) -> tuple[list[int], array]:
+        """(doc ids, tfs) of one block."""
+        gaps = _decode_varints(self.data, self.block_offset[block], self.block_offset[block + 1])
+        return list(accumulate(gaps)), self.freqs[self.block_start[block]:self.block_start[block + 1]]
+
+
+# ── scorers ───────────────────────────────────────────────
+
+class _BlockMaxScorer(ABC):
+    """
+    MaxScore top-k over a PostingsStore. Subclasses give the weight of a
+    block's postings and an upper bound of those weights.
+    """
+
+    store: PostingsStore
+
+    @abstractmethod
+    def _weights(self, tid: int, docs: list[int], tfs) -> list[float]:
+        """Weight of each posting (docs[i], tfs[i]) of term `tid`."""
+
+    @abstractmethod
+    def _block_bound(self, tid: int, block: int) -> float:
+        """Upper bound of the weights in `block` of term `tid`."""
+
+    def _term_bound(self, tid: int) -> float:
+        return max(self._block_bound(tid, b) for b in self.store.blocks(tid))
+
+    def _top_k_exhaustive(self, qweights: dict[int, float], top_k: int, positive_only: bool):
+        scores: dict[int, float] = defaultdict(float)
+        walked = 0
+        for tid, qw in qweights.items():
+            for b in self.store.blocks(tid):
+                docs, tfs = self.store.decode(b)
+                walked += len(docs)
+                for d, w in zip(docs, self._weights(tid, docs, tfs)):
+                    scores[d] += qw * w
+        count_work(walked, len(scores))
+        return self._ranked(scores, top_k, positive_only)
+
+    def _top_k(self, qweights: dict[int, float], top_k: int, positive_only: bool):
+        """
+        Same results as _top_k_exhaustive(), see BM25.score_maxscore for
+        the idea. On top of the term bounds, each candidate probe first
+        checks the bound of the block the doc would sit in, so blocks
+        whose best posting can't keep any candidate alive stay encoded.
+        """
+        if not qweights or top_k <= 0:
+            return []
+        store = self.store
+        terms = sorted(
+            ((qw * self._term_bound(tid), tid, qw) for tid, qw in qweights.items()), reverse=True
+        )
+        remaining = [0.0] * (len(terms) + 1)
+        for i in range(len(terms) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + terms[i][0]
+
+        def kth_best(scores) -> float:
+            if len(scores) < top_k:
+                return 0.0
+            return heapq.nlargest(top_k, scores.values())[-1]
+
+        # essential terms: decode every block
+        acc: dict[int, float] = defaultdict(float)
+        walked = 0
+        i = 0
+        while i < len(terms):
+            _, tid, qw = terms[i]
+            for b in store.blocks(tid):
+                docs, tfs = store.decode(b)
+                walked += len(docs)
+                for d, w in zip(docs, self._weights(tid, docs, tfs)):
+                    acc[d] += qw * w
+            i += 1
+            if remaining[i] < kth_best(acc):
+                break
+        candidates = len(acc)
+
+        # non-essential terms: seek each candidate's block, in doc order
+        for j in range(i, len(terms)):
+            _, tid, qw = terms[j]
+            theta = kth_best(acc)
+            rest = remaining[j + 1]
+            blocks = store.blocks(tid)
+            b, decoded, block_weights = blocks.start, -1, {}
+            survivors = {}
+            for d in sorted(acc):
+                s = acc[d]
+                while b < blocks.stop and store.block_last[b] < d:
+                    b += 1
+                if b < blocks.stop:
+                    if s + qw * self._block_bound(tid, b) + rest < theta:
+                        continue
+                    if decoded != b:
+                        docs, tfs = store.decode(b)
+                        walked += len(docs)
+                        block_weights = dict(zip(docs, self._weights(tid, docs, tfs)))
+                        decoded = b
+                    s += qw * block_weights.get(d, 0.0)
+                if s + rest >= theta:
+                    survivors[d] = s
+            acc = survivors
+
+        count_work(walked, candidates)
+        return self._ranked(acc, top_k, positive_only)
+
+    def _top_k_filtered(self, qweights: dict[int, float], allowed, top_k: int, positive_only: bool):
+        """
+        Score only the docs in `allowed` (a filters.DocFilter). A block is
+        decoded only if some allowed doc falls in its doc id range.
+        """
+        store = self.store
+        ids = allowed.id_list()
+        keep = allowed.id_set()
+        scores: dict[int, float] = defaultdict(float)
+        walked = 0
+        for tid, qw in qweights.items():
+            lo = 0  # first allowed doc past the previous block
+            for b in store.blocks(tid):
+                if lo == len(ids):
+                    break
+                if ids[lo] > store.block_last[b]:
+                    continue
+                docs, tfs = store.decode(b)
+                walked += len(docs)
+                for d, w in zip(docs, self._weights(tid, docs, tfs)):
+                    if d in keep:
+                        scores[d] += qw * w
+                lo = bisect_right(ids, store.block_last[b], lo)
+        count_work(walked, len(scores))
+        return self._ranked(scores, top_k, positive_only)
+
+    @staticmethod
+    def _ranked(scores: dict[int, float], top_k: int, positive_only: bool):
+        items = scores.items()
+        if positive_only:
+            items = ((d, s) for d, s in items if s > 0)
+        return heapq.nlargest(top_k, items, key=lambda x: (x[1], -x[0]))
+
+
+class CompactTfidfVectorizer(_BlockMaxScorer):
+    """
+    TF-IDF cosine scorer over a PostingsStore. Doc weights aren't stored;
+    tf / len * idf / norm is recomputed per decoded block, which matches
+    TfidfVectorizer's normalized vectors.
+    """
+
+    def __init__(self):
+        self.store: PostingsStore | None = None
+        self.vocab: dict[str, int] = {}
+        self.n_docs = 0
+        self.idf = array("d")
+        self.doc_norms = array("d")
+        self.block_max = array("d")
+
+    def fit(self, texts: list[str]):
+        self.fit_counts([count_terms(tokenize(text)) for text in texts])
+
+    def fit_counts(self, doc_tfs: list[dict[str, int]], doc_freq: dict[str, int] | None = None):
+        store = self.store = PostingsStore(doc_tfs, doc_freq)
+        self.vocab = store.vocab
+        n_docs = self.n_docs = store.n_docs
+        self.idf = array("d", (math.log(n_docs / (df + 1)) + 1.0 for df in store.df))
+
+        # L2 norm of each doc's tf / len * idf vector
+        self.doc_norms = array("d", [0.0]) * n_docs
+        for doc_idx, tf in enumerate(doc_tfs):
+            length = store.doc_lens[doc_idx] or 1
+            norm = math.sqrt(sum(((c / length) * self.idf[self.vocab[t]]) ** 2 for t, c in tf.items()))
+            self.doc_norms[doc_idx] = norm or 1.0
+
+        # exact per-block maxima of the doc weights, for MaxScore
+        self.block_max = array("d", [0.0]) * len(store.block_last)
+        for tid in range(len(self.vocab)):
+            for b in store.blocks(tid):
+                docs, tfs = store.decode(b)
+                self.block_max[b] = max(self._weights(tid, docs, tfs))
+
+        print(f"[postings] {len(store)} postings in {store.nbytes / 2**20:.1f} MiB "
+              f"({store.nbytes / max(len(store), 1):.2f} bytes/posting)")
+
+    def _weights(self, tid, docs, tfs):
+        idf, lens, norms = self.idf[tid], self.store.doc_lens, self.doc_norms
+        return [((tf / (lens[d] or 1)) * idf) / norms[d] for d, tf in zip(docs, tfs)]
+
+    def _block_bound(self, tid, block):
+        return self.block_max[block]
+
+    def term_idf(self, token: str) -> float:
+        """IDF of `token`, 0.0 if it's not in the corpus."""
+        tid = self.vocab.get(token)
+        return self.idf[tid] if tid is not None else 0.0
+
+    def query(self, text: str, top_k: int = 10) -> list[tuple[int, float]]:
+        return self.query_tokens(tokenize(text), top_k=top_k)
+
+    def query_tokens(self, tokens: list[str], top_k: int = 10, allowed=None) -> list[tuple[int, float]]:
+        """`allowed` (a filters.DocFilter) restricts scoring to those docs."""
+        tf: dict[str, float] = defaultdict(float)
+        for t in tokens:
+            tf[t] += 1.0
+        length = len(tokens) or 1
+
+        q_vec = {}
+        for t, count in tf.items():
+            tid = self.vocab.get(t)
+            if tid is not None:
+                q_vec[tid] = (count / length) * self.idf[tid]
+        norm = math.sqrt(sum(v * v for v in q_vec.values())) or 1.0
+        qweights = {tid: v / norm for tid, v in q_vec.items()}
+        if allowed is not None:
+            return self._top_k_filtered(qweights, allowed, top_k, positive_only=True)
+        return self._top_k(qweights, top_k, positive_only=True)
+
+
+class CompactBM25(_BlockMaxScorer):
+    """Okapi BM25 over a PostingsStore, same weights as retriever.BM25."""
+
+    def __init__(self, store: PostingsStore, k1=1.5, b=0.75):
+        self.store = store
+        self.k1 = k1
+        self.b = b
+        self.corpus_size = store.n_docs
+        self.avgdl = sum(store.doc_lens) / max(self.corpus_size, 1)
+        self.idf = array("d", (
+            math.log((self.corpus_size - df + 0.5) / (df + 0.5) + 1.0) for df in store.df
+        ))
+        self.max_weight: dict[int, float] = {}  # per-term bound cache
+
+    @classmethod
+    def from_counts(cls, doc_tfs: list[dict[str, int]], k1=1.5, b=0.75) -> "CompactBM25":
+        return cls(PostingsStore(doc_tfs), k1, b)
+
+    @classmethod
+    def from_store(cls, store: PostingsStore, k1=1.5, b=0.75) -> "CompactBM25":
+        """Share the postings of an already fitted CompactTfidfVectorizer."""
+        return cls(store, k1, b)
+
+    def term_idf(self, token: str) -> float:
+        """IDF of `token`, 0.0 if it's not in the corpus."""
+        tid = self.store.vocab.get(token)
+        return self.idf[tid] if tid is not None else 0.0
+
+    def term_df(self, token: str) -> int:
+        """Length of `token`'s postings list."""
+        tid = self.store.vocab.get(token)
+        return int(self.store.df[tid]) if tid is not None else 0
+
+    def _weights(self, tid, docs, tfs):
+        idf, lens = self.idf[tid], self.store.doc_lens
+        k1, b, avgdl = self.k1, self.b, self.avgdl
+        return [
+            idf * (tf * (k1 + 1)) / (tf + k1 * (1 - b + b * lens[d] / avgdl))
+            for d, tf in zip(docs, tfs)
+        ]
+
+    def _block_bound(self, tid, block):
+        # BM25 grows with tf and shrinks with doc length, so the block's
+        # largest tf in its shortest doc bounds every posting in it
+        tf, dl = self.store.block_max_tf[block], self.store.block_min_len[block]
+        k1, b = self.k1, self.b
+        return self.idf[tid] * (tf * (k1 + 1)) / (tf + k1 * (1 - b + b * dl / self.avgdl))
+
+    def _term_bound(self, tid):
+        ub = self.max_weight.get(tid)
+        if ub is None:
+            ub = self.max_weight[tid] = super()._term_bound(tid)
+        return ub
+
+    def score(self, query_tokens: list[str], top_k: int = 10, allowed=None) -> list[tuple[int, float]]:
+        """Return list of (doc_idx, score) sorted descending, within `allowed` if given."""
+        from retriever import BM25_PRUNING  # retriever imports this module lazily
+
+        qweights: dict[int, float] = defaultdict(float)
+        for t in query_tokens:
+            tid = self.store.vocab.get(t)
+            if tid is not None:
+                qweights[tid] += 1.0
+        if allowed is not None:
+            return self._top_k_filtered(qweights, allowed, top_k, positive_only=False)
+        if BM25_PRUNING == "off":
+            return self._top_k_exhaustive(qweights, top_k, positive_only=False)
+        return self._top_k(qweights, top_k, positive_only=False)
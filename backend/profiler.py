@@ -0,0 +1,156 @@
+"""
+Opt-in per-query profiling of the retrieval path.
+
+A /query request is profiled when it sends `X-Profile: 1` or when it is
+picked at random by PROFILE_SAMPLE_RATE:
+
+    PROFILE_SAMPLE_RATE=0      fraction of queries profiled (0 = header only)
+    PROFILE_KEEP=20            slowest traces kept
+    ADMIN_TOKEN=               the header and /admin/profiles need
+                               `X-Admin-Token: <token>`; unset, both are off
+
+A profiled search runs under cProfile with the ranking cache bypassed,
+so the trace shows the scoring work and not a cache lookup. It records
+the top functions by cumulative time along with what the scorers
+actually did during that search (count_work()): postings read, and
+passages that got a score, summed over every scorer and segment.
+MaxScore and filters show up as fewer postings than the terms' lists
+hold; a query full of common terms shows up as a large total.
+
+One search is profiled at a time per process: from Python 3.12 cProfile
+runs on sys.monitoring, which takes one profiler at once, and a second
+enable() raises. A query picked while another one is being profiled
+runs as a plain search and is counted as skipped.
+
+Only the PROFILE_KEEP slowest traces are kept (a min-heap on duration),
+and GET /admin/profiles returns them slowest first. Profiling costs
+several times the search itself, so keep the sample rate low in
+production.
+"""
+
+import cProfile
+import heapq
+import io
+import itertools
+import os
+import pstats
+import random
+import threading
+import time
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+PROFILE_HEADER = "x-profile"
+PROFILE_TOP_FUNCTIONS = 25  # pstats lines kept per trace
+
+# held while a search runs under cProfile, see QueryProfiler.search
+_profiling = threading.Lock()
+
+# ── scoring work counters ─────────────────────────────────
+
+_counters = threading.local()
+
+
+def count_work(postings: int, candidates: int):
+    """
+    Called by each scorer once per query it ranks: postings it read
+    (walked or probed) and candidate passages it scored. A no-op unless
+    a profiled search is running on this thread.
+    """
+    work = getattr(_counters, "work", None)
+    if work is not None:
+        work["postings"] += postings
+        work["candidates"] += candidates
+
+
+class QueryProfiler:
+    """Profiles sampled or requested searches, keeping the slowest traces."""
+
+    def __init__(self, keep: int = PROFILE_KEEP, sample_rate: float = PROFILE_SAMPLE_RATE):
+        self.keep = keep
+        self.sample_rate = sample_rate
+        self.profiled = 0
+        self.skipped = 0  # picked while another search was being profiled
+        self._traces: list[tuple[float, int, dict]] = []  # min-heap on duration
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def reason(self, requested: bool) -> str | None:
+        """Why this request should be profiled, or None if it shouldn't."""
+        if self.keep <= 0:
+            return None
+        if requested:
+            return "header"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def search(self, retriever, query: str, top_k: int, filters: dict | None, reason: str):
+        """
+        retriever.search() under cProfile; records the trace, returns the
+        hits. A plain search if another one is being profiled.
+        """
+        if not _profiling.acquire(blocking=False):
+            self.skipped += 1
+            return retriever.search(query, top_k, filters=filters)
+        try:
+            profile = cProfile.Profile()
+            work = _counters.work = {"postings": 0, "candidates": 0}
+            t0 = time.perf_counter()
+            profile.enable()
+            try:
+                hits = retriever.search(query, top_k, filters=filters, use_cache=False)
+            finally:
+                profile.disable()
+                _counters.work = None
+        finally:
+            _profiling.release()
+        duration = time.perf_counter() - t0
+
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        trace = {
+            "query": query,
+            "top_k": top_k,
+            "filters": filters,
+            "reason": reason,
+            "engine": retriever.engine,
+            "timestamp": time.time(),
+            "duration_ms": round(duration * 1000, 3),
+            "function_calls": stats.total_calls,
+            **work,
+            "hits": [hit.id for hit in hits],
+            "profile": out.getvalue().strip().splitlines(),
+        }
+        self._record(duration, trace)
+        return hits
+
+    def _record(self, duration: float, trace: dict):
+        with self._lock:
+            self.profiled += 1
+            entry = (duration, next(self._seq), trace)
+            if len(self._traces) < self.keep:
+                heapq.heappush(self._traces, entry)
+            elif duration > self._traces[0][0]:
+                heapq.heapreplace(self._traces, entry)
+
+    def slowest(self) -> list[dict]:
+        with self._lock:
+            return [trace for _, _, trace in sorted(self._traces, reverse=True)]
+
+    def clear(self):
+        with self._lock:
+            self._traces.clear()
+
+    def stats(self) -> dict:
+        return {
+            "profiled": self.profiled,
+            "skipped": self.skipped,
+            "kept": len(self._traces),
+            "keep": self.keep,
+            "sample_rate": self.sample_rate,
+        }
+
+
+query_profiler = QueryProfiler()
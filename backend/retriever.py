@@ -1,126 +1,1010 @@
 
 
+import hashlib
+import heapq
 import math
-import re
-from collections import defaultdict
+import os
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
 
+import metrics
+from doc_sources import DOCUMENT_SOURCE, iter_documents
 from embeddings import TfidfVectorizer
-from genomic_db import get_all_documents
+from parallel_build import count_corpus, count_postings
+from passages import (
+    PASSAGE_POOLING,
+    PASSAGES_PER_HIT,
+    POOL_DEPTH,
+    POOLING_MODES,
+    PassageMap,
+    passage_config,
+)
+from profiler import count_work
+from segments import IndexSnapshot, Segment, WriteLog, build_delta, net_writes
+from tokenizer import TOKENIZER, count_terms, tokenize
 
-# ── BM25 (minimal implementation, no external dep) ────────
+# "dict" — pure-Python dict postings (no external deps)
+# "csr"  — numpy/scipy CSR matrices, see sparse_index.py
+# "compact" — block-compressed postings (~3-4 bytes each), see postings.py
+RETRIEVER_ENGINE = os.getenv("RETRIEVER_ENGINE", "dict")
+ENGINES = ("dict", "csr", "compact")
+
+# "maxscore" — skip postings that can't reach the top-k (exact results)
+# "off"      — score every posting of every query term
+BM25_PRUNING = os.getenv("BM25_PRUNING", "maxscore")
+
+# prebuilt on-disk index (see index_store.py); empty = build in memory
+INDEX_DIR = os.getenv("INDEX_DIR", "")
+
+# prebuilt embedding index (see dense.py); empty = no dense ranking
+DENSE_INDEX_DIR = os.getenv("DENSE_INDEX_DIR", "")
+
+# fused rankings kept per (query tokens, top_k); 0 disables
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "4096"))
 
-def _tokenize(text: str) -> list[str]:
-    """Lowercased alphanumeric tokens. Good enough for gene names."""
-    return re.findall(r"[a-z0-9]+", text.lower())
+# background merge (compaction) after this many adds/deletes, or this
+# fraction of the live corpus, whichever is larger
+INDEX_MERGE_MIN_UPDATES = int(os.getenv("INDEX_MERGE_MIN_UPDATES", "100"))
+INDEX_MERGE_RATIO = float(os.getenv("INDEX_MERGE_RATIO", "0.1"))
+# delta segments (one per write) kept before they're merged into one
+INDEX_MAX_DELTAS = int(os.getenv("INDEX_MAX_DELTAS", "8"))
+# writes are appended here before they're acknowledged, and replayed on
+# startup; empty = writes last until the process exits
+INDEX_WRITE_LOG = os.getenv(
+    "INDEX_WRITE_LOG", f"{INDEX_DIR.rstrip(os.sep)}.writes.jsonl" if INDEX_DIR else ""
+)
 
+# ── BM25 (minimal implementation, no external dep) ────────
 
 class BM25:
     """Okapi BM25 scorer. k1=1.5, b=0.75 — standard defaults."""
 
     def __init__(self, corpus_tokens: list[list[str]], k1=1.5, b=0.75):
+        self._fit([count_terms(tokens) for tokens in corpus_tokens], k1, b)
+
+    @classmethod
+    def from_counts(cls, doc_tfs: list[dict[str, int]], k1=1.5, b=0.75, reference=None) -> "BM25":
+        """
+        Build from per-document term counts (see parallel_build.py).
+        With a `reference` scorer (a delta segment's base, see
+        segments.py), IDF and avgdl come from it, so scores are on the
+        same scale as the reference's.
+        """
+        self = cls.__new__(cls)
+        self._fit(doc_tfs, k1, b, reference)
+        return self
+
+    def _fit(self, doc_tfs: list[dict[str, int]], k1, b, reference=None):
         self.k1 = k1
         self.b = b
-        self.corpus_size = len(corpus_tokens)
-        self.doc_lens = [len(d) for d in corpus_tokens]
-        self.avgdl = sum(self.doc_lens) / max(self.corpus_size, 1)
+        self.reference = reference
+        self.corpus_size = len(doc_tfs)
+        self.doc_lens = [sum(tf.values()) for tf in doc_tfs]
+        self.total_len = sum(self.doc_lens)
+        self.avgdl = self.total_len / max(self.corpus_size, 1)
+        if reference is not None and reference.avgdl:
+            self.avgdl = reference.avgdl
 
         # inverted index: token -> {doc_idx: term_freq}
         self.inv_index: dict[str, dict[int, int]] = defaultdict(dict)
-        for idx, tokens in enumerate(corpus_tokens):
-            freq: dict[str, int] = defaultdict(int)
-            for t in tokens:
-                freq[t] += 1
-            for t, f in freq.items():
+        for idx, tf in enumerate(doc_tfs):
+            for t, f in tf.items():
                 self.inv_index[t][idx] = f
 
-        # IDF cache
         self.idf: dict[str, float] = {}
-        for token, postings in self.inv_index.items():
-            df = len(postings)
-            self.idf[token] = math.log(
-                (self.corpus_size - df + 0.5) / (df + 0.5) + 1.0
+        for token in self.inv_index:
+            self._idf(token)
+        # per-term upper bound of the BM25 term weight, for MaxScore
+        self.max_weight: dict[str, float] = {}
+
+    def _idf(self, token: str) -> float:
+        idf = self.idf.get(token)
+        if idf is None:
+            idf = self.reference.term_idf(token) if self.reference is not None else 0.0
+            if not idf:
+                # a term the reference hasn't seen: DF from here, N of both
+                n = self.corpus_size
+                if self.reference is not None:
+                    n += self.reference.corpus_size
+                df = len(self.inv_index[token])
+                idf = math.log((n - df + 0.5) / (df + 0.5) + 1.0)
+            self.idf[token] = idf
+        return idf
+
+    def term_idf(self, token: str) -> float:
+        """IDF of `token`, 0.0 if it's not in the corpus."""
+        return self._idf(token) if self.inv_index.get(token) else 0.0
+
+    def term_df(self, token: str) -> int:
+        """Length of `token`'s postings list."""
+        return len(self.inv_index.get(token, ()))
+
+    def _weight(self, idf: float, tf: int, doc_idx: int) -> float:
+        dl = self.doc_lens[doc_idx]
+        num = tf * (self.k1 + 1)
+        denom = tf + self.k1 * (1 - self.b + self.b * dl / self.avgdl)
+        return idf * num / denom
+
+    def _max_weight(self, token: str) -> float:
+        """Largest weight `token` contributes to any doc (cached)."""
+        ub = self.max_weight.get(token)
+        if ub is None:
+            idf = self._idf(token)
+            ub = self.max_weight[token] = max(
+                self._weight(idf, tf, doc_idx)
+                for doc_idx, tf in self.inv_index[token].items()
             )
+        return ub
 
-    def score(self, query_tokens: list[str], top_k: int = 10) -> list[tuple[int, float]]:
-        """Return list of (doc_idx, score) sorted descending."""
+    def score(self, query_tokens: list[str], top_k: int = 10, allowed=None) -> list[tuple[int, float]]:
+        """Return list of (doc_idx, score) sorted descending, within `allowed` if given."""
+        if allowed is not None:
+            return self.score_filtered(query_tokens, allowed, top_k)
+        if BM25_PRUNING == "off":
+            return self.score_exhaustive(query_tokens, top_k)
+        return self.score_maxscore(query_tokens, top_k)
+
+    def score_exhaustive(self, query_tokens: list[str], top_k: int = 10) -> list[tuple[int, float]]:
+        """Score every posting of every query term."""
         scores = defaultdict(float)
+        walked = 0
         for qt in query_tokens:
             if qt not in self.inv_index:
                 continue
+            idf = self._idf(qt)
+            walked += len(self.inv_index[qt])
             for doc_idx, tf in self.inv_index[qt].items():
-                dl = self.doc_lens[doc_idx]
-                num = tf * (self.k1 + 1)
-                denom = tf + self.k1 * (1 - self.b + self.b * dl / self.avgdl)
-                scores[doc_idx] += self.idf[qt] * num / denom
-        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-        return ranked[:top_k]
+                scores[doc_idx] += self._weight(idf, tf, doc_idx)
+        count_work(walked, len(scores))
+        return heapq.nlargest(top_k, scores.items(), key=lambda x: (x[1], -x[0]))
+
+    def score_filtered(self, query_tokens: list[str], allowed, top_k: int = 10) -> list[tuple[int, float]]:
+        """
+        Score only the docs in `allowed` (a filters.DocFilter). Small
+        filters probe each allowed doc in the postings of the query terms
+        instead of walking those postings.
+        """
+        qtf = count_terms([t for t in query_tokens if t in self.inv_index])
+        terms = [(self.inv_index[t], c, self._idf(t)) for t, c in qtf.items()]
+        scores: dict[int, float] = defaultdict(float)
+        walked = sum(len(postings) for postings, _, _ in terms)
+        if len(allowed) < walked:
+            walked = len(allowed) * len(terms)  # probes
+            for doc_idx in allowed.id_list():
+                for postings, c, idf in terms:
+                    tf = postings.get(doc_idx)
+                    if tf:
+                        scores[doc_idx] += c * self._weight(idf, tf, doc_idx)
+        else:
+            keep = allowed.id_set()
+            for postings, c, idf in terms:
+                for doc_idx, tf in postings.items():
+                    if doc_idx in keep:
+                        scores[doc_idx] += c * self._weight(idf, tf, doc_idx)
+        count_work(walked, len(scores))
+        return heapq.nlargest(top_k, scores.items(), key=lambda x: (x[1], -x[0]))
+
+    def score_maxscore(self, query_tokens: list[str], top_k: int = 10) -> list[tuple[int, float]]:
+        """
+        MaxScore top-k: same results as score_exhaustive(), less work.
+
+        Terms are visited by descending upper bound. Once the bounds of the
+        terms left can't lift an unseen doc past the current k-th score,
+        those terms stop contributing candidates. For them, we only look up
+        docs that are already candidates, which is an O(1) dict probe each.
+        Candidates that can't reach the k-th score even with every remaining
+        term are dropped as we go. Common low-IDF terms ("cancer", "gene")
+        sort last, so their long postings lists are almost never walked.
+        """
+        qtf = count_terms([t for t in query_tokens if t in self.inv_index])
+        if not qtf or top_k <= 0:
+            return []
+
+        # (upper bound, token, query count), highest bound first
+        terms = sorted(
+            ((self._max_weight(t) * c, t, c) for t, c in qtf.items()), reverse=True
+        )
+        # remaining[i] = sum of the bounds of terms[i:]
+        remaining = [0.0] * (len(terms) + 1)
+        for i in range(len(terms) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + terms[i][0]
+
+        def kth_best(scores) -> float:
+            if len(scores) < top_k:
+                return 0.0
+            return heapq.nlargest(top_k, scores.values())[-1]
+
+        # essential terms: walk full postings
+        acc: dict[int, float] = defaultdict(float)
+        walked = 0
+        i = 0
+        while i < len(terms):
+            _, t, c = terms[i]
+            idf = self._idf(t)
+            walked += len(self.inv_index[t])
+            for doc_idx, tf in self.inv_index[t].items():
+                acc[doc_idx] += c * self._weight(idf, tf, doc_idx)
+            i += 1
+            if remaining[i] < kth_best(acc):
+                break  # an unseen doc scores at most remaining[i]
+        candidates = len(acc)
+
+        # non-essential terms: only probe the surviving candidates
+        for j in range(i, len(terms)):
+            _, t, c = terms[j]
+            theta = kth_best(acc)
+            acc = {d: s for d, s in acc.items() if s + remaining[j] >= theta}
+            postings = self.inv_index[t]
+            idf = self._idf(t)
+            walked += len(acc)  # probes
+            for doc_idx in acc:
+                tf = postings.get(doc_idx)
+                if tf:
+                    acc[doc_idx] += c * self._weight(idf, tf, doc_idx)
+
+        count_work(walked, candidates)
+        return heapq.nlargest(top_k, acc.items(), key=lambda x: (x[1], -x[0]))
+
+
+# ── ranking cache ─────────────────────────────────────────
+
+class RankingCache:
+    """
+    Thread-safe LRU of fused rankings, stored as (doc_idx, score, passage
+    spans) triples rather than copies of the documents. Keys carry the index generation,
+    so entries from a previous build can never be served.
+    """
+
+    def __init__(self, max_size: int = RETRIEVAL_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[tuple, list[tuple]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> list[tuple] | None:
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            ranking = self._data.get(key)
+            if ranking is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return ranking
+
+    def put(self, key: tuple, ranking: list[tuple]):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = ranking
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key: tuple) -> bool:
+        # a peek that doesn't count as a hit or miss
+        return key in self._data
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+# ── search results ────────────────────────────────────────
+
+class SearchHit:
+    """
+    One search result: the fields the references panel shows plus the
+    fused score, and the (start, end) content spans of the passages that
+    matched, best first (empty = the whole doc, see passages.with_passages).
+    The content stays in the document store; fetch the full doc with
+    HybridRetriever.get_document() when it's actually needed.
+    """
+
+    __slots__ = ("id", "title", "type", "gene", "score", "references", "passages")
+
+    def __init__(self, doc: dict, score: float, passages: tuple = ()):
+        self.id = doc["id"]
+        self.title = doc["title"]
+        self.type = doc["type"]
+        self.gene = doc.get("gene", "")
+        self.references = doc.get("references", [])
+        self.score = score
+        self.passages = passages
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"SearchHit({self.id!r}, score={self.score})"
 
 
 # ── Hybrid Retriever ──────────────────────────────────────
 
+def index_is_current(manifest: dict) -> bool:
+    """True if an on-disk index manifest matches the configured corpus and settings."""
+    from index_store import source_fingerprint
+
+    return (manifest.get("source") == DOCUMENT_SOURCE
+            and manifest.get("tokenizer", "simple") == TOKENIZER
+            and manifest.get("passages", [0, 0]) == passage_config()
+            and manifest.get("source_fingerprint") == source_fingerprint(DOCUMENT_SOURCE))
+
+
 class HybridRetriever:
     """
     Combines TF-IDF (cosine similarity) and BM25 (keyword matching)
-    using reciprocal rank fusion.
+    using reciprocal rank fusion, plus embedding similarity when a dense
+    index is loaded (DENSE_INDEX_DIR). The index is an immutable base
+    segment plus a delta segment per write, see segments.py.
     """
 
-    def __init__(self):
-        self.documents = []
-        self.tfidf = None
-        self.bm25 = None
+    def __init__(self, engine: str | None = None, pooling: str | None = None):
+        self.engine = engine or RETRIEVER_ENGINE
+        if self.engine not in ENGINES:
+            raise ValueError(
+                f"unknown retriever engine {self.engine!r}, expected one of {ENGINES}"
+            )
+        self.pooling = pooling or PASSAGE_POOLING
+        if self.pooling not in POOLING_MODES:
+            raise ValueError(
+                f"unknown passage pooling {self.pooling!r}, expected one of {POOLING_MODES}"
+            )
+        # everything a search reads; replaced, never changed, by writers
+        self.snapshot = IndexSnapshot()
         self._built = False
-        self.index_size = 0
+        self.cache = RankingCache()
+
+        # writer state: searches don't take the lock or read any of this
+        self._lock = threading.Lock()
+        self._updates = 0  # docs added or deleted since the base was built
+        self._merging = False
+        self._index_path = None  # INDEX_DIR the base was opened from
+        self._manifest = None
+        self._log = None  # segments.WriteLog, see INDEX_WRITE_LOG
+
+    # views of the current snapshot
+    @property
+    def segments(self) -> list[Segment]:
+        return self.snapshot.segments
+
+    @property
+    def generation(self) -> int:
+        """Bumped whenever the index changes; part of every cache key."""
+        return self.snapshot.generation
+
+    @property
+    def index_size(self) -> int:
+        return self.snapshot.index_size
+
+    @property
+    def dense(self):
+        return self.snapshot.dense
+
+    # the base segment's scorers and passage map (bench.py, tests)
+    @property
+    def tfidf(self):
+        return self.segments[0].tfidf if self.segments else None
+
+    @property
+    def bm25(self):
+        return self.segments[0].bm25 if self.segments else None
+
+    @property
+    def passages(self) -> PassageMap:
+        return self.segments[0].passages if self.segments else PassageMap()
 
     def build_index(self):
-        """Load documents, build both indexes."""
-        self.documents = get_all_documents()
-        texts = [self._doc_text(d) for d in self.documents]
+        """Load documents from DOCUMENT_SOURCE, build both indexes in memory."""
+        documents = list(iter_documents(DOCUMENT_SOURCE))
+        scorers = self._build_scorers(documents)
+        with self._lock:
+            self._install(documents, *scorers)
+            self._open_log()
+
+    def _build_scorers(self, documents: list[dict]):
+        """(tfidf, bm25, passages) over the passages of `documents`."""
+        passages = PassageMap()
+        texts = passages.add(documents)
+
+        tfidf_cls, bm25_cls = self._engine_classes()
+
+        # tokenize + count once (sharded across BUILD_WORKERS processes),
+        # shared by both scorers; the csr engine takes postings arrays
+        if hasattr(tfidf_cls, "fit_postings"):
+            postings = count_postings(texts)
+        else:
+            doc_tfs, doc_freq = count_corpus(texts)
 
         # TF-IDF vectorizer (replaces FAISS + sentence-transformers)
-        print("[retriever] building TF-IDF index ...")
-        self.tfidf = TfidfVectorizer()
-        self.tfidf.fit(texts)
-        print(f"[retriever] TF-IDF index built: {len(texts)} docs, {len(self.tfidf.vocab)} terms")
+        print(f"[retriever] building TF-IDF index ({self.engine}) ...")
+        tfidf = tfidf_cls()
+        if hasattr(tfidf_cls, "fit_postings"):
+            tfidf.fit_postings(*postings)
+        else:
+            tfidf.fit_counts(doc_tfs, doc_freq)
+        print(f"[retriever] TF-IDF index built: {len(documents)} docs, "
+              f"{len(texts)} passages, {len(tfidf.vocab)} terms")
 
-        # BM25
-        corpus_tokens = [_tokenize(t) for t in texts]
-        self.bm25 = BM25(corpus_tokens)
-        print(f"[retriever] BM25 index built: {len(corpus_tokens)} docs")
+        # BM25 (the compact engine reuses the TF-IDF postings store)
+        if hasattr(bm25_cls, "from_store"):
+            bm25 = bm25_cls.from_store(tfidf.store)
+        elif hasattr(bm25_cls, "from_postings"):
+            bm25 = bm25_cls.from_postings(*postings)
+        else:
+            bm25 = bm25_cls.from_counts(doc_tfs)
+        print(f"[retriever] BM25 index built: {len(texts)} passages")
+        return tfidf, bm25, passages
 
-        self.index_size = len(self.documents)
+    def _install(self, documents, tfidf, bm25, passages, **prebuilt):
+        """
+        Publish a freshly built base with no deltas; `prebuilt` are the
+        Segment's arrays from an index on disk. Caller holds self._lock.
+        """
+        old = self.snapshot
+        snap = IndexSnapshot([Segment(documents, tfidf, bm25, passages, **prebuilt)], old.generation + 1)
+        if old.dense is not None:
+            snap.dense, snap.dense_slots = old.dense, old.dense.bind(snap.live_ids(), snap.doc_digest)
+        self._updates = 0
+        self._index_path = self._manifest = None
         self._built = True
+        self._publish(snap)
+
+    def _publish(self, snap: IndexSnapshot):
+        """Swap in `snap` and drop rankings of the previous one. Caller holds self._lock."""
+        self.snapshot = snap
+        self.cache.clear()
+
+    def load_index(self, path: str):
+        """
+        Open a prebuilt index from disk (memory-mapped, read-only) as the
+        base segment. Always uses the csr engine, since that's the
+        on-disk layout.
+        """
+        tfidf, bm25, idx = self._open_index(path)
+        manifest = idx["manifest"]
+        with self._lock:
+            self.engine = "csr"
+            self._install(idx["documents"], tfidf, bm25, idx["passages"], **self._prebuilt(idx))
+            self._index_path, self._manifest = path, manifest
+            self._open_log()
+        print(f"[retriever] loaded index from {path}: {manifest['n_docs']} docs, {manifest['n_terms']} terms")
+
+    @staticmethod
+    def _open_index(path: str):
+        """(tfidf, bm25, index_store.load_index() dict) for the index at `path`."""
+        from index_store import load_index
+        from sparse_index import CsrBM25, CsrTfidfVectorizer
+
+        idx = load_index(path)
+        manifest = idx["manifest"]
+        tfidf = CsrTfidfVectorizer.from_index(idx["vocab"], idx["tfidf_idf"], idx["tfidf_matrix"])
+        bm25 = CsrBM25.from_index(
+            idx["vocab"], idx["bm25_idf"], idx["bm25_matrix"], idx["doc_lens"],
+            k1=manifest["k1"], b=manifest["b"],
+        )
+        return tfidf, bm25, idx
+
+    @staticmethod
+    def _prebuilt(idx: dict) -> dict:
+        """Segment arguments an index on disk has precomputed."""
+        return {"ids": idx["id_index"], "filters": idx["filters"], "digests": idx["digests"]}
+
+    def load_or_build(self, path: str | None = None):
+        """
+        Open the on-disk index at `path` (default INDEX_DIR) if it exists
+        and matches the current corpus; otherwise build in memory.
+        """
+        if DENSE_INDEX_DIR:
+            self.load_dense(DENSE_INDEX_DIR)
+
+        path = path if path is not None else INDEX_DIR
+        if not path:
+            self.build_index()
+            return
+
+        from index_store import read_manifest
+
+        manifest = read_manifest(path)
+        if manifest is None:
+            print(f"[retriever] no index at {path}, building in memory")
+            self.build_index()
+        elif not index_is_current(manifest):
+            # writes since the index was built are replayed from INDEX_WRITE_LOG
+            print(f"[retriever] index at {path} is stale, building in memory "
+                  f"(run `python index_store.py build --out {path} --source {DOCUMENT_SOURCE}`)")
+            self.build_index()
+        else:
+            self.load_index(path)
+
+    def load_dense(self, path: str) -> bool:
+        """
+        Attach the embedding index at `path` as a third ranking. A missing
+        or stale index (built from another corpus) is skipped with a
+        warning; the sparse rankings work on their own.
+        """
+        from dense import DenseRetriever
+        from index_store import read_manifest, source_fingerprint
+
+        manifest = read_manifest(path)
+        if manifest is None:
+            print(f"[retriever] no dense index at {path}, dense retrieval off")
+            return False
+        if (manifest.get("source") != DOCUMENT_SOURCE
+                or manifest.get("source_fingerprint") != source_fingerprint(DOCUMENT_SOURCE)):
+            print(f"[retriever] dense index at {path} is stale, dense retrieval off "
+                  f"(run `python dense.py build --out {path} --source {DOCUMENT_SOURCE}`)")
+            return False
+
+        dense = DenseRetriever.open(path)
+        with self._lock:
+            snap = self.snapshot.copy()
+            if snap.dense is not None:
+                snap.dense.close()
+            snap.dense = dense
+            snap.dense_slots = dense.bind(snap.live_ids(), snap.doc_digest) if self._built else dense.bind({})
+            self._publish(snap)
+        print(f"[retriever] loaded dense index from {path}: {manifest['n_docs']} vectors "
+              f"({manifest['model']}, {manifest['dtype']})")
+        return True
+
+    # ── writes ─────────────────────────────────────────────
+
+    def get_document(self, doc_id: str) -> dict | None:
+        """Full stored document by id (O(1) via the id -> slot index)."""
+        docs = self.get_documents([doc_id])
+        return docs[0] if docs else None
+
+    def get_documents(self, doc_ids: list[str]) -> list[dict]:
+        """Full documents for `doc_ids`, in order, skipping ids since deleted."""
+        if not self._built:
+            self.build_index()
+        snap = self.snapshot
+        slots = [snap.slot_of(doc_id) for doc_id in doc_ids]
+        return [snap.doc(slot) for slot in slots if slot is not None]
+
+    def term_weights(self, query: str) -> dict[str, float]:
+        """BM25 IDF of each distinct query token (see context_packer.py)."""
+        if not self._built:
+            self.build_index()
+        segments = self.snapshot.segments
+        # deltas reuse the base's IDF, and add the terms it doesn't know
+        return {t: max(seg.bm25.term_idf(t) for seg in segments) for t in dict.fromkeys(tokenize(query))}
+
+    def add_documents(self, docs: list[dict]) -> int:
+        """
+        Add documents; a doc whose id already exists replaces the old one,
+        which is tombstoned. The new docs get their own delta segment,
+        built before taking the lock, so they're searchable as soon as
+        this returns. With INDEX_WRITE_LOG the write is on disk first.
+        """
+        if not self._built:
+            self.build_index()
+        docs = list({doc["id"]: doc for doc in docs}.values())  # last copy of an id wins
+        if not docs:
+            return 0
+        delta = build_delta(docs, self.snapshot.segments[0])
+        with self._lock:
+            if self._log is not None:
+                self._log.append("add", docs)
+            snap = self.snapshot.copy()
+            self._apply_add(snap, docs, delta)
+            self._publish(snap)
+        self._maybe_merge()
+        return len(docs)
+
+    def delete_documents(self, doc_ids: list[str]) -> int:
+        """Delete documents by id. Returns how many existed."""
+        if not self._built:
+            self.build_index()
+        with self._lock:
+            existing = [doc_id for doc_id in dict.fromkeys(doc_ids)
+                        if self.snapshot.slot_of(doc_id) is not None]
+            if existing:
+                if self._log is not None:
+                    self._log.append("delete", existing)
+                snap = self.snapshot.copy()
+                self._apply_delete(snap, existing)
+                self._publish(snap)
+        self._maybe_merge()
+        return len(existing)
+
+    def _apply_add(self, snap: IndexSnapshot, docs: list[dict], delta: Segment):
+        self._apply_delete(snap, [doc["id"] for doc in docs])
+        start = snap.n_slots
+        snap.append(delta)
+        for offset, doc in enumerate(docs):
+            snap.overlay[doc["id"]] = start + offset
+        if snap.dense is not None:
+            rows = [(snap.dense.row_of(doc["id"]), start + offset) for offset, doc in enumerate(docs)]
+            rows = [(row, slot) for row, slot in rows if row is not None]
+            if rows:
+                # a re-added doc moved to a new slot: its vector follows it
+                # if it encodes this content, else the row is tombstoned
+                snap.dense_slots = snap.dense_slots.copy()
+                for row, slot in rows:
+                    current = snap.dense.encodes(row, snap.doc_digest(slot))
+                    snap.dense_slots[row] = slot if current else -1
+        self._updates += len(docs)
+        snap.index_size += len(docs)
+
+    def _apply_delete(self, snap: IndexSnapshot, doc_ids: list[str]) -> int:
+        n = 0
+        for doc_id in doc_ids:
+            slot = snap.slot_of(doc_id)
+            if slot is None:
+                continue
+            snap.tombstone(slot)
+            snap.overlay[doc_id] = None
+            n += 1
+        self._updates += n
+        snap.index_size -= n
+        return n
+
+    def _open_log(self):
+        """Replay INDEX_WRITE_LOG onto the base just installed, then log to it. Caller holds self._lock."""
+        if not INDEX_WRITE_LOG:
+            return
+        if self._log is None:
+            self._log = WriteLog(INDEX_WRITE_LOG)
+        start = 0
+        held = (self._manifest or {}).get("write_log")
+        if held and self._log.digest(held["bytes"]) == held["sha256"]:
+            start = held["bytes"]  # a merge built this base from the log up to there
+        deleted, added = net_writes(self._log.read(start))
+        if not deleted:
+            return
+        snap = self.snapshot.copy()
+        self._apply_delete(snap, deleted)
+        if added:
+            self._apply_add(snap, added, build_delta(added, snap.segments[0]))
+        self._publish(snap)
+        print(f"[retriever] replayed {INDEX_WRITE_LOG}: {len(added)} docs written, "
+              f"{len(deleted) - len(added)} deleted")
+
+    # ── merges ─────────────────────────────────────────────
+
+    def _maybe_merge(self):
+        with self._lock:
+            if self._merging:
+                return
+            threshold = max(INDEX_MERGE_MIN_UPDATES, INDEX_MERGE_RATIO * self.index_size)
+            if self._updates >= threshold:
+                first = 0
+            elif len(self.segments) - 1 > INDEX_MAX_DELTAS:
+                first = 1
+            else:
+                return
+            self._merging = True  # claimed here, so concurrent writers start one merge
+        threading.Thread(target=self._merge, args=(first,), name="index-merge", daemon=True).start()
+
+    def merge(self, first: int = 0):
+        """
+        Compact segments[first:] into one. first=0 builds a new base from
+        the live documents, which drops dead slots and refreshes every
+        weight against the current corpus; when the base came from
+        INDEX_DIR it's rebuilt there. first=1 folds the deltas into one.
+        Runs without holding the lock: writes that arrive meanwhile add
+        deltas or tombstones, which are carried over when the merged
+        segment is swapped in.
+        """
+        with self._lock:
+            if self._merging or len(self.snapshot.segments) <= first:
+                return
+            self._merging = True
+        self._merge(first)
+
+    def _merge(self, first: int):
+        """merge(), once the caller has set self._merging."""
+        with self._lock:
+            snap = self.snapshot
+            last = len(snap.segments)
+            updates = self._updates
+            log_offset = self._log.tell() if self._log is not None and first == 0 else None
+        segments, doc_base = snap.segments[first:], snap.doc_base[first:]
+        slots = [s for s in range(doc_base[0], snap.n_slots) if not snap.is_dead(s)]
+        ids: list[str] = []
+
+        def live_docs():
+            for slot in slots:
+                i = bisect_right(doc_base, slot) - 1
+                doc = segments[i].documents[slot - doc_base[i]]
+                ids.append(doc["id"])
+                yield doc
+
+        try:
+            # the log's writes up to log_offset, netted: what the new base holds
+            held = self._log.compacted(log_offset) if log_offset is not None else None
+            if first:
+                docs = list(live_docs())
+                merged = build_delta(docs, snap.segments[0])
+            elif self._index_path is not None:
+                merged = self._rebuild_on_disk(live_docs(), held)
+            else:
+                docs = list(live_docs())
+                merged = Segment(docs, *self._build_scorers(docs))
+        except Exception:
+            with self._lock:
+                self._merging = False
+            raise
+
+        with self._lock:
+            self._publish(self._merged(self.snapshot, first, last, merged, slots, ids))
+            if first == 0:
+                self._updates -= updates
+                if held is not None:
+                    # netted, not dropped: a base rebuilt from the source
+                    # still needs them (see _open_log)
+                    self._log.compact(log_offset, held)
+            self._merging = False
+        what = "base" if first == 0 else "deltas"
+        print(f"[retriever] merged {what}: {len(slots)} docs, {len(self.segments) - 1} deltas left")
+        self._maybe_merge()
+
+    def _rebuild_on_disk(self, documents, held: bytes | None) -> Segment:
+        """
+        Build a new base into the INDEX_DIR the current one came from and
+        open it. `held` is the compacted write log prefix it includes.
+        """
+        from index_builder import build_index_streaming
+
+        manifest = self._manifest
+        write_log = None
+        if held is not None:
+            write_log = {"bytes": len(held), "sha256": hashlib.sha256(held).hexdigest()}
+        build_index_streaming(
+            manifest["source"], self._index_path, documents=documents,
+            fingerprint=manifest.get("source_fingerprint"), write_log=write_log,
+        )
+        tfidf, bm25, idx = self._open_index(self._index_path)
+        self._manifest = idx["manifest"]
+        return Segment(idx["documents"], tfidf, bm25, idx["passages"], **self._prebuilt(idx))
+
+    @staticmethod
+    def _merged(
+        snap: IndexSnapshot, first: int, last: int, merged: Segment, slots: list[int], ids: list[str]
+    ) -> IndexSnapshot:
+        """
+        `snap` with segments[first:last] replaced by `merged`, which was
+        built from the docs at `slots` (whose ids are `ids`).
+        """
+        start = snap.doc_base[first]
+        tail_start = snap.doc_base[last] if last < len(snap.segments) else snap.n_slots
+        shift = start + merged.n_docs - tail_start  # for slots of deltas added since
+        moved = {old: start + i for i, old in enumerate(slots)}
+
+        # killed during the merge: their merged copies are dead too
+        dead = [s if s < start else s + shift for s in snap.dead_slots() if s < start or s >= tail_start]
+        dead.extend(moved[s] for s in slots if snap.is_dead(s))
+
+        overlay = {}
+        for doc_id, slot in snap.overlay.items():
+            if slot is None:
+                # a base merge only needs the deletes of ids the new base still has
+                if first or merged.slot_of(doc_id) is not None:
+                    overlay[doc_id] = None
+            elif slot >= tail_start:
+                overlay[doc_id] = slot + shift
+            elif slot < start:
+                overlay[doc_id] = slot
+            elif first:
+                overlay[doc_id] = moved[slot]
+            # else: the new base's id index has it
+
+        new = IndexSnapshot(generation=snap.generation + 1)
+        for segment in [*snap.segments[:first], merged, *snap.segments[last:]]:
+            new.append(segment)
+        new.overlay = overlay
+        for slot in dead:
+            new.tombstone(slot)
+        new.index_size = snap.index_size
+        if snap.dense is not None:
+            new.dense, new.dense_slots = snap.dense, snap.dense.bind(new.live_ids(), new.doc_digest)
+        return new
+
+    def _engine_classes(self):
+        """(tfidf_cls, bm25_cls) for the configured engine."""
+        if self.engine == "csr":
+            # imported lazily so the dict engine works without numpy/scipy
+            from sparse_index import CsrBM25, CsrTfidfVectorizer
+            return CsrTfidfVectorizer, CsrBM25
+        if self.engine == "compact":
+            from postings import CompactBM25, CompactTfidfVectorizer
+            return CompactTfidfVectorizer, CompactBM25
+        return TfidfVectorizer, BM25
 
     @staticmethod
     def _doc_text(doc: dict) -> str:
         """Concatenate searchable fields into one string."""
         return f"{doc['title']} {doc.get('gene', '')} {doc['content']}"
 
-    def search(self, query: str, top_k: int = 5) -> list[dict]:
+    # ── search ─────────────────────────────────────────────
+
+    def search(
+        self, query: str, top_k: int = 5, filters: dict | None = None, use_cache: bool = True
+    ) -> list[SearchHit]:
         """
-        Run hybrid search and return top_k documents with scores.
+        Run hybrid search and return the top_k hits with scores.
+        `filters` restricts the search to docs matching metadata, e.g.
+        {"gene": "BRCA1"} or {"gene": ["KRAS", "BRAF"], "type": "therapeutic"}.
+        """
+        return self.search_many([query], top_k=top_k, filters=filters, use_cache=use_cache)[0]
+
+    def search_many(
+        self, queries: list[str], top_k: int = 5, filters: dict | None = None, use_cache: bool = True
+    ) -> list[list[SearchHit]]:
+        """
+        Hybrid search for a batch of queries. Cache misses are scored
+        together: with the csr engine that's one sparse query-matrix x
+        postings product per scorer instead of one per query. With
+        `filters` (shared by the whole batch) every scorer only looks at
+        the matching docs. use_cache=False scores every query afresh
+        (the results still refresh the cache). Takes no lock: the whole
+        batch reads the snapshot current when it starts.
         """
         if not self._built:
             self.build_index()
 
-        # ── dense-ish retrieval (TF-IDF cosine) ───────────
-        dense_ranking = self.tfidf.query(query, top_k=top_k * 2)
+        snap = self.snapshot
+        t_start = time.perf_counter()
+        filter_key = None
+        if filters:
+            from filters import normalize_filters
+            filter_key = normalize_filters(filters)  # ValueError on unknown fields
+
+        # tokenize once, shared by both scorers and the cache key
+        token_lists = [tokenize(q) for q in queries]
+        t0 = time.perf_counter()
+        metrics.TOKENIZE_SECONDS.observe(t0 - t_start)
 
-        # ── sparse retrieval (BM25) ───────────────────────
-        q_tokens = _tokenize(query)
-        sparse_ranking = self.bm25.score(q_tokens, top_k=top_k * 2)
+        keys = [(snap.generation, tuple(tokens), top_k, filter_key) for tokens in token_lists]
+        fused_by_key = {}
+        for key in keys:
+            if key not in fused_by_key:
+                fused_by_key[key] = self.cache.get(key) if use_cache else None
 
-        # ── reciprocal rank fusion ─────────────────────────
-        fused = self._rrf(dense_ranking, sparse_ranking, k=60)
+        missing = [key for key, fused in fused_by_key.items() if fused is None]
+        if missing:
+            miss_tokens = [list(key[1]) for key in missing]
+            allowed = [seg.select(filter_key) if filter_key else None for seg in snap.segments]
+            # ── embedding retrieval (optional) ────────────────
+            vector_rankings = [[] for _ in missing]
+            t0 = time.perf_counter()
+            if snap.dense is not None:
+                text_of = dict(zip(map(tuple, token_lists), queries))
+                vectors = snap.dense.encode([text_of[key[1]] for key in missing])
+                dense_allowed = self._global_filter(snap, allowed) if filter_key else None
+                vector_rankings = [
+                    [(i, s) for i, s in snap.dense.search(vector, top_k * 2, snap.dense_slots, dense_allowed)
+                     if not snap.is_dead(i)]
+                    for vector in vectors
+                ]
+                metrics.DENSE_SECONDS.observe(time.perf_counter() - t0)
+            # ── TF-IDF cosine and BM25, per segment ───────────
+            dense_rankings, sparse_rankings = self._score_segments(snap, miss_tokens, top_k, allowed)
+            t0 = time.perf_counter()
+            for key, (dense, dense_rows), (sparse, sparse_rows), vector in zip(
+                missing, dense_rankings, sparse_rankings, vector_rankings
+            ):
+                # ── reciprocal rank fusion ─────────────────────────
+                fused = self._rrf(dense[:top_k * 2], sparse[:top_k * 2], vector, k=60)
+                fused = [
+                    (i, s, self._hit_spans(snap, i, dense_rows, sparse_rows)) for i, s in fused[:top_k]
+                ]
+                self.cache.put(key, fused)
+                fused_by_key[key] = fused
+            metrics.FUSION_SECONDS.observe(time.perf_counter() - t0)
 
         # assemble results
-        results = []
-        for doc_idx, rrf_score in fused[:top_k]:
-            if 0 <= doc_idx < len(self.documents):
-                doc = self.documents[doc_idx].copy()
-                doc["score"] = round(rrf_score, 4)
-                results.append(doc)
+        results = [
+            [SearchHit(snap.doc(doc_idx), round(rrf_score, 4), spans)
+             for doc_idx, rrf_score, spans in fused_by_key[key]]
+            for key in keys
+        ]
+        metrics.SEARCH_SECONDS.observe(time.perf_counter() - t_start)
         return results
 
+    def _score_segments(self, snap: IndexSnapshot, token_lists: list[list[str]], top_k: int, allowed: list):
+        """
+        TF-IDF and BM25 doc rankings of each query over every segment,
+        with each doc's matched rows: ([(ranking, rows)], [(ranking, rows)]).
+        Slots and rows are global; tombstoned docs are left out.
+        """
+        tfidf_time = bm25_time = 0.0
+        dense = [([], {}) for _ in token_lists]
+        sparse = [([], {}) for _ in token_lists]
+        for i, seg in enumerate(snap.segments):
+            if not seg.n_rows:
+                continue
+            # the scorers rank passages; fetch deeper when docs have several,
+            # so pooling still finds top_k * 2 docs, and past the dead rows
+            depth = top_k * 2 if seg.passages.identity else top_k * 2 * POOL_DEPTH
+            row_allowed = seg.passages.expand(allowed[i]) if allowed[i] is not None else None
+            t0 = time.perf_counter()
+            tfidf = self._batch(
+                seg.tfidf, "query_many", "query_tokens", token_lists, depth + snap.dead_rows[i], row_allowed
+            )
+            t1 = time.perf_counter()
+            bm25 = self._batch(
+                seg.bm25, "score_many", "score", token_lists, depth + snap.dead_rows[i], row_allowed
+            )
+            tfidf_time += t1 - t0
+            bm25_time += time.perf_counter() - t1
+            for out, rankings in ((dense, tfidf), (sparse, bm25)):
+                for q, ranking in enumerate(rankings):
+                    out[q] = self._merge_pooled(out[q], self._pool(snap, i, ranking, depth))
+        metrics.TFIDF_SECONDS.observe(tfidf_time)
+        metrics.BM25_SECONDS.observe(bm25_time)
+        return dense, sparse
+
+    def _pool(self, snap: IndexSnapshot, i: int, ranking: list[tuple[int, float]], depth: int):
+        """Segment i's (row, score) ranking -> (doc ranking, matched rows), globally numbered."""
+        seg = snap.segments[i]
+        doc_base, row_base = snap.doc_base[i], snap.row_base[i]
+        if snap.dead_rows[i]:
+            row_doc = seg.passages.row_doc
+            ranking = [
+                (row, s) for row, s in ranking if not snap.is_dead(doc_base + int(row_doc[row]))
+            ][:depth]
+        docs, rows = seg.passages.pool(ranking, self.pooling)
+        if not doc_base and not row_base:
+            return docs, rows
+        return (
+            [(d + doc_base, s) for d, s in docs],
+            {d + doc_base: [r + row_base for r in matched] for d, matched in rows.items()},
+        )
+
+    @staticmethod
+    def _merge_pooled(a, b):
+        """Merge two (doc ranking, matched rows) pairs over disjoint docs."""
+        if not a[0]:
+            return b
+        if not b[0]:
+            return a
+        ranking = sorted(a[0] + b[0], key=lambda x: (-x[1], x[0]))
+        return ranking, {**a[1], **b[1]}
+
+    @staticmethod
+    def _global_filter(snap: IndexSnapshot, allowed: list):
+        """One filters.DocFilter over all slots from the per-segment ones (for dense)."""
+        import numpy as np
+        from filters import DocFilter
+
+        ids = np.concatenate([f.ids + base for f, base in zip(allowed, snap.doc_base)])
+        return DocFilter(ids.astype(np.int32), snap.n_slots)
+
+    @staticmethod
+    def _hit_spans(snap: IndexSnapshot, doc_idx: int, *row_lists: dict[int, list[int]]) -> tuple:
+        """Content spans of the passages that matched `doc_idx`, best first."""
+        i = snap.segment_of(doc_idx)
+        passages = snap.segments[i].passages
+        if passages.identity:
+            return ()  # every doc is one passage: the whole content
+        rows = []
+        for rank in range(max((len(r.get(doc_idx, ())) for r in row_lists), default=0)):
+            for r in row_lists:
+                matched = r.get(doc_idx, ())
+                if rank < len(matched) and matched[rank] not in rows:
+                    rows.append(matched[rank])
+        row_base = snap.row_base[i]
+        return tuple(passages.span(row - row_base) for row in rows[:PASSAGES_PER_HIT])
+
+    @staticmethod
+    def _batch(scorer, many: str, one: str, token_lists: list[list[str]], top_k: int, allowed=None):
+        """Use the scorer's batched method when it has one, else loop."""
+        if allowed is not None:
+            return [getattr(scorer, one)(t, top_k=top_k, allowed=allowed) for t in token_lists]
+        if hasattr(scorer, many):
+            return getattr(scorer, many)(token_lists, top_k=top_k)
+        return [getattr(scorer, one)(tokens, top_k=top_k) for tokens in token_lists]
+
     @staticmethod
     def _rrf(
         *rankings: list[tuple[int, float]], k: int = 60
@@ -0,0 +1,272 @@
+"""
+Segmented index for live writes, LSM-style.
+
+The index is one immutable base segment (built in memory, or opened
+from INDEX_DIR) plus small delta segments, one per write. Nothing is
+ever modified in place. An add builds a new delta from just the new
+documents, so it's searchable as soon as the write returns. A delete,
+or the old copy of a replaced document, is tombstoned by doc slot.
+Searches score every segment and merge the rankings, skipping
+tombstoned rows. What they read is an IndexSnapshot, published
+copy-on-write, so they never wait for a write or a merge.
+
+Deltas use the dict engine and score against the base's term
+statistics: IDF of the terms the base knows, and its average passage
+length. That keeps their scores on the same scale as the base's
+precomputed weights. Terms the base has never seen get an IDF from the
+delta's own counts over the combined corpus size.
+
+HybridRetriever.merge() compacts in the background:
+
+    too many deltas (INDEX_MAX_DELTAS)   the deltas become one delta
+    enough writes (INDEX_MERGE_*)        everything becomes a new base:
+                                         weights refreshed, dead slots gone
+
+With INDEX_WRITE_LOG set, every write is appended to that file and
+fsync'd before it's acknowledged (WriteLog), and replayed on startup.
+A base merge compacts the log: the writes it held are netted into at
+most two lines (WriteLog.compact), so it stays as small as the set of
+ids ever written, but never drops a write. The log is the only copy of
+those writes that survives a rebuild from the document source (a stale
+INDEX_DIR, or `index_store.py build`), which is why it's replayed on top
+of whatever base is opened. A base opened from INDEX_DIR is merged back
+into INDEX_DIR, and its manifest records the compacted log prefix it
+already holds, so a restart replays only the writes after it.
+"""
+
+import hashlib
+import json
+import os
+from bisect import bisect_right
+
+from embeddings import TfidfVectorizer
+from passages import PassageMap
+from tokenizer import count_terms, tokenize
+
+
+class Segment:
+    """Documents plus the passage map and scorers built over them. Immutable."""
+
+    def __init__(self, documents, tfidf, bm25, passages: PassageMap, ids=None, filters=None, digests=None):
+        self.documents = documents  # list of dicts, or index_store.DocStore
+        self.tfidf = tfidf
+        self.bm25 = bm25
+        self.passages = passages
+        self.n_docs = len(documents)
+        self.n_rows = len(passages)
+        # id -> local slot: an index_store.MmapIdIndex, or built on first use
+        self._ids = ids
+        # filters.FilterIndex: index_store.MmapFilterIndex, or built on
+        # first filtered search
+        self._filters = filters
+        # index_store.doc_digest() per local slot: memory-mapped, or hashed
+        # on first use (only with a dense index, see dense.DenseIndex.bind)
+        self._digests = digests
+
+    def slot_of(self, doc_id: str) -> int | None:
+        if self._ids is None:
+            self._ids = {doc["id"]: i for i, doc in enumerate(self.documents)}
+        return self._ids.get(doc_id)
+
+    def id_items(self):
+        """(doc id, local slot) of every document."""
+        if self._ids is None:
+            self.slot_of("")
+        return self._ids.items()
+
+    def digest(self, slot: int) -> int:
+        if self._digests is None:
+            from index_store import doc_digest
+            self._digests = [doc_digest(doc) for doc in self.documents]
+        return int(self._digests[slot])
+
+    def select(self, filter_key: tuple):
+        """filters.DocFilter of the local doc slots matching a normalize_filters() key."""
+        if self._filters is None:
+            from filters import FilterIndex
+            self._filters = FilterIndex(self.documents)
+        return self._filters.select(filter_key)
+
+
+class IndexSnapshot:
+    """
+    The segments plus the write state over them: tombstones, and where
+    each id written since the base was built now lives. Published
+    copy-on-write: a writer copy()s the current snapshot, changes the
+    copy and swaps it in with one assignment, so searches read whichever
+    snapshot they picked up without a lock.
+    """
+
+    def __init__(self, segments=(), generation: int = 0):
+        self.segments: list[Segment] = []  # the base, then one delta per write
+        self.doc_base: list[int] = []  # first doc slot of each segment
+        self.row_base: list[int] = []  # first passage row of each segment
+        self.n_slots = 0
+        self.n_rows = 0
+        self.dead = bytearray()  # tombstone bitset over doc slots
+        self.dead_rows: list[int] = []  # tombstoned passage rows, per segment
+        # ids written since the base was built -> slot (None = deleted);
+        # any other id is looked up in the base segment
+        self.overlay: dict[str, int | None] = {}
+        self.index_size = 0  # live docs
+        self.dense = None  # dense.DenseRetriever, see HybridRetriever.load_dense()
+        self.dense_slots = None  # its vector row -> doc slot, see dense.DenseIndex.bind()
+        self.generation = generation
+        for segment in segments:
+            self.append(segment)
+            self.index_size += segment.n_docs
+
+    def copy(self) -> "IndexSnapshot":
+        """A private copy to change and publish, one generation on."""
+        new = IndexSnapshot.__new__(IndexSnapshot)
+        new.__dict__.update(self.__dict__)
+        for name in ("segments", "doc_base", "row_base", "dead_rows"):
+            setattr(new, name, list(getattr(self, name)))
+        new.dead = bytearray(self.dead)
+        new.overlay = dict(self.overlay)
+        new.generation = self.generation + 1
+        return new
+
+    def append(self, segment: Segment):
+        self.segments.append(segment)
+        self.doc_base.append(self.n_slots)
+        self.row_base.append(self.n_rows)
+        self.dead_rows.append(0)
+        self.n_slots += segment.n_docs
+        self.n_rows += segment.n_rows
+        self.dead.extend(bytes((self.n_slots + 7) // 8 - len(self.dead)))
+
+    def is_dead(self, slot: int) -> bool:
+        return self.dead[slot >> 3] >> (slot & 7) & 1 == 1
+
+    def tombstone(self, slot: int):
+        i = self.segment_of(slot)
+        self.dead[slot >> 3] |= 1 << (slot & 7)
+        self.dead_rows[i] += len(self.segments[i].passages.rows(slot - self.doc_base[i]))
+
+    def dead_slots(self):
+        for i, byte in enumerate(self.dead):
+            if byte:
+                yield from (i * 8 + bit for bit in range(8) if byte >> bit & 1)
+
+    def segment_of(self, slot: int) -> int:
+        return bisect_right(self.doc_base, slot) - 1
+
+    def doc(self, slot: int) -> dict:
+        i = self.segment_of(slot)
+        return self.segments[i].documents[slot - self.doc_base[i]]
+
+    def doc_digest(self, slot: int) -> int:
+        i = self.segment_of(slot)
+        return self.segments[i].digest(slot - self.doc_base[i])
+
+    def slot_of(self, doc_id: str) -> int | None:
+        """Slot of the live copy of `doc_id`, or None."""
+        slot = self.overlay.get(doc_id, -1)
+        if slot == -1:
+            slot = self.segments[0].slot_of(doc_id) if self.segments else None
+        return None if slot is None else int(slot)
+
+    def live_ids(self) -> dict[str, int]:
+        """doc id -> slot of every live document (for dense.DenseIndex.bind)."""
+        ids = {doc_id: int(slot) for doc_id, slot in self.segments[0].id_items()
+               if doc_id not in self.overlay}
+        ids.update((doc_id, slot) for doc_id, slot in self.overlay.items() if slot is not None)
+        return ids
+
+
+def build_delta(documents: list[dict], base: Segment | None) -> Segment:
+    """A dict-engine segment over `documents`, scored with `base`'s term statistics."""
+    from retriever import BM25  # retriever imports this module
+
+    passages = PassageMap()
+    texts = passages.add(documents)
+    doc_tfs = [count_terms(tokenize(text)) for text in texts]
+    tfidf = TfidfVectorizer()
+    tfidf.fit_counts(doc_tfs, reference=base.tfidf if base is not None else None)
+    bm25 = BM25.from_counts(doc_tfs, reference=base.bm25 if base is not None else None)
+    return Segment(documents, tfidf, bm25, passages)
+
+
+def net_writes(entries) -> tuple[list[str], list[dict]]:
+    """
+    Collapse a sequence of ("add", docs) / ("delete", ids) writes into
+    (ids to delete, docs to add): the same end state in one step.
+    """
+    state: dict[str, dict | None] = {}
+    for op, arg in entries:
+        for item in arg:
+            doc_id = item["id"] if op == "add" else item
+            state.pop(doc_id, None)  # re-insert, so the last write decides the order
+            state[doc_id] = item if op == "add" else None
+    return list(state), [doc for doc in state.values() if doc is not None]
+
+
+class WriteLog:
+    """
+    Append-only JSONL log of document writes, one {"op": "add", "docs":
+    [...]} or {"op": "delete", "ids": [...]} per line. Replaying it is
+    idempotent (adds replace by id), so a crash between publishing a
+    merged index and truncating the log is harmless.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "ab")
+
+    def append(self, op: str, arg: list):
+        key = "docs" if op == "add" else "ids"
+        line = json.dumps({"op": op, key: arg}, ensure_ascii=False).encode() + b"\n"
+        self._file.write(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def read(self, start: int = 0, end: int | None = None) -> list[tuple[str, list]]:
+        """The writes logged between byte offsets `start` and `end` (default: the end)."""
+        entries = []
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            data = f.read() if end is None else f.read(end - start)
+        for line in data.splitlines(keepends=True):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break  # torn last line from a crash mid-append
+            op = entry.get("op")
+            entries.append((op, entry["docs"] if op == "add" else entry["ids"]))
+        return entries
+
+    def compacted(self, end: int) -> bytes:
+        """The writes before offset `end`, netted (see net_writes) into at most two log lines."""
+        deleted, added = net_writes(self.read(end=end))
+        added_ids = {doc["id"] for doc in added}
+        lines = []
+        if len(deleted) > len(added):
+            lines.append({"op": "delete", "ids": [i for i in deleted if i not in added_ids]})
+        if added:
+            lines.append({"op": "add", "docs": added})
+        return b"".join(json.dumps(line, ensure_ascii=False).encode() + b"\n" for line in lines)
+
+    def digest(self, n: int) -> str:
+        """sha256 of the first `n` bytes (see HybridRetriever.merge)."""
+        with open(self.path, "rb") as f:
+            return hashlib.sha256(f.read(n)).hexdigest()
+
+    def compact(self, end: int, prefix: bytes):
+        """Replace the first `end` bytes with `prefix`, their compacted() form."""
+        tmp = f"{self.path}.tmp-{os.getpid()}"
+        with open(self.path, "rb") as src, open(tmp, "wb") as dst:
+            dst.write(prefix)
+            src.seek(end)
+            dst.write(src.read())
+            dst.flush()
+            os.fsync(dst.fileno())
+        self._file.close()
+        os.replace(tmp, self.path)
+        self._file = open(self.path, "ab")
+
+    def close(self):
+        self._file.close()
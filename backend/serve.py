@@ -0,0 +1,109 @@
+"""
+Multi-worker launcher with one shared index.
+
+`uvicorn main:app --workers N` on its own builds the index N times, once
+per worker, and memory grows linearly with N. This launcher builds the
+on-disk index once in the parent (index_builder.py), then starts the
+workers with INDEX_DIR pointing at it. Every worker memory-maps the same
+read-only files: postings, weights, vocab, doc store, id index and
+passage map. The kernel keeps one copy of their pages for all workers.
+By default the index goes to /dev/shm (tmpfs), so even the first worker
+never reads it from disk.
+
+    python serve.py --workers 4 [--port 8000] [--index-dir PATH] [--rebuild]
+
+A current index at --index-dir (same source, tokenizer, passage window
+and fingerprint) is reused, so restarts skip the build. A write through
+POST/DELETE /documents would only reach the worker that received it, so
+with more than one worker they are turned off (INDEX_WRITES=false, the
+endpoints answer 409). Rebuild to change the corpus, or run one worker.
+
+With one worker, writes are fsync'd to INDEX_WRITE_LOG, which defaults
+to a file next to the index. On /dev/shm that file is gone after a
+reboot, so there writes stay off unless INDEX_WRITE_LOG is set to a path
+on disk. The index itself can live on tmpfs: after a reboot it's rebuilt
+from the source and the log is replayed on top (see segments.py).
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", str(os.cpu_count() or 1)))
+
+
+def default_index_dir() -> str:
+    if os.getenv("INDEX_DIR"):
+        return os.environ["INDEX_DIR"]
+    if os.path.isdir("/dev/shm"):
+        return f"/dev/shm/gciqs-index-{os.getuid()}"
+    return "data/index"
+
+
+def on_tmpfs(path: str) -> bool:
+    return os.path.abspath(path).startswith("/dev/shm" + os.sep)
+
+
+def prepare_index(path: str, rebuild: bool = False) -> dict:
+    """Build the shared index at `path` unless a current one is there. Returns its manifest."""
+    from doc_sources import DOCUMENT_SOURCE
+    from index_store import read_manifest
+    from retriever import index_is_current
+
+    manifest = read_manifest(path)
+    if manifest is not None and not rebuild and index_is_current(manifest):
+        print(f"[serve] reusing index at {path}: {manifest['n_docs']} docs")
+        return manifest
+
+    # build in a child process, so the build's peak memory is returned to
+    # the OS instead of staying in the long-lived parent
+    t0 = time.time()
+    print(f"[serve] building shared index at {path} from {DOCUMENT_SOURCE} ...")
+    builder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index_store.py")
+    subprocess.run(
+        [sys.executable, builder, "build", "--out", path, "--source", DOCUMENT_SOURCE], check=True
+    )
+    manifest = read_manifest(path)
+    print(f"[serve] index built: {manifest['n_docs']} docs ({time.time() - t0:.1f}s)")
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the API from N workers sharing one index.")
+    parser.add_argument("--workers", type=int, default=WEB_WORKERS)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--index-dir", default=default_index_dir())
+    parser.add_argument("--rebuild", action="store_true", help="rebuild even if the index is current")
+    args = parser.parse_args(argv)
+
+    # set before anything imports retriever (which reads it at import):
+    # workers inherit the environment, so each one's load_or_build()
+    # maps this index instead of building its own
+    os.environ["INDEX_DIR"] = args.index_dir
+    if args.workers > 1:
+        os.environ["INDEX_WRITES"] = "false"
+        print(f"[serve] {args.workers} workers: POST/DELETE /documents disabled")
+    elif os.getenv("INDEX_WRITES", "true").lower() in ("1", "true", "yes"):
+        write_log = os.getenv("INDEX_WRITE_LOG") or f"{args.index_dir.rstrip(os.sep)}.writes.jsonl"
+        if on_tmpfs(write_log):
+            # acknowledged writes must survive a reboot
+            os.environ["INDEX_WRITES"] = "false"
+            print(f"[serve] write log {write_log} is on tmpfs: POST/DELETE /documents disabled "
+                  f"(set INDEX_WRITE_LOG to a path on disk to enable them)")
+    prepare_index(args.index_dir, rebuild=args.rebuild)
+
+    import uvicorn
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Single-flight request coalescing for the event loop.
+
+Concurrent callers asking for the same key share one run of the work:
+the first caller starts the source (an async iterator) as a task, and
+every caller, including the first, gets its own subscriber queue that
+the task broadcasts each item to. A caller that joins late is replayed
+the items already produced before it sees live ones, so every subscriber
+receives the full sequence.
+
+A flight ends when its source is exhausted; the next caller for that key
+starts a new one (by then the answer cache usually has it). If every
+subscriber disconnects first, the source is cancelled, so an abandoned
+upstream stream isn't kept open for nobody.
+
+Everything runs on the event loop thread, so no locks are needed.
+"""
+
+import asyncio
+from typing import AsyncIterator, Callable, Hashable
+
+_END = object()  # end-of-flight marker on subscriber queues
+
+
+class _Flight:
+    def __init__(self):
+        self.history: list = []
+        self.subscribers: set[asyncio.Queue] = set()
+        self.done = False
+        self.task: asyncio.Task | None = None
+
+    def publish(self, item):
+        self.history.append(item)
+        for queue in self.subscribers:
+            queue.put_nowait(item)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in self.history:  # replay for late joiners
+            queue.put_nowait(item)
+        if self.done:
+            queue.put_nowait(_END)
+        self.subscribers.add(queue)
+        return queue
+
+    def finish(self):
+        self.done = True
+        for queue in self.subscribers:
+            queue.put_nowait(_END)
+
+
+class SingleFlight:
+    """Deduplicates concurrent async streams by key."""
+
+    def __init__(self, name: str = "singleflight"):
+        self.name = name
+        self.started = 0  # flights that ran the source
+        self.joined = 0   # callers that piggybacked on a running flight
+        self._flights: dict[Hashable, _Flight] = {}
+
+    async def stream(
+        self, key: Hashable, source: Callable[[], AsyncIterator]
+    ) -> AsyncIterator:
+        """
+        Items of `source()`, shared with every concurrent caller of the
+        same key. `source` is only called when no flight for `key` is
+        running.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, source()))
+            self.started += 1
+        else:
+            self.joined += 1
+
+        queue = flight.subscribe()
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    return
+                yield item
+        finally:
+            flight.subscribers.discard(queue)
+            if not flight.subscribers and not flight.done:
+                # nobody is listening any more: stop the upstream work
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    async def _run(self, key: Hashable, flight: _Flight, source: AsyncIterator):
+        try:
+            async for item in source:
+                flight.publish(item)
+        except asyncio.CancelledError:
+            # the last subscriber left, or the loop is shutting down: any
+            # subscriber still gets _END (below), and the task ends cancelled
+            raise
+        except Exception as e:
+            # sources report their own errors as items; this is a bug
+            print(f"[{self.name}] flight {key!r} failed: {e!r}")
+        finally:
+            self._forget(key, flight)
+            flight.finish()
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._flights), "started": self.started, "joined": self.joined}
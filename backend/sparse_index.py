@@ -0,0 +1,323 @@
+"""
+Array-backed scoring engine for TF-IDF and BM25.
+
+Same interface as embeddings.TfidfVectorizer and retriever.BM25, but
+terms are interned to integer ids and the weights live in a scipy CSR
+matrix with one row per term (i.e. the row slice *is* the postings
+list). Scoring a query is a sparse (1 x V) @ (V x N) product, so only
+the postings of query terms are touched, and top-k uses argpartition
+instead of a full sort. Batches of queries are one (Q x V) @ (V x N)
+product.
+"""
+
+import math
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+from profiler import count_work
+from tokenizer import count_terms, tokenize
+
+WEIGHT_DTYPE = np.float32
+INDEX_DTYPE = np.int32
+
+
+def _build_vocab(doc_tfs: list[dict[str, int]]) -> dict[str, int]:
+    """Sorted token -> id map, same ordering as TfidfVectorizer.vocab."""
+    seen = set()
+    for tf in doc_tfs:
+        seen.update(tf)
+    return {t: i for i, t in enumerate(sorted(seen))}
+
+
+def _count_triples(
+    doc_tfs: list[dict[str, int]], vocab: dict[str, int]
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(term_ids, doc_ids, counts) for every distinct term in every doc."""
+    terms, docs, counts = [], [], []
+    for doc_idx, tf in enumerate(doc_tfs):
+        for t, c in tf.items():
+            terms.append(vocab[t])
+            docs.append(doc_idx)
+            counts.append(c)
+    return (
+        np.asarray(terms, dtype=INDEX_DTYPE),
+        np.asarray(docs, dtype=INDEX_DTYPE),
+        np.asarray(counts, dtype=np.float64),
+    )
+
+
+def _doc_lens(doc_tfs: list[dict[str, int]]) -> np.ndarray:
+    return np.array([sum(tf.values()) for tf in doc_tfs], dtype=INDEX_DTYPE)
+
+
+def _term_doc_matrix(
+    terms: np.ndarray, docs: np.ndarray, weights: np.ndarray, n_terms: int, n_docs: int
+) -> sparse.csr_matrix:
+    """Term x doc CSR matrix; row t holds the postings of term t."""
+    m = sparse.csr_matrix(
+        (weights.astype(WEIGHT_DTYPE), (terms, docs)),
+        shape=(n_terms, n_docs),
+    )
+    m.sort_indices()
+    return m
+
+
+def _query_matrix(rows: list[dict[int, float]], n_terms: int) -> sparse.csr_matrix:
+    """Q x V sparse matrix, one row of {term_id: weight} per query."""
+    indptr = np.zeros(len(rows) + 1, dtype=INDEX_DTYPE)
+    np.cumsum([len(r) for r in rows], out=indptr[1:])
+    cols = np.fromiter((t for r in rows for t in r), dtype=INDEX_DTYPE, count=indptr[-1])
+    vals = np.fromiter((w for r in rows for w in r.values()), dtype=WEIGHT_DTYPE, count=indptr[-1])
+    return sparse.csr_matrix((vals, cols, indptr), shape=(len(rows), n_terms))
+
+
+def top_k_from_arrays(
+    doc_ids: np.ndarray, scores: np.ndarray, top_k: int
+) -> list[tuple[int, float]]:
+    """
+    Top-k (doc_idx, score) pairs, descending, ties towards the lower doc index.
+    argpartition keeps this O(n) in the number of candidates.
+    """
+    if top_k <= 0 or len(scores) == 0:
+        return []
+    if len(scores) > top_k:
+        # keep everything tied with the k-th score, so the tie-break below
+        # decides which of them make the cut (argpartition picks arbitrarily)
+        kth = -np.partition(-scores, top_k - 1)[top_k - 1]
+        part = np.flatnonzero(scores >= kth)
+        doc_ids, scores = doc_ids[part], scores[part]
+    order = np.lexsort((doc_ids, -scores))[:top_k]
+    return [(int(doc_ids[i]), float(scores[i])) for i in order]
+
+
+def _top_k_rows(
+    scores: sparse.csr_matrix, top_k: int, positive_only: bool
+) -> list[list[tuple[int, float]]]:
+    """Top-k per row of a Q x N score matrix."""
+    out = []
+    for q in range(scores.shape[0]):
+        start, end = scores.indptr[q], scores.indptr[q + 1]
+        doc_ids, row = scores.indices[start:end], scores.data[start:end]
+        if positive_only:
+            mask = row > 0
+            doc_ids, row = doc_ids[mask], row[mask]
+        out.append(top_k_from_arrays(doc_ids, row, top_k))
+    return out
+
+
+def _score_batch(
+    q_rows: list[dict[int, float]], matrix: sparse.csr_matrix, top_k: int, positive_only: bool
+) -> list[list[tuple[int, float]]]:
+    """
+    Score many queries in one sparse (Q x V) @ (V x N) product, so the
+    postings shared by several queries are walked once.
+    """
+    nonempty = [i for i, r in enumerate(q_rows) if r]
+    results: list[list[tuple[int, float]]] = [[] for _ in q_rows]
+    if nonempty:
+        q = _query_matrix([q_rows[i] for i in nonempty], matrix.shape[0])
+        scores = (q @ matrix).tocsr()
+        indptr = matrix.indptr
+        count_work(int(sum(indptr[t + 1] - indptr[t] for i in nonempty for t in q_rows[i])), scores.nnz)
+        for i, ranking in zip(nonempty, _top_k_rows(scores, top_k, positive_only)):
+            results[i] = ranking
+    return results
+
+
+def _score_filtered(
+    q_row: dict[int, float], matrix: sparse.csr_matrix, allowed, top_k: int, positive_only: bool
+) -> list[tuple[int, float]]:
+    """
+    Score one query over the docs in `allowed` (a filters.DocFilter)
+    only: each query term's postings are cut down to the allowed docs
+    before any weight is summed.
+    """
+    docs, weights = [], []
+    walked = 0
+    for term_id, q_w in q_row.items():
+        start, end = matrix.indptr[term_id], matrix.indptr[term_id + 1]
+        walked += int(end - start)
+        row_docs = matrix.indices[start:end]
+        keep = allowed.positions(row_docs)
+        docs.append(row_docs[keep])
+        weights.append(matrix.data[start:end][keep] * WEIGHT_DTYPE(q_w))
+    if not docs:
+        return []
+    doc_ids, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+    count_work(walked, len(doc_ids))
+    # float32 scores, like the unfiltered sparse product, so ties order the same way
+    scores = np.bincount(inverse, weights=np.concatenate(weights), minlength=len(doc_ids))
+    scores = scores.astype(WEIGHT_DTYPE)
+    if positive_only:
+        mask = scores > 0
+        doc_ids, scores = doc_ids[mask], scores[mask]
+    return top_k_from_arrays(doc_ids, scores, top_k)
+
+
+# ── TF-IDF ────────────────────────────────────────────────
+
+class CsrTfidfVectorizer:
+    """TF-IDF cosine scorer on a term x doc CSR matrix."""
+
+    def __init__(self):
+        self.vocab: dict[str, int] = {}
+        self.idf: np.ndarray = np.zeros(0, dtype=np.float64)
+        self.matrix: sparse.csr_matrix | None = None
+        self.n_docs = 0
+
+    def fit(self, texts: list[str]):
+        self.fit_counts([count_terms(tokenize(t)) for t in texts])
+
+    def fit_counts(self, doc_tfs: list[dict[str, int]], doc_freq: dict[str, int] | None = None):
+        """Fit from per-document term counts."""
+        vocab = {t: i for i, t in enumerate(sorted(doc_freq))} if doc_freq else _build_vocab(doc_tfs)
+        self.fit_postings(vocab, *_count_triples(doc_tfs, vocab), _doc_lens(doc_tfs))
+
+    def fit_postings(self, vocab: dict[str, int], terms, docs, counts, doc_lens):
+        """Fit from (term id, doc, count) triples, see parallel_build.count_postings."""
+        self.n_docs = len(doc_lens)
+        self.vocab = vocab
+
+        # IDF: log(N / df) + 1  (smoothed) — same formula as the dict engine
+        df = np.bincount(terms, minlength=len(self.vocab))
+        self.idf = np.log(self.n_docs / (df + 1.0)) + 1.0
+
+        doc_lens = np.maximum(doc_lens, 1).astype(np.float64)
+        weights = counts / doc_lens[docs] * self.idf[terms]
+
+        # L2 normalize per document
+        norms = np.sqrt(np.bincount(docs, weights=weights * weights, minlength=self.n_docs))
+        norms[norms == 0] = 1.0
+        weights /= norms[docs]
+
+        self.matrix = _term_doc_matrix(terms, docs, weights, len(self.vocab), self.n_docs)
+
+    @classmethod
+    def from_index(cls, vocab, idf: np.ndarray, matrix: sparse.csr_matrix) -> "CsrTfidfVectorizer":
+        """Wrap prebuilt (e.g. memory-mapped) arrays, see index_store.py."""
+        self = cls()
+        self.vocab, self.idf, self.matrix = vocab, idf, matrix
+        self.n_docs = matrix.shape[1]
+        return self
+
+    def term_idf(self, token: str) -> float:
+        """IDF of `token`, 0.0 if it's not in the corpus."""
+        term_id = self.vocab.get(token)
+        return float(self.idf[term_id]) if term_id is not None else 0.0
+
+    def query(self, text: str, top_k: int = 10) -> list[tuple[int, float]]:
+        return self.query_tokens(tokenize(text), top_k=top_k)
+
+    def query_tokens(self, tokens: list[str], top_k: int = 10, allowed=None) -> list[tuple[int, float]]:
+        """`allowed` (a filters.DocFilter) restricts scoring to those docs."""
+        if allowed is not None:
+            return _score_filtered(self._query_weights(tokens), self.matrix, allowed, top_k, True)
+        return self.query_many([tokens], top_k=top_k)[0]
+
+    def query_many(self, token_lists: list[list[str]], top_k: int = 10) -> list[list[tuple[int, float]]]:
+        """Rankings for a batch of tokenized queries, scored together."""
+        return _score_batch([self._query_weights(t) for t in token_lists], self.matrix, top_k, True)
+
+    def _query_weights(self, tokens: list[str]) -> dict[int, float]:
+        length = len(tokens) or 1
+
+        q_vec: dict[int, float] = {}
+        for t, count in Counter(tokens).items():
+            term_id = self.vocab.get(t)
+            if term_id is not None:
+                q_vec[term_id] = (count / length) * self.idf[term_id]
+        norm = math.sqrt(sum(v * v for v in q_vec.values())) or 1.0
+        return {t: v / norm for t, v in q_vec.items()}
+
+
+# ── BM25 ──────────────────────────────────────────────────
+
+class CsrBM25:
+    """
+    Okapi BM25 with the per-posting term weight precomputed, so a query
+    is just the sum of weights across its tokens. k1=1.5, b=0.75.
+    """
+
+    def __init__(self, corpus_tokens: list[list[str]], k1=1.5, b=0.75):
+        self._fit([count_terms(tokens) for tokens in corpus_tokens], k1, b)
+
+    @classmethod
+    def from_counts(cls, doc_tfs: list[dict[str, int]], k1=1.5, b=0.75) -> "CsrBM25":
+        """Build from per-document term counts."""
+        self = cls.__new__(cls)
+        self._fit(doc_tfs, k1, b)
+        return self
+
+    @classmethod
+    def from_postings(cls, vocab: dict[str, int], terms, docs, counts, doc_lens, k1=1.5, b=0.75) -> "CsrBM25":
+        """Build from (term id, doc, count) triples, see parallel_build.count_postings."""
+        self = cls.__new__(cls)
+        self._fit_postings(vocab, terms, docs, counts, doc_lens, k1, b)
+        return self
+
+    def _fit(self, doc_tfs: list[dict[str, int]], k1, b):
+        vocab = _build_vocab(doc_tfs)
+        self._fit_postings(vocab, *_count_triples(doc_tfs, vocab), _doc_lens(doc_tfs), k1, b)
+
+    def _fit_postings(self, vocab, terms, docs, tf, doc_lens, k1, b):
+        self.k1 = k1
+        self.b = b
+        self.corpus_size = len(doc_lens)
+        self.doc_lens = np.asarray(doc_lens, dtype=INDEX_DTYPE)
+        self.avgdl = float(self.doc_lens.sum()) / max(self.corpus_size, 1)
+        self.vocab = vocab
+
+        df = np.bincount(terms, minlength=len(self.vocab)).astype(np.float64)
+        self.idf = np.log((self.corpus_size - df + 0.5) / (df + 0.5) + 1.0)
+
+        dl = self.doc_lens[docs].astype(np.float64)
+        denom = tf + self.k1 * (1 - self.b + self.b * dl / self.avgdl)
+        weights = self.idf[terms] * tf * (self.k1 + 1) / denom
+
+        self.matrix = _term_doc_matrix(terms, docs, weights, len(self.vocab), self.corpus_size)
+
+    @classmethod
+    def from_index(
+        cls, vocab, idf: np.ndarray, matrix: sparse.csr_matrix, doc_lens: np.ndarray, k1=1.5, b=0.75
+    ) -> "CsrBM25":
+        """Wrap prebuilt (e.g. memory-mapped) arrays, see index_store.py."""
+        self = cls.__new__(cls)
+        self.k1, self.b = k1, b
+        self.corpus_size = matrix.shape[1]
+        self.doc_lens = doc_lens
+        self.avgdl = float(np.sum(doc_lens)) / max(self.corpus_size, 1)
+        self.vocab, self.idf, self.matrix = vocab, idf, matrix
+        return self
+
+    def term_idf(self, token: str) -> float:
+        """IDF of `token`, 0.0 if it's not in the corpus."""
+        term_id = self.vocab.get(token)
+        return float(self.idf[term_id]) if term_id is not None else 0.0
+
+    def term_df(self, token: str) -> int:
+        """Length of `token`'s postings list (nonzeros in its matrix row)."""
+        term_id = self.vocab.get(token)
+        if term_id is None:
+            return 0
+        return int(self.matrix.indptr[term_id + 1] - self.matrix.indptr[term_id])
+
+    def score(self, query_tokens: list[str], top_k: int = 10, allowed=None) -> list[tuple[int, float]]:
+        """Return list of (doc_idx, score) sorted descending, within `allowed` if given."""
+        if allowed is not None:
+            return _score_filtered(self._query_weights(query_tokens), self.matrix, allowed, top_k, False)
+        return self.score_many([query_tokens], top_k=top_k)[0]
+
+    def score_many(self, token_lists: list[list[str]], top_k: int = 10) -> list[list[tuple[int, float]]]:
+        """Rankings for a batch of tokenized queries, scored together."""
+        return _score_batch([self._query_weights(t) for t in token_lists], self.matrix, top_k, False)
+
+    def _query_weights(self, query_tokens: list[str]) -> dict[int, float]:
+        # repeated query tokens count once per occurrence, as in retriever.BM25
+        q_vec: dict[int, float] = {}
+        for t, count in Counter(query_tokens).items():
+            term_id = self.vocab.get(t)
+            if term_id is not None:
+                q_vec[term_id] = float(count)
+        return q_vec
@@ -0,0 +1,122 @@
+"""
+AnswerCache (answer_cache.py): an LRU with a TTL in memory, and an
+SQLite tier that only its own thread touches. Answers outlive the
+process through SQLite, expired ones are never returned and are purged
+from both tiers, and /query stores only complete, error-free answers.
+"""
+
+import asyncio
+import sqlite3
+import threading
+import types
+
+import pytest
+
+import answer_cache
+from answer_cache import AnswerCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(answer_cache, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def _get(cache: AnswerCache, key: str):
+    return asyncio.run(cache.get(key))
+
+
+def test_lru_and_ttl(clock):
+    cache = AnswerCache(max_size=2, ttl=60, db_path="")
+    cache.put("a", ["A"])
+    cache.put("b", ["B"])
+    assert _get(cache, "a") == ["A"]  # now the most recent
+    cache.put("c", ["C"])
+    assert _get(cache, "b") is None  # least recently used, evicted
+    assert _get(cache, "a") == ["A"] and _get(cache, "c") == ["C"]
+
+    clock[0] += 61
+    assert _get(cache, "a") is None
+    assert cache.stats()["size"] == 1  # the expired entry is dropped on lookup
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 2
+
+
+def test_sqlite_tier_survives_restart(clock, tmp_path):
+    db = str(tmp_path / "answers.db")
+    cache = AnswerCache(max_size=8, ttl=60, db_path=db)
+    cache.put("k", ["tok", "ens"])
+    cache.close()  # waits for the queued write
+
+    restarted = AnswerCache(max_size=8, ttl=60, db_path=db)
+    threads = []
+    db_get = restarted._db_get
+
+    def recording_get(key):
+        threads.append(threading.current_thread().name)
+        return db_get(key)
+
+    restarted._db_get = recording_get
+    assert _get(restarted, "k") == ["tok", "ens"]
+    assert _get(restarted, "k") == ["tok", "ens"]  # promoted to memory
+    assert len(threads) == 1 and threads[0].startswith("answer-cache")
+
+    clock[0] += 61
+    restarted._mem.clear()
+    assert _get(restarted, "k") is None  # expired in SQLite too
+    restarted.close()
+    assert restarted._db_thread is None and restarted._db is None
+
+
+def test_purge(clock, tmp_path):
+    db = str(tmp_path / "answers.db")
+    cache = AnswerCache(max_size=8, ttl=60, db_path=db)
+    cache.put("old", ["1"])
+    clock[0] += 50
+    cache.put("new", ["2"])
+    clock[0] += 20  # "old" is 70s old, "new" 20s
+
+    cache.purge()
+    assert list(cache._mem) == ["new"]
+    cache.close()
+    with sqlite3.connect(db) as conn:
+        assert [row[0] for row in conn.execute("SELECT key FROM answers")] == ["new"]
+
+
+def test_disabled():
+    cache = AnswerCache(max_size=0, db_path="ignored.db")
+    cache.put("k", ["x"])
+    assert _get(cache, "k") is None
+    assert cache._db_thread is None
+    cache.close()
+
+
+# ── what /query stores ────────────────────────────────────
+
+@pytest.mark.parametrize("tokens, stored", [
+    (["complete ", "answer"], True),
+    (["partial ", "[ERROR] Groq API returned 500: oops\n"], False),
+    ([], False),
+    (["cut ", RuntimeError("connection dropped")], False),
+])
+def test_query_stores_only_complete_answers(monkeypatch, tokens, stored):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    cache = AnswerCache(max_size=8, ttl=60, db_path="")
+    monkeypatch.setattr(main, "answer_cache", cache)
+
+    async def fake_stream(query, context_docs, term_weights):
+        for token in tokens:
+            if isinstance(token, Exception):
+                raise token
+            yield token
+
+    monkeypatch.setattr(main, "astream_genomic_answer", fake_stream)
+    with TestClient(main.app) as client:
+        response = client.post("/query", json={"query": f"BRCA1 repair {len(tokens)} {stored}"})
+    assert response.status_code == 200
+    assert (cache.stats()["size"] == 1) is stored
+    if stored:
+        assert next(iter(cache._mem.values()))[1] == tokens
@@ -0,0 +1,69 @@
+"""
+pack_context (context_packer.py) fills a token budget with each doc's
+best-matching sentence first, then the next best ones, and lists every
+reference once, numbered in order of first citation.
+"""
+
+from context_packer import estimate_tokens, pack_context, split_passages
+
+DOCS = [
+    {
+        "id": "DOC-1", "title": "KRAS", "type": "gene", "gene": "KRAS",
+        "content": "KRAS is a GTPase. It cycles between GDP and GTP states. "
+                   "Sotorasib binds KRAS p.G12C covalently. Resistance arises through bypass signalling.",
+        "references": ["Smith 2020", "Lee 2021"],
+    },
+    {
+        "id": "DOC-2", "title": "NSCLC", "type": "clinical", "gene": "KRAS",
+        "content": "Lung cancer is common. Sotorasib was approved in 2021 for KRAS G12C tumors. "
+                   "Other drugs are in trials.",
+        "references": ["Lee 2021", "Kim 2022"],
+    },
+    {
+        "id": "DOC-3", "title": "TP53", "type": "gene", "gene": "TP53",
+        "content": "TP53 is a tumor suppressor. " * 10,
+        "references": ["Zed 1999"],
+    },
+]
+QUERY = "sotorasib resistance"
+
+
+def test_sentences_keep_variant_notation():
+    assert split_passages(DOCS[0]["content"])[2] == "Sotorasib binds KRAS p.G12C covalently."
+
+
+def test_budget_respected():
+    for budget in range(40, 260, 10):
+        assert estimate_tokens(pack_context(QUERY, DOCS, budget=budget)) <= budget, budget
+    # the top doc is kept even if it alone is over budget
+    assert "[DOC-1]" in pack_context(QUERY, DOCS, budget=5)
+
+
+def test_tiny_budget_keeps_best_sentence():
+    out = pack_context(QUERY, DOCS, {"sotorasib": 5.0, "resistance": 0.1}, budget=40)
+    assert "Sotorasib binds KRAS p.G12C covalently. ..." in out
+    assert "GTPase" not in out and "bypass" not in out
+    assert "[DOC-2]" not in out and "[DOC-3]" not in out
+
+    # the weights decide which sentence is best
+    out = pack_context(QUERY, DOCS, {"sotorasib": 0.1, "resistance": 5.0}, budget=40)
+    assert "Gene: KRAS\nResistance arises through bypass signalling.\n" in out
+    assert "Sotorasib" not in out
+
+
+def test_references_numbered_once():
+    out = pack_context(QUERY, DOCS, budget=0)  # no limit: everything, in full
+    for doc in DOCS:
+        assert doc["content"].strip() in out
+    assert "[DOC-1] KRAS ---\nType: gene | Gene: KRAS\n" in out
+    assert out.count("References: [R1], [R2]\n") == 1  # DOC-1
+    assert "References: [R2], [R3]\n" in out  # DOC-2 shares Lee 2021
+    assert out.endswith("References:\n[R1] Smith 2020\n[R2] Lee 2021\n[R3] Kim 2022\n[R4] Zed 1999")
+
+    # a doc dropped for budget brings no references
+    out = pack_context(QUERY, DOCS, budget=40)
+    assert out.endswith("References:\n[R1] Smith 2020\n[R2] Lee 2021")
+
+
+def test_no_documents():
+    assert pack_context(QUERY, []) == "No relevant documents were retrieved."
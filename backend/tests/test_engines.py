@@ -0,0 +1,259 @@
+"""
+Every engine and pruning mode must return the same top-k as exhaustive
+scoring with the dict engine, on a random corpus with plenty of ties.
+
+The csr and mmap engines store float32 weights, so two docs whose
+float64 scores differ in the last bits may swap places. Rankings are
+therefore compared by score: the doc at each rank must have the
+reference score of that rank (within float32 rounding), and its own
+score must match the reference score of that doc.
+"""
+
+import json
+import random
+
+import numpy as np
+import pytest
+
+import retriever
+from filters import DocFilter
+from retriever import HybridRetriever
+
+N_DOCS = 400
+N_QUERIES = 200
+TOP_K = 10
+WORDS = [f"w{i}" for i in range(300)]
+GENES = ["BRCA1", "KRAS", "TP53", "EGFR"]
+# a Zipf-ish draw: a few very common terms (long postings, many ties)
+WEIGHTS = [1 / (i + 1) for i in range(len(WORDS))]
+
+REL_TOL, ABS_TOL = 1e-5, 1e-6
+
+
+def _corpus(seed=0) -> list[dict]:
+    rng = random.Random(seed)
+    docs = []
+    for i in range(N_DOCS):
+        # mostly short docs, some past one passage window
+        n_words = rng.choice([3, 8, 20, 60, 250])
+        docs.append({
+            "id": f"DOC-{i:04d}",
+            "title": " ".join(rng.choices(WORDS, WEIGHTS, k=2)),
+            "type": rng.choice(["clinical", "pathway"]),
+            "gene": rng.choice(GENES),
+            "content": " ".join(rng.choices(WORDS, WEIGHTS, k=n_words)),
+            "references": [],
+        })
+    return docs
+
+
+def _queries(seed=1) -> list[list[str]]:
+    rng = random.Random(seed)
+    queries = [rng.choices(WORDS, WEIGHTS, k=rng.randint(1, 5)) for _ in range(N_QUERIES)]
+    queries.append(["not-in-the-corpus"])
+    queries.append(["w0", "w0", "w1"])  # repeated terms
+    return queries
+
+
+def _filters(n_rows: int, seed=2) -> list[DocFilter]:
+    rng = np.random.default_rng(seed)
+    out = []
+    for size in (1, 5, n_rows // 20, n_rows // 3, n_rows):
+        ids = np.sort(rng.choice(n_rows, size=size, replace=False)).astype(np.int32)
+        out.append(DocFilter(ids, n_rows))
+    return out
+
+
+def _close(a: float, b: float) -> bool:
+    return abs(a - b) <= ABS_TOL + REL_TOL * max(abs(a), abs(b))
+
+
+def assert_same_top_k(got, ref_scores: dict[int, float], top_k: int, positive_only: bool):
+    """`got` is a valid top-k of `ref_scores` (doc -> exact score)."""
+    items = ref_scores.items()
+    if positive_only:
+        items = [(d, s) for d, s in items if s > 0]
+    expected = sorted(items, key=lambda x: (-x[1], x[0]))[:top_k]
+    assert len(got) == len(expected), (got, expected)
+    seen = set()
+    for (doc, score), (_, ref) in zip(got, expected):
+        assert doc not in seen
+        seen.add(doc)
+        assert doc in ref_scores, (doc, got, expected)
+        assert _close(score, ref_scores[doc]), (doc, score, ref_scores[doc])
+        assert _close(ref_scores[doc], ref), (got, expected)
+
+
+# ── reference ─────────────────────────────────────────────
+
+@pytest.fixture(scope="module")
+def docs():
+    return _corpus()
+
+
+@pytest.fixture(scope="module")
+def reference(docs):
+    """Exhaustive dict-engine scores of every row, per query."""
+    r = HybridRetriever("dict")
+    r._install(docs, *r._build_scorers(docs))
+    n_rows = len(r.passages)
+    tfidf, bm25 = [], []
+    for tokens in _queries():
+        tfidf.append(dict(r.tfidf.query_tokens(tokens, top_k=n_rows)))
+        bm25.append(dict(r.bm25.score_exhaustive(tokens, top_k=n_rows)))
+    return {"tfidf": tfidf, "bm25": bm25, "n_rows": n_rows}
+
+
+def _built(engine: str, docs):
+    r = HybridRetriever(engine)
+    r._install(docs, *r._build_scorers(docs))
+    return r
+
+
+@pytest.fixture(scope="module")
+def mmap_retriever(docs, tmp_path_factory):
+    from index_builder import build_index_streaming
+
+    tmp = tmp_path_factory.mktemp("index")
+    source = tmp / "corpus.jsonl"
+    with open(source, "w") as f:
+        for doc in docs:
+            f.write(json.dumps(doc) + "\n")
+    build_index_streaming(str(source), str(tmp / "index"), chunk_size=97)
+    r = HybridRetriever("csr")
+    r.load_index(str(tmp / "index"))
+    return r
+
+
+@pytest.fixture(scope="module", params=["dict", "csr", "compact", "mmap"])
+def engine(request, docs, mmap_retriever):
+    if request.param == "mmap":
+        return mmap_retriever
+    return _built(request.param, docs)
+
+
+# ── tests ─────────────────────────────────────────────────
+
+def test_same_passages(engine, reference):
+    assert len(engine.passages) == reference["n_rows"]
+
+
+@pytest.mark.parametrize("pruning", ["maxscore", "off"])
+def test_bm25_top_k(engine, reference, pruning, monkeypatch):
+    monkeypatch.setattr(retriever, "BM25_PRUNING", pruning)
+    for tokens, ref in zip(_queries(), reference["bm25"]):
+        got = engine.bm25.score(tokens, top_k=TOP_K)
+        assert_same_top_k(got, ref, TOP_K, positive_only=False)
+
+
+def test_tfidf_top_k(engine, reference):
+    for tokens, ref in zip(_queries(), reference["tfidf"]):
+        got = engine.tfidf.query_tokens(tokens, top_k=TOP_K)
+        assert_same_top_k(got, ref, TOP_K, positive_only=True)
+
+
+def test_filtered_top_k(engine, reference):
+    for allowed in _filters(reference["n_rows"]):
+        keep = allowed.id_set()
+        for tokens, ref_t, ref_b in zip(_queries()[:50], reference["tfidf"], reference["bm25"]):
+            got = engine.tfidf.query_tokens(tokens, top_k=TOP_K, allowed=allowed)
+            assert_same_top_k(got, {d: s for d, s in ref_t.items() if d in keep}, TOP_K, True)
+            got = engine.bm25.score(tokens, top_k=TOP_K, allowed=allowed)
+            assert_same_top_k(got, {d: s for d, s in ref_b.items() if d in keep}, TOP_K, False)
+
+
+def test_batch_matches_single(engine):
+    """query_many / score_many, where an engine has them, rank like single queries."""
+    queries = _queries()[:50]
+    if hasattr(engine.tfidf, "query_many"):
+        assert engine.tfidf.query_many(queries, top_k=TOP_K) == [
+            engine.tfidf.query_tokens(q, top_k=TOP_K) for q in queries
+        ]
+    if hasattr(engine.bm25, "score_many"):
+        assert engine.bm25.score_many(queries, top_k=TOP_K) == [
+            engine.bm25.score(q, top_k=TOP_K) for q in queries
+        ]
+
+
+def test_search_matches_csr(docs, mmap_retriever):
+    """The on-disk index ranks exactly like the in-memory csr engine."""
+    csr = _built("csr", docs)
+    for tokens in _queries()[:50]:
+        query = " ".join(tokens)
+        got = mmap_retriever.search(query, TOP_K, use_cache=False)
+        want = csr.search(query, TOP_K, use_cache=False)
+        assert [h.id for h in got] == [h.id for h in want]
+
+
+@pytest.mark.parametrize("pruning", ["maxscore", "off"])
+def test_profiled_work(engine, pruning, monkeypatch):
+    """A profiled search counts the postings its scorers actually read."""
+    from profiler import QueryProfiler
+
+    monkeypatch.setattr(retriever, "BM25_PRUNING", pruning)
+    profiler = QueryProfiler(keep=1)
+    terms = ["w0", "w1", "w7"]
+    profiler.search(engine, " ".join(terms), TOP_K, None, "header")
+    trace = profiler.slowest()[0]
+    total = 2 * sum(engine.bm25.term_df(t) for t in terms)  # TF-IDF + BM25, exhaustive
+    if pruning == "off" and engine.engine != "compact":  # compact TF-IDF always prunes
+        assert trace["postings"] == total
+    assert 0 < trace["postings"] <= total
+    assert 0 < trace["candidates"] <= 2 * len(engine.passages)
+
+
+def test_profiling_one_at_a_time(engine):
+    """A search picked while another is under cProfile runs unprofiled."""
+    import profiler
+
+    query_profiler = profiler.QueryProfiler(keep=4)
+    with profiler._profiling:  # another search is being profiled
+        hits = query_profiler.search(engine, "w0 w1", TOP_K, None, "sampled")
+    assert [h.id for h in hits] == [h.id for h in engine.search("w0 w1", TOP_K)]
+    assert query_profiler.stats()["skipped"] == 1 and query_profiler.slowest() == []
+
+    query_profiler.search(engine, "w0 w1", TOP_K, None, "sampled")
+    assert len(query_profiler.slowest()) == 1
+
+
+def test_prebuilt_filters(docs, mmap_retriever):
+    """The filter lists stored with the index select what indexing the docs would."""
+    from filters import FilterIndex, normalize_filters
+    from index_store import MmapFilterIndex
+
+    base = mmap_retriever.segments[0]
+    assert isinstance(base._filters, MmapFilterIndex)
+    built = FilterIndex(docs)
+    for spec in ({"gene": "BRCA1"}, {"gene": ["kras", "TP53"], "type": "clinical"},
+                 {"type": "pathway"}, {"gene": "NOT-A-GENE"}):
+        key = normalize_filters(spec)
+        assert base.select(key).ids.tolist() == built.select(key).ids.tolist()
+
+
+def test_parallel_build_matches_serial(docs, monkeypatch):
+    """Sharded builds in spawned workers give exactly the serial scorers."""
+    import parallel_build
+    from passages import PassageMap
+    from sparse_index import CsrBM25, CsrTfidfVectorizer
+
+    monkeypatch.setattr(parallel_build, "PARALLEL_MIN_DOCS", 0)
+    texts = PassageMap().add(docs)
+    serial = parallel_build.count_postings(texts, workers=1)
+    sharded = parallel_build.count_postings(texts, workers=3)
+    assert sharded[0] == serial[0]
+    for got, want in zip(sharded[1:], serial[1:]):
+        assert np.array_equal(got, want)
+
+    # and the same as building from per-doc counts
+    doc_tfs, doc_freq = parallel_build.count_corpus(texts, workers=2)
+    assert doc_tfs == parallel_build.count_corpus(texts, workers=1)[0]
+    want_tfidf = CsrTfidfVectorizer()
+    want_tfidf.fit_counts(doc_tfs, doc_freq)
+    got_tfidf = CsrTfidfVectorizer()
+    got_tfidf.fit_postings(*sharded)
+    want_bm25, got_bm25 = CsrBM25.from_counts(doc_tfs), CsrBM25.from_postings(*sharded)
+    for got, want in ((got_tfidf, want_tfidf), (got_bm25, want_bm25)):
+        assert got.vocab == want.vocab
+        assert np.array_equal(got.idf, want.idf)
+        for name in ("data", "indices", "indptr"):
+            assert np.array_equal(getattr(got.matrix, name), getattr(want.matrix, name))
@@ -0,0 +1,176 @@
+"""
+The upstream limiter (limiter.py) and the retry loop around it
+(groq_client._astream). The limit grows only on completed streams and
+halves on throttling, at most once per cooldown; waiters get slots in
+arrival order, and one that gives up never holds a slot. Once the queue
+is full, /query answers 503 with a Retry-After instead of streaming.
+"""
+
+import asyncio
+import types
+
+import httpx
+import pytest
+
+import groq_client
+import limiter
+from limiter import AIMDLimiter, UpstreamBusy
+
+
+def _limiter(**kwargs) -> AIMDLimiter:
+    return AIMDLimiter(**{"initial": 2, "minimum": 1, "maximum": 10,
+                          "queue_size": 4, "queue_timeout": 5, **kwargs})
+
+
+def test_limit_grows_on_ok_and_halves_on_throttle(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(limiter, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    lim = _limiter()
+
+    async def stream(ok: bool):
+        async with lim.slot() as outcome:
+            outcome["ok"] = ok
+
+    asyncio.run(stream(ok=False))  # failed or abandoned: no change
+    assert lim.limit == 2
+    asyncio.run(stream(ok=True))
+    assert lim.limit == 2.5  # + 1 / limit
+    assert lim.in_flight == 0
+
+    lim.on_throttled()
+    assert lim.limit == 1.25
+    now[0] += 0.5
+    lim.on_throttled()  # same burst, inside the cooldown
+    assert lim.limit == 1.25
+    now[0] += limiter.DECREASE_COOLDOWN
+    lim.on_throttled()
+    assert lim.limit == 1  # never below the minimum
+    assert lim.throttled == 3
+
+
+def test_waiters_served_fifo():
+    async def run():
+        lim = _limiter(initial=1)
+        await lim.acquire()
+        order = []
+
+        async def wait(name):
+            await lim.acquire()
+            order.append(name)
+
+        tasks = {name: asyncio.create_task(wait(name)) for name in "abc"}
+        await asyncio.sleep(0)
+        assert lim.stats()["queued"] == 3
+
+        tasks["b"].cancel()  # gives up while queued
+        await asyncio.gather(tasks["b"], return_exceptions=True)
+        assert lim.stats()["queued"] == 2
+
+        lim.release(0.1)
+        await tasks["a"]
+        assert order == ["a"]
+        lim.release(0.1)
+        await tasks["c"]
+        assert order == ["a", "c"]
+        assert lim.in_flight == 1 and lim.stats()["queued"] == 0
+
+        # granted and cancelled at once: it either runs holding the slot
+        # or gives it back (asyncio.wait_for decides, per Python version),
+        # but the slot is never lost
+        late = asyncio.create_task(wait("d"))
+        await asyncio.sleep(0)
+        lim.release(0.1)
+        late.cancel()
+        await asyncio.gather(late, return_exceptions=True)
+        assert lim.in_flight == order.count("d")
+        assert tasks["b"].cancelled() and "b" not in order
+
+    asyncio.run(run())
+
+
+def test_queue_full_and_timeout():
+    async def run():
+        lim = _limiter(initial=1, queue_size=1, queue_timeout=0.05)
+        await lim.acquire()
+        assert not lim.queue_full()
+        waiter = asyncio.create_task(lim.acquire())
+        await asyncio.sleep(0)
+        assert lim.queue_full()
+        with pytest.raises(UpstreamBusy) as busy:
+            await lim.acquire()
+        assert busy.value.retry_after >= 1
+        assert lim.rejected == 1
+
+        with pytest.raises(UpstreamBusy):
+            await waiter
+        assert lim.timed_out == 1
+        assert lim.in_flight == 1 and not lim.queue_full()
+
+    asyncio.run(run())
+
+
+# ── retries (groq_client._astream) ────────────────────────
+
+SSE_OK = 'data: {"choices":[{"delta":{"content":"hi"}}]}\n\ndata: [DONE]\n\n'
+
+
+def _stream(monkeypatch, responses: list[httpx.Response]) -> tuple[list[str], list, AIMDLimiter]:
+    """Tokens of one _astream() against `responses`, the requests sent, and the limiter used."""
+    lim = _limiter(initial=4)
+    monkeypatch.setattr(groq_client, "upstream_limiter", lim)
+    monkeypatch.setattr(groq_client, "GROQ_BACKOFF_BASE", 0.0)
+    monkeypatch.setattr(groq_client, "GROQ_BACKOFF_MAX", 8.0)
+    sent = []
+
+    def handler(request):
+        sent.append(request)
+        return responses[len(sent) - 1]
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return [t async for t in groq_client._astream(client, "q", [])]
+
+    return asyncio.run(run()), sent, lim
+
+
+def test_retry_after_within_backoff_max_is_retried(monkeypatch):
+    tokens, sent, lim = _stream(monkeypatch, [
+        httpx.Response(429, headers={"Retry-After": "0"}),
+        httpx.Response(200, text=SSE_OK),
+    ])
+    assert tokens == ["hi"]
+    assert len(sent) == 2
+    assert lim.throttled == 1 and lim.in_flight == 0
+
+
+def test_retry_after_above_backoff_max_gives_up(monkeypatch):
+    tokens, sent, lim = _stream(monkeypatch, [
+        httpx.Response(429, headers={"Retry-After": "30"}),
+        httpx.Response(200, text=SSE_OK),
+    ])
+    assert len(sent) == 1
+    assert len(tokens) == 1 and tokens[0].startswith("[ERROR] Groq API returned 429")
+    assert lim.limit == 2 and lim.in_flight == 0
+
+
+# ── /query ────────────────────────────────────────────────
+
+def test_query_sheds_when_queue_full(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    lim = _limiter(initial=1, queue_size=0)
+    lim.in_flight = 1
+    monkeypatch.setattr(main, "upstream_limiter", lim)
+
+    def no_upstream(*args):
+        raise AssertionError("a shed query must not open a stream")
+
+    monkeypatch.setattr(main, "astream_genomic_answer", no_upstream)
+    with TestClient(main.app) as client:
+        response = client.post("/query", json={"query": "KRAS G12C shed test"})
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert lim.rejected == 1
+    assert main.query_flights.stats()["in_flight"] == 0
@@ -0,0 +1,116 @@
+"""
+SingleFlight (singleflight.py): concurrent callers of one key share one
+run of the source. A late joiner is replayed what it missed, the source
+is cancelled once nobody listens, and a finished or abandoned flight is
+never left behind in _flights, whichever way it ended.
+"""
+
+import asyncio
+
+from singleflight import SingleFlight
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_late_joiner_is_replayed():
+    async def run():
+        sf = SingleFlight()
+        gate = asyncio.Event()
+        calls = []
+
+        async def source():
+            calls.append(1)
+            yield 1
+            yield 2
+            await gate.wait()
+            yield 3
+
+        first = sf.stream("k", source)
+        assert [await anext(first), await anext(first)] == [1, 2]
+        late = sf.stream("k", source)
+        assert [await anext(late), await anext(late)] == [1, 2]  # replayed
+
+        gate.set()
+        assert [x async for x in first] == [3]
+        assert [x async for x in late] == [3]
+        assert calls == [1]
+        assert sf.stats() == {"in_flight": 0, "started": 1, "joined": 1}
+
+        # finished: the next caller runs the source again
+        assert [x async for x in sf.stream("k", source)] == [1, 2, 3]
+        assert calls == [1, 1]
+
+    asyncio.run(run())
+
+
+def test_source_cancelled_when_last_subscriber_leaves():
+    async def run():
+        sf = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def source():
+            try:
+                yield "token"
+                await asyncio.Event().wait()  # an upstream stream that stalls
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        a, b = sf.stream("k", source), sf.stream("k", source)
+        assert await anext(a) == "token" and await anext(b) == "token"
+        task = sf._flights["k"].task
+
+        await a.aclose()
+        await _settle()
+        assert not cancelled.is_set()  # b still listens
+
+        await b.aclose()
+        await _settle()
+        assert cancelled.is_set() and task.cancelled()
+        assert sf._flights == {}
+
+    asyncio.run(run())
+
+
+def test_busy_first_event_closes_the_flight():
+    """As query_endpoint does with a ("busy", None) first event."""
+    async def run():
+        sf = SingleFlight()
+
+        async def busy():
+            yield "busy", None
+
+        async def busy_then_stall():
+            yield "busy", None
+            await asyncio.Event().wait()
+
+        for source in (busy, busy_then_stall):
+            events = sf.stream(source.__name__, source)
+            assert await anext(events) == ("busy", None)
+            await events.aclose()
+            await _settle()
+            assert sf._flights == {}, source.__name__
+
+    asyncio.run(run())
+
+
+def test_outside_cancellation_propagates():
+    async def run():
+        sf = SingleFlight()
+
+        async def source():
+            yield 1
+            await asyncio.Event().wait()
+
+        events = sf.stream("k", source)
+        assert await anext(events) == 1
+        task = sf._flights["k"].task
+        task.cancel()  # e.g. loop shutdown, with a subscriber still there
+        assert [x async for x in events] == []  # the subscriber is ended
+        assert task.cancelled()
+        assert sf._flights == {}
+
+    asyncio.run(run())
@@ -0,0 +1,54 @@
+"""
+The genomic tokenizer (the default TOKENIZER) keeps variant notation
+and gene symbols together, adds the extra tokens queries match on, and
+otherwise tokenizes like `simple`, so ordinary prose ranks as before.
+"""
+
+import pytest
+
+from tokenizer import TOKENIZERS, count_terms
+
+genomic, simple = TOKENIZERS["genomic"], TOKENIZERS["simple"]
+
+
+@pytest.mark.parametrize("text, tokens", [
+    # gene + protein change: the parts plus the compound
+    ("KRAS G12C", ["kras", "g12c", "kras_g12c"]),
+    ("BRAF p.V600E", ["braf", "p.v600e", "v600e", "braf_v600e"]),
+    # HGVS: one token, p. changes also bare
+    ("p.G12C", ["p.g12c", "g12c"]),
+    ("c.68_69delAG", ["c.68_69delag"]),
+    ("c.742C>T", ["c.742c>t"]),
+    # hyphenated symbols: the whole symbol, then its parts
+    ("BCR-ABL1", ["bcr-abl1", "bcr", "abl1"]),
+    ("HLA-B", ["hla-b", "hla", "b"]),
+    ("RAS-RAF-MEK-ERK", ["ras-raf-mek-erk", "ras", "raf", "mek", "erk"]),
+])
+def test_genomic_spans(text, tokens):
+    assert genomic(text) == tokens
+
+
+def test_spans_inside_prose():
+    assert genomic("Sotorasib targets KRAS G12C (c.34G>T) in NSCLC.") == [
+        "sotorasib", "targets", "kras", "g12c", "kras_g12c", "c.34g>t", "in", "nsclc",
+    ]
+
+
+@pytest.mark.parametrize("text", [
+    "e.g. 5 patients",
+    "i.e. 3 of them",
+    "e.g.5",
+    "see Fig. 2, p. 14",
+    "The KRAS gene was sequenced in 12 samples.",
+    "hazard ratio 0.62 (95% CI 0.48-0.80)",
+])
+def test_prose_like_simple(text):
+    """No HGVS or compound tokens where the text has none."""
+    assert genomic(text) == simple(text)
+
+
+def test_count_terms_interns_keys():
+    a = count_terms(genomic("KRAS G12C"))
+    b = count_terms(genomic("".join(["KR", "AS"]) + " G12C"))
+    assert a == {"kras": 1, "g12c": 1, "kras_g12c": 1}
+    assert all(x is y for x, y in zip(a, b))
@@ -0,0 +1,291 @@
+"""
+Writes go to delta segments over an immutable base (see segments.py).
+Whatever mix of adds, replacements, deletes and merges, a search must
+see exactly the live documents: every new doc right away, and never a
+replaced or deleted copy. A base merge must rank like a fresh build
+over the same documents.
+"""
+
+import json
+import os
+import random
+import threading
+
+import pytest
+
+import retriever
+from retriever import HybridRetriever
+
+GENES = ["BRCA1", "KRAS", "TP53"]
+
+
+def _doc(i: int, version: int = 0, rng=random.Random(0)) -> dict:
+    words = " ".join(rng.choices(["variant", "tumor", "pathway", "kinase", "repair"], k=12))
+    return {
+        "id": f"DOC-{i:04d}",
+        "title": f"doc {i}",
+        "type": "clinical",
+        "gene": GENES[i % len(GENES)],
+        # a token only this version of this doc has
+        "content": f"marker{i}v{version} {words}",
+        "references": [],
+    }
+
+
+def _hits(r: HybridRetriever, query: str, **kwargs) -> list[str]:
+    return [hit.id for hit in r.search(query, top_k=5, use_cache=False, **kwargs)]
+
+
+def _check(r: HybridRetriever, live: dict[str, dict], gone: list[str]):
+    """`live` docs (id -> current version) are found; `gone` markers aren't."""
+    assert r.index_size == len(live)
+    for doc in live.values():
+        marker = doc["content"].split()[0]
+        assert _hits(r, marker)[:1] == [doc["id"]], marker
+        assert r.get_document(doc["id"]) == doc
+        assert _hits(r, marker, filters={"gene": doc["gene"]})[:1] == [doc["id"]]
+    for marker in gone:
+        assert _hits(r, marker) == [], marker
+    for doc_id in _hits(r, "variant tumor pathway kinase repair"):
+        assert doc_id in live
+
+
+def _writes(r: HybridRetriever, live: dict, gone: list, n: int, seed: int):
+    rng = random.Random(seed)
+    next_id = 1000 * seed  # never reuses the id of a deleted doc
+    for step in range(n):
+        op = rng.choice(["add", "replace", "delete"])
+        if op == "add":
+            doc = _doc(next_id)
+            next_id += 1
+            r.add_documents([doc])
+            live[doc["id"]] = doc
+        elif op == "replace":
+            old = live[rng.choice(sorted(live))]
+            i = int(old["id"][4:])
+            doc = _doc(i, int(old["content"].split()[0].rsplit("v", 1)[1]) + 1)
+            r.add_documents([doc])
+            gone.append(old["content"].split()[0])
+            live[doc["id"]] = doc
+        else:
+            doc = live.pop(rng.choice(sorted(live)))
+            assert r.delete_documents([doc["id"]]) == 1
+            gone.append(doc["content"].split()[0])
+
+
+@pytest.fixture(autouse=True)
+def no_auto_merge(monkeypatch):
+    """Merges only when a test calls merge()."""
+    monkeypatch.setattr(retriever, "INDEX_MERGE_MIN_UPDATES", 10**9)
+    monkeypatch.setattr(retriever, "INDEX_MAX_DELTAS", 10**9)
+    monkeypatch.setattr(retriever, "INDEX_WRITE_LOG", "")
+
+
+def _write_source(path, docs):
+    with open(path, "w") as f:
+        for doc in docs:
+            f.write(json.dumps(doc) + "\n")
+
+
+def _open(engine: str, docs: list[dict], tmp_path) -> HybridRetriever:
+    if engine == "mmap":
+        from index_builder import build_index_streaming
+
+        tmp_path.mkdir(exist_ok=True)
+        _write_source(tmp_path / "corpus.jsonl", docs)
+        build_index_streaming(str(tmp_path / "corpus.jsonl"), str(tmp_path / "index"), chunk_size=7)
+        r = HybridRetriever("csr")
+        r.load_index(str(tmp_path / "index"))
+        return r
+    r = HybridRetriever(engine)
+    r._install(docs, *r._build_scorers(docs))
+    return r
+
+
+@pytest.mark.parametrize("engine", ["dict", "csr", "compact", "mmap"])
+def test_writes_and_merges(engine, tmp_path):
+    docs = [_doc(i) for i in range(30)]
+    r = _open(engine, docs, tmp_path)
+    live, gone = {d["id"]: d for d in docs}, []
+
+    _writes(r, live, gone, 40, seed=1)
+    assert len(r.segments) > 1
+    _check(r, live, gone)
+
+    r.merge(first=1)  # deltas -> one delta
+    assert len(r.segments) == 2
+    _check(r, live, gone)
+
+    _writes(r, live, gone, 20, seed=2)
+    r.merge()  # everything -> a new base
+    assert len(r.segments) == 1 and not any(r.snapshot.dead)
+    _check(r, live, gone)
+
+    # ranks like a fresh build over the same docs, in slot order
+    fresh = _open(engine, [r.snapshot.doc(s) for s in range(r.index_size)], tmp_path / "fresh")
+    for query in ("variant tumor", "kinase repair pathway", "marker3v0 tumor"):
+        assert [(h.id, h.score) for h in r.search(query, use_cache=False)] == [
+            (h.id, h.score) for h in fresh.search(query, use_cache=False)
+        ]
+
+
+def test_writes_during_merge():
+    docs = [_doc(i) for i in range(20)]
+    r = _open("dict", docs, None)
+    live, gone = {d["id"]: d for d in docs}, []
+    _writes(r, live, gone, 10, seed=3)
+
+    started, resume = threading.Event(), threading.Event()
+    build = r._build_scorers
+
+    def slow_build(documents):
+        started.set()
+        resume.wait()
+        return build(documents)
+
+    r._build_scorers = slow_build
+    merge = threading.Thread(target=r.merge)
+    merge.start()
+    started.wait()
+    _writes(r, live, gone, 15, seed=4)  # replaces and deletes docs being merged
+    resume.set()
+    merge.join()
+
+    assert len(r.segments) > 1  # the deltas written meanwhile stay
+    _check(r, live, gone)
+
+
+def test_write_log_replay(monkeypatch, tmp_path):
+    monkeypatch.setattr(retriever, "INDEX_WRITE_LOG", str(tmp_path / "writes.jsonl"))
+    docs = [_doc(i) for i in range(20)]
+    r = _open("mmap", docs, tmp_path)
+    live, gone = {d["id"]: d for d in docs}, []
+    _writes(r, live, gone, 15, seed=5)
+
+    # a restart replays the log onto the index on disk
+    restarted = HybridRetriever("csr")
+    restarted.load_index(str(tmp_path / "index"))
+    _check(restarted, live, gone)
+
+    # a base merge writes the index back and compacts the log, whose
+    # compacted prefix the new index's manifest says it holds
+    restarted.merge()
+    log = (tmp_path / "writes.jsonl").read_bytes()
+    assert len(log.splitlines()) <= 2
+    again = HybridRetriever("csr")
+    again.load_index(str(tmp_path / "index"))
+    assert len(again.segments) == 1
+    _check(again, live, gone)
+
+
+def test_write_log_survives_source_rebuild(monkeypatch, tmp_path):
+    """merge, then the source changes on disk, then restart: no acknowledged write is lost."""
+    monkeypatch.setattr(retriever, "INDEX_WRITE_LOG", str(tmp_path / "writes.jsonl"))
+    docs = [_doc(i) for i in range(20)]
+    r = _open("mmap", docs, tmp_path)
+    monkeypatch.setattr(retriever, "DOCUMENT_SOURCE", str(tmp_path / "corpus.jsonl"))
+    live, gone = {d["id"]: d for d in docs}, []
+    _writes(r, live, gone, 15, seed=6)
+    r.merge()
+    _writes(r, live, gone, 5, seed=7)  # after the merge, still only in the log
+
+    # touched: the index is stale, so the base is rebuilt from the source
+    # without any of the writes, and the whole log goes on top of it
+    source = tmp_path / "corpus.jsonl"
+    stat = source.stat()
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    restarted = HybridRetriever("csr")
+    restarted.load_or_build(str(tmp_path / "index"))
+    assert restarted._index_path is None
+    _check(restarted, live, gone)
+
+    # and as `index_store.py build` would: a fresh index from the source
+    from index_builder import build_index_streaming
+
+    build_index_streaming(str(source), str(tmp_path / "index"))
+    rebuilt = HybridRetriever("csr")
+    rebuilt.load_or_build(str(tmp_path / "index"))
+    assert rebuilt._index_path is not None
+    _check(rebuilt, live, gone)
+
+
+def _dense_index(path, docs):
+    """A dense index over `docs` with made-up vectors (no model needed)."""
+    import numpy as np
+    from dense import DenseIndex, DenseRetriever
+    from index_store import doc_digest
+
+    path.mkdir()
+    np.save(path / "doc_ids.npy", np.array([d["id"].encode() for d in docs]))
+    np.save(path / "doc_digests.npy", np.array([doc_digest(d) for d in docs], dtype=np.uint64))
+    np.save(path / "vectors.npy", np.eye(len(docs), dtype=np.float16))
+    np.save(path / "centroids.npy", np.zeros((1, len(docs)), dtype=np.float32))
+    np.save(path / "list_offsets.npy", np.array([0, len(docs)]))
+    (path / "manifest.json").write_text(json.dumps({
+        "format_version": 1, "model": "none", "dim": len(docs), "dtype": "float16",
+        "ann": "ivf", "nlist": 1, "n_docs": len(docs),
+    }))
+    return DenseRetriever(DenseIndex(str(path)), encoder=None)
+
+
+def test_rewritten_doc_loses_its_vector(tmp_path):
+    docs = [_doc(i) for i in range(6)]
+    r = _open("mmap", docs, tmp_path)
+    dense = _dense_index(tmp_path / "dense", docs)
+    with r._lock:
+        snap = r.snapshot.copy()
+        snap.dense, snap.dense_slots = dense, dense.bind(snap.live_ids(), snap.doc_digest)
+        r._publish(snap)
+
+    def vector_slot(doc_id):
+        return int(r.snapshot.dense_slots[dense.row_of(doc_id)])
+
+    assert vector_slot("DOC-0001") == r.snapshot.slot_of("DOC-0001")
+    r.add_documents([_doc(1, version=1), docs[2]])  # a new version, and the same doc again
+    assert vector_slot("DOC-0001") == -1
+    assert vector_slot("DOC-0002") == r.snapshot.slot_of("DOC-0002")
+    for first in (1, 0):  # merges rebind the vectors, and must not bring it back
+        r.merge(first=first)
+        assert vector_slot("DOC-0001") == -1
+        assert vector_slot("DOC-0002") == r.snapshot.slot_of("DOC-0002")
+        assert vector_slot("DOC-0003") == r.snapshot.slot_of("DOC-0003")
+
+
+def test_search_takes_no_lock():
+    docs = [_doc(i) for i in range(10)]
+    r = _open("dict", docs, None)
+    with r._lock:  # held by a writer
+        search = threading.Thread(target=_hits, args=(r, "marker1v0"))
+        search.start()
+        search.join(timeout=5)
+        assert not search.is_alive()
+
+
+def test_reads_during_writes_and_merges():
+    docs = [_doc(i) for i in range(30)]
+    r = _open("compact", docs, None)
+    live, gone = {d["id"]: d for d in docs}, []
+    stop, errors = threading.Event(), []
+
+    def read():
+        while not stop.is_set():
+            try:
+                for hit in r.search("variant tumor kinase", top_k=10, use_cache=False):
+                    assert hit.id.startswith("DOC-")
+                r.search("repair", filters={"gene": "KRAS"}, use_cache=False)
+            except Exception as e:  # surfaced below
+                errors.append(e)
+                return
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for t in readers:
+        t.start()
+    for seed in range(6, 10):
+        _writes(r, live, gone, 10, seed=seed)
+        r.merge(first=seed % 2)
+    stop.set()
+    for t in readers:
+        t.join()
+
+    assert not errors, errors
+    _check(r, live, gone)
@@ -0,0 +1,105 @@
+"""
+Tokenizers shared by every scorer, so a query is tokenized once per search.
+
+Two are built in, selected with TOKENIZER:
+
+    simple   lowercased [a-z0-9]+ runs
+    genomic  (default) the same, but keeps variant notation intact:
+               c.68_69delAG, p.G12C, c.742C>T  -> one HGVS token
+                                                  (p. changes also as "g12c")
+               KRAS G12C, BRAF p.V600E         -> "kras", "g12c" plus the
+                                                  compound "kras_g12c"
+               HLA-B, BCR-ABL1, PD-1           -> "bcr-abl1" plus its parts
+
+The genomic tokenizer only does extra work around those spans: one
+precompiled scan finds them and the text in between goes through the
+simple regex. Index builds tokenize about half as fast as with `simple`;
+queries are short enough that it doesn't show.
+
+Other tokenizers can be added with register_tokenizer(). Indexes must be
+queried with the tokenizer they were built with; index_store.py records
+it in the manifest.
+"""
+
+import os
+import re
+import sys
+from typing import Callable
+
+TOKENIZER = os.getenv("TOKENIZER", "genomic")
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+# HGVS strings, gene + protein change, hyphenated symbols. Every branch
+# starts with the same character class so re can skip ahead to candidate
+# positions instead of trying the whole alternation at every character.
+_SPECIAL_RE = re.compile(
+    r"""
+    [cgmnorpA-Z](?<![\w.][cgmnorpA-Z])                  # start of a word
+    (?:
+        (?<=[cgmnorp])\.(?=[\w*+>?-]*\d)[\w*+>?-]*[\w*?]  # c.68_69delAG
+      | (?<=[A-Z])[A-Z0-9]{1,9}\s+
+        (?P<change>(?:p\.)?[A-Z]\d+[A-Z*])(?!\w)          # KRAS G12C
+      | (?<=[A-Z])[A-Z0-9]*(?:-[A-Z0-9]+)+\b              # BCR-ABL1
+    )
+    """,
+    re.VERBOSE,
+)
+
+
+def _simple(text: str) -> list[str]:
+    """Lowercased alphanumeric tokens."""
+    return _WORD_RE.findall(text.lower())
+
+
+def _special_tokens(m: re.Match) -> list[str]:
+    token = m.group().lower()
+    change = m.group("change")
+    if change:
+        gene, change = token.split()[0], change.lower()
+        bare = change[2:] if change.startswith("p.") else change
+        tokens = [gene, change] if bare == change else [gene, change, bare]
+        return [*tokens, f"{gene}_{bare}"]
+    if token[1] == ".":
+        return [token, token[2:]] if token.startswith("p.") else [token]
+    return [token, *token.split("-")]
+
+
+def _genomic(text: str) -> list[str]:
+    tokens = []
+    pos = 0
+    for m in _SPECIAL_RE.finditer(text):
+        if m.start() > pos:
+            tokens += _WORD_RE.findall(text[pos:m.start()].lower())
+        tokens += _special_tokens(m)
+        pos = m.end()
+    tokens += _WORD_RE.findall(text[pos:].lower())
+    return tokens
+
+
+TOKENIZERS: dict[str, Callable[[str], list[str]]] = {
+    "simple": _simple,
+    "genomic": _genomic,
+}
+
+
+def register_tokenizer(name: str, fn: Callable[[str], list[str]]):
+    """Make `fn` selectable with TOKENIZER=<name>."""
+    TOKENIZERS[name] = fn
+
+
+def tokenize(text: str) -> list[str]:
+    """Tokens of `text` with the configured TOKENIZER."""
+    return TOKENIZERS[TOKENIZER](text)
+
+
+def count_terms(tokens: list[str]) -> dict[str, int]:
+    """
+    token -> term frequency, in order of first appearance. Keys are
+    interned, so the per-doc dicts and postings of a large corpus share
+    one string object per term instead of one per occurrence.
+    """
+    tf: dict[str, int] = {}
+    for t in tokens:
+        tf[t] = tf.get(t, 0) + 1
+    return {sys.intern(t): c for t, c in tf.items()}
@@ -171,8 +171,9 @@ function renderReferences(refs) {
             .map(r => `<div class="ref-citation">• ${escapeHtml(r)}</div>`)
             .join("");
 
+        // documents can arrive through POST /documents: escape every field
         card.innerHTML = `
-            <span class="ref-id">${ref.id}</span>
+            <span class="ref-id">${escapeHtml(ref.id)}</span>
             <div class="ref-body">
                 <div class="ref-title">${escapeHtml(ref.title)}</div>
                 <div class="ref-meta">
@@ -180,14 +181,43 @@ function renderReferences(refs) {
                     <span class="type-tag">${escapeHtml(ref.type)}</span>
                 </div>
                 ${citationsHtml ? `<div class="ref-citations">${citationsHtml}</div>` : ""}
+                <div class="ref-content"></div>
             </div>
-            <span class="ref-score">score: ${ref.score}</span>
+            <span class="ref-score">score: ${escapeHtml(ref.score)}</span>
         `;
 
+        card.addEventListener("click", () => toggleReference(card));
         refsGrid.appendChild(card);
     }
 }
 
+// ── expand a reference: full document, fetched on demand ──
+
+// the references stream only carries titles and citations; the full
+// text is loaded when a card is first expanded. No client-side cache: a
+// document can be replaced through POST /documents, so every load goes
+// to the server, and the browser revalidates its copy with the
+// document's ETag (Cache-Control: no-cache), getting a 304 if unchanged
+async function fetchDocument(id) {
+    const res = await fetch(`${API_BASE}/documents/${encodeURIComponent(id)}`);
+    if (!res.ok) throw new Error(`HTTP ${res.status}`);
+    return res.json();
+}
+
+async function toggleReference(card) {
+    const content = card.querySelector(".ref-content");
+    if (card.classList.toggle("expanded") === false || content.dataset.loaded) return;
+
+    content.textContent = "loading …";
+    try {
+        const doc = await fetchDocument(card.dataset.id);
+        content.textContent = doc.content;
+        content.dataset.loaded = "1";
+    } catch (err) {
+        content.textContent = `could not load document (${err.message})`;
+    }
+}
+
 // ── highlight [DOC-XXX] citations in the answer ───────────
 
 function highlightCitations() {